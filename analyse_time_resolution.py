@@ -28,11 +28,17 @@ import lip_pps_run_manager as RM
 import logging
 import pandas
 import numpy
-import sqlite3
 
 from utilities import filter_dataframe
 from utilities import make_histogram_plot
 from utilities import make_2d_line_plot
+from utilities import etroc1_data_view
+from storage_utilities import read_table
+from storage_utilities import write_table
+from storage_utilities import find_table_backend
+from storage_utilities import EventTensor
+from storage_utilities import CutflowFilter
+from storage_utilities import read_filter
 
 import scipy.odr
 import plotly.express as px
@@ -43,44 +49,42 @@ from math import sqrt
 def calculate_time_delta(
     iteration:int,
     board_list:list[int],
-    data_df:pandas.DataFrame,
-    pivot_df:pandas.DataFrame,
+    event_tensor:EventTensor,
     ):
-    delta_column = "time_delta"
-    time_column = "time_of_arrival_twc_iteration_{}".format(iteration)
-    for board_id in board_list:
-        delta_board_column = (delta_column, board_id)
+    """
+    Returns the layers with the time delta and the time difference of each
+    board after the given time walk correction iteration
+    """
+    time_layer = event_tensor["time_of_arrival_twc_iteration_{}".format(iteration)]
 
-        columns_to_sum = []
-        for other_board in board_list:
-            if other_board == board_id:
-                continue
-            columns_to_sum += [(time_column, other_board)]
-        pivot_df[delta_board_column] = pivot_df[columns_to_sum].sum(axis=1)/(len(board_list) - 1) - pivot_df[(time_column, board_id)]
-    data_df[delta_column] = pivot_df.stack()[delta_column]
+    delta_layer = numpy.full(event_tensor.hits.shape, numpy.nan)
+    for board_id in board_list:
+        board_idx = event_tensor.board_index(board_id)
+        other_boards_idx = [event_tensor.board_index(other_board) for other_board in board_list if other_board != board_id]
+        # The missing boards are left out of the sum, like when summing the columns of a dataframe
+        delta_layer[:, board_idx] = numpy.nansum(time_layer[:, other_boards_idx], axis=1)/(len(board_list) - 1) - time_layer[:, board_idx]
 
-    diff_column = "time_diff"
+    diff_layer = numpy.full(event_tensor.hits.shape, numpy.nan)
     for idx_0 in range(len(board_list)):
         # Create the following pairs( for 3 boards): [(0, 1), (1, 2), (2, 0)]
         idx_1 = idx_0 + 1
         if idx_1 == len(board_list):
             idx_1 = 0
-        board_id_0 = board_list[idx_0]
-        board_id_1 = board_list[idx_1]
+        board_idx_0 = event_tensor.board_index(board_list[idx_0])
+        board_idx_1 = event_tensor.board_index(board_list[idx_1])
 
-        diff_board_column = (diff_column, board_id_0)
-        board_column_0 = (time_column, board_id_0)
-        board_column_1 = (time_column, board_id_1)
+        diff_layer[:, board_idx_0] = time_layer[:, board_idx_0] - time_layer[:, board_idx_1]
 
-        pivot_df[diff_board_column] = pivot_df[board_column_0] - pivot_df[board_column_1]
-    data_df[diff_column] = pivot_df.stack()[diff_column]
+    return delta_layer, diff_layer
 
 def calculate_time_resolution_with_time_filters(
         Jorge: RM.TaskManager,
         script_logger: logging.Logger,
         original_df: pandas.DataFrame,
-        time_filters: dict[str, Path],
+        event_tensor: EventTensor,
+        time_filters: dict[str, Path | CutflowFilter],
         max_twc_iterations: int,
+        storage_backend: str = None,
     ):
     board_list = sorted(original_df['data_board_id'].unique())
     N = len(board_list)  # N is the number of boards
@@ -97,6 +101,10 @@ def calculate_time_resolution_with_time_filters(
         if largest_idx is None or step_idx > largest_idx:
             largest_idx = step_idx
 
+    # The time deltas do not depend on the cuts, so they are calculated once for all the steps
+    hit_index = event_tensor.locate(original_df["event"].to_numpy(), original_df["data_board_id"].to_numpy())
+    time_delta_layers = [calculate_time_delta(twc_iteration, board_list, event_tensor) for twc_iteration in range(max_twc_iterations)]
+
     timing_info = pandas.DataFrame()
     for step in time_filters:
         if step != 'Final':
@@ -107,34 +115,21 @@ def calculate_time_resolution_with_time_filters(
         data_df = filter_dataframe(
             df=original_df,
             filter_files={
-                "event": Jorge.path_directory/"event_filter.fd",
+                "event": Jorge.path_directory/"event_filter.npz",
                 "time": time_filters[step],
             },
             script_logger=script_logger,
         )
 
-        pivot_df = data_df.pivot(
-            index = 'event',
-            columns = 'data_board_id',
-            values = list(set(data_df.columns) - {'data_board_id', 'event'}),
-        )
-
         for twc_iteration in range(max_twc_iterations):
             twcDir = Jorge.task_path/("twc_iteration_{}".format(twc_iteration))
             twcDir.mkdir(exist_ok=True)
             outDir = twcDir/step
             outDir.mkdir(exist_ok=True)
 
-            data_df.set_index(["event", "data_board_id"], inplace=True)
-
-            calculate_time_delta(
-                iteration=twc_iteration,
-                board_list=board_list,
-                data_df=data_df,
-                pivot_df=pivot_df,
-            )
-
-            data_df.reset_index(inplace=True)
+            delta_layer, diff_layer = time_delta_layers[twc_iteration]
+            data_df["time_delta"] = delta_layer[hit_index]
+            data_df["time_diff"] = diff_layer[hit_index]
 
             make_histogram_plot(
                 data_df=data_df,
@@ -224,11 +219,7 @@ def calculate_time_resolution_with_time_filters(
             #    print(twc_timing_info)
 
             # Save the timing info of this pair (cuts, iteration)
-            with sqlite3.connect(outDir/'data.sqlite') as output_twc_sqlite3:
-                twc_timing_info.to_sql('timing_info',
-                                       output_twc_sqlite3,
-                                       index=False,
-                                       if_exists='replace')
+            write_table(twc_timing_info, outDir, 'timing_info', backend=storage_backend)
 
             timing_info = pandas.concat([timing_info, twc_timing_info], ignore_index=True)
 
@@ -242,105 +233,114 @@ def analyse_time_resolution_task(
     ):
     if Linus.task_completed("calculate_time_walk_correction"):
         with Linus.handle_task("analyse_time_resolution", drop_old_data=drop_old_data) as Jorge:
-            with sqlite3.connect(Jorge.get_task_path("calculate_time_walk_correction")/'data.sqlite') as input_sqlite3_connection, \
-                 sqlite3.connect(Jorge.task_path/'time_resolution.sqlite') as output_sqlite3_connection:
-                original_df = pandas.read_sql('SELECT * FROM etroc1_data', input_sqlite3_connection, index_col=None)
-                twc_info_df = pandas.read_sql('SELECT * FROM twc_info', input_sqlite3_connection, index_col=None)
-
-                max_twc_iterations = twc_info_df.iloc[0]['max_twc_iterations']
-                board_list = sorted(original_df['data_board_id'].unique())
-
-                time_filters = {
-                    'Final': Jorge.path_directory/"time_filter.fd",
-                }
-                if Jorge.task_completed("apply_time_cuts"):
+            input_dir = Jorge.get_task_path("calculate_time_walk_correction")
+            storage_backend = find_table_backend(input_dir, "twc_info")  # The results are stored in the same format as the input data
+            twc_info_df = read_table(input_dir, "twc_info")
+
+            max_twc_iterations = twc_info_df.iloc[0]['max_twc_iterations']
+            twc_columns = ["time_of_arrival_twc_iteration_{}".format(iteration) for iteration in range(max_twc_iterations)]
+            data_view = etroc1_data_view(Jorge, ["calculate_times_in_ns", "calculate_time_walk_correction"])
+            original_df = data_view.read(columns=["event", "data_board_id"])
+            event_tensor = data_view.tensor(twc_columns)
+            board_list = sorted(original_df['data_board_id'].unique())
+
+            time_filters = {
+                'Final': Jorge.path_directory/"time_filter.npz",
+            }
+            if Jorge.task_completed("apply_time_cuts"):
+                cutflow_filter_file = Jorge.get_task_path("apply_time_cuts")/"time_filter.npz"
+                if cutflow_filter_file.is_file():
+                    # The filter of each step of the cutflow is made of the cuts up to that step
+                    cutflow_filter = read_filter(cutflow_filter_file)
+                    for step, n_cuts in cutflow_filter.steps().items():
+                        time_filters[step] = cutflow_filter.prefix(n_cuts)
+                else:  # Older runs, with a filter file for each step of the cutflow
                     for dir in (Jorge.get_task_path("apply_time_cuts")/'CutflowPlots').iterdir():
                         time_filters[dir.name] = dir/"time_filter.fd"
 
-                timing_df = calculate_time_resolution_with_time_filters(
-                    Jorge,
-                    script_logger=script_logger,
-                    original_df=original_df,
-                    time_filters=time_filters,
-                    max_twc_iterations=max_twc_iterations,
+            timing_df = calculate_time_resolution_with_time_filters(
+                Jorge,
+                script_logger=script_logger,
+                original_df=original_df,
+                event_tensor=event_tensor,
+                time_filters=time_filters,
+                max_twc_iterations=max_twc_iterations,
+                storage_backend=storage_backend,
+            )
+
+            write_table(timing_df, Jorge.task_path, 'timing_info', backend=storage_backend)
+
+            timing_df["data_board_id_cat"] = timing_df["data_board_id"].astype(str)
+
+            plotDir = Jorge.task_path/'plots'
+            plotDir.mkdir(exist_ok=True)
+            twc_iteration = sorted(timing_df["twc_iteration"].unique())
+            step_order = sorted(timing_df["step_order"].unique())
+
+            for step_id in step_order:
+                tmp_df = timing_df.query('step_order=={}'.format(step_id)).reset_index()
+                tmp_df.sort_values(by=['data_board_id', 'twc_iteration'], inplace=True)
+
+                step_name = tmp_df.at[0, 'step_name']
+                if '-' in step_name:
+                    step_name = str(step_name).split('-')[1]
+
+                outDir = plotDir/'Step-{}-{}'.format(step_id, step_name)
+                outDir.mkdir(exist_ok=True)
+
+                # Convert times from ns into ps
+                tmp_df["time_resolution_new"] = tmp_df["time_resolution_new"]*1000
+                tmp_df["time_resolution_new_unc"] = tmp_df["time_resolution_new_unc"]*1000
+
+                make_2d_line_plot(
+                    data_df=tmp_df,
+                    run_name=Jorge.run_name,
+                    task_name=Jorge.task_name,
+                    base_path=outDir,
+                    plot_title="Time Resolution vs TWC Iteration",
+                    subtitle="Time cut step: {}".format(step_name),
+                    x_var="twc_iteration",
+                    y_var="time_resolution_new",
+                    y_error="time_resolution_new_unc",
+                    file_name="time_resolution_vs_iteration",
+                    color_var="data_board_id_cat",
+                    labels={
+                        'data_board_id_cat': 'Board ID',
+                        'time_resolution_new': 'Time Resolution [ps]',
+                        'twc_iteration': 'TWC Iteration',
+                    },
                 )
 
-                timing_df.to_sql('timing_info',
-                               output_sqlite3_connection,
-                               index=False,
-                               if_exists='replace')
-
-                timing_df["data_board_id_cat"] = timing_df["data_board_id"].astype(str)
-
-                plotDir = Jorge.task_path/'plots'
-                plotDir.mkdir(exist_ok=True)
-                twc_iteration = sorted(timing_df["twc_iteration"].unique())
-                step_order = sorted(timing_df["step_order"].unique())
-
-                for step_id in step_order:
-                    tmp_df = timing_df.query('step_order=={}'.format(step_id)).reset_index()
-                    tmp_df.sort_values(by=['data_board_id', 'twc_iteration'], inplace=True)
-
-                    step_name = tmp_df.at[0, 'step_name']
-                    if '-' in step_name:
-                        step_name = str(step_name).split('-')[1]
-
-                    outDir = plotDir/'Step-{}-{}'.format(step_id, step_name)
-                    outDir.mkdir(exist_ok=True)
-
-                    # Convert times from ns into ps
-                    tmp_df["time_resolution_new"] = tmp_df["time_resolution_new"]*1000
-                    tmp_df["time_resolution_new_unc"] = tmp_df["time_resolution_new_unc"]*1000
-
-                    make_2d_line_plot(
-                        data_df=tmp_df,
-                        run_name=Jorge.run_name,
-                        task_name=Jorge.task_name,
-                        base_path=outDir,
-                        plot_title="Time Resolution vs TWC Iteration",
-                        subtitle="Time cut step: {}".format(step_name),
-                        x_var="twc_iteration",
-                        y_var="time_resolution_new",
-                        y_error="time_resolution_new_unc",
-                        file_name="time_resolution_vs_iteration",
-                        color_var="data_board_id_cat",
-                        labels={
-                            'data_board_id_cat': 'Board ID',
-                            'time_resolution_new': 'Time Resolution [ps]',
-                            'twc_iteration': 'TWC Iteration',
-                        },
-                    )
-
-                for iteration in twc_iteration:
-                    tmp_df = timing_df.query('twc_iteration=={}'.format(iteration)).reset_index()
-                    tmp_df.sort_values(by=['data_board_id', 'step_order'], inplace=True)
-
-                    outDir = plotDir/'Iteration-{}'.format(iteration)
-                    outDir.mkdir(exist_ok=True)
-
-                    # Convert times from ns into ps
-                    tmp_df["time_resolution_new"] = tmp_df["time_resolution_new"]*1000
-                    tmp_df["time_resolution_new_unc"] = tmp_df["time_resolution_new_unc"]*1000
-
-                    make_2d_line_plot(
-                        data_df=tmp_df,
-                        run_name=Jorge.run_name,
-                        task_name=Jorge.task_name,
-                        base_path=outDir,
-                        plot_title="Time Resolution vs Time Cut Step",
-                        subtitle="TWC Iteration: {}".format(iteration),
-                        x_var="step_order",
-                        y_var="time_resolution_new",
-                        y_error="time_resolution_new_unc",
-                        file_name="time_resolution_vs_step",
-                        color_var="data_board_id_cat",
-                        labels={
-                            'data_board_id_cat': 'Board ID',
-                            'time_resolution_new': 'Time Resolution [ps]',
-                            'step_order': 'Cut Sequence',
-                        },
-                        text_var='step_name',
-                    )
+            for iteration in twc_iteration:
+                tmp_df = timing_df.query('twc_iteration=={}'.format(iteration)).reset_index()
+                tmp_df.sort_values(by=['data_board_id', 'step_order'], inplace=True)
+
+                outDir = plotDir/'Iteration-{}'.format(iteration)
+                outDir.mkdir(exist_ok=True)
+
+                # Convert times from ns into ps
+                tmp_df["time_resolution_new"] = tmp_df["time_resolution_new"]*1000
+                tmp_df["time_resolution_new_unc"] = tmp_df["time_resolution_new_unc"]*1000
+
+                make_2d_line_plot(
+                    data_df=tmp_df,
+                    run_name=Jorge.run_name,
+                    task_name=Jorge.task_name,
+                    base_path=outDir,
+                    plot_title="Time Resolution vs Time Cut Step",
+                    subtitle="TWC Iteration: {}".format(iteration),
+                    x_var="step_order",
+                    y_var="time_resolution_new",
+                    y_error="time_resolution_new_unc",
+                    file_name="time_resolution_vs_step",
+                    color_var="data_board_id_cat",
+                    labels={
+                        'data_board_id_cat': 'Board ID',
+                        'time_resolution_new': 'Time Resolution [ps]',
+                        'step_order': 'Cut Sequence',
+                    },
+                    text_var='step_name',
+                )
 
 def script_main(
     output_directory:Path,
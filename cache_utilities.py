@@ -0,0 +1,181 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+
+from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
+                         #   https://docs.python.org/3/library/pathlib.html
+
+import logging
+import os
+import shutil
+import hashlib
+import json
+import sqlite3
+import pandas
+from storage_utilities import sqlite_file_name
+from storage_utilities import sqlite_batch_rows
+from storage_utilities import find_table_backend
+from storage_utilities import table_files
+
+# The results of a task can be saved in a cache directory, shared by any number of runs, under a key
+# which is the hash of everything the task depends on: the task name, its parameters, the files of its
+# input tables, its other input files (e.g. the filters, the cuts files and the script itself) and the
+# source of the modules in `task_cache_modules`, which the cached tasks use for their computations. When a
+# task is run again with a key already in the cache, the saved results are copied into the task directory
+# instead of being computed. Each entry is a directory "<cache>/<task>/<key>" with:
+#  - task: the files of the task directory, except those written by the run manager and the event tensors
+#  - outputs: the files the task writes outside of its directory, e.g. into the run directory
+task_cache_version = 1  # Increase to invalidate all the cached results, e.g. when the format of the results changes
+task_cache_modules = ["utilities.py", "storage_utilities.py", "cut_etroc1_single_run.py", "cache_utilities.py"]
+task_cache_ignore = shutil.ignore_patterns("task_report.txt", "backup.*.py", "*.tensor", "*.sqlite-shm")
+
+def hash_file_into(key_hash, file_path: Path):
+    """
+    Add the name and content of a file to a hash, or a marker if the file
+    does not exist
+    """
+    key_hash.update(file_path.name.encode())
+    if not file_path.is_file():
+        key_hash.update(b"\0missing\0")
+        return
+    with open(file_path, "rb") as file:
+        for data in iter(lambda: file.read(1024*1024), b""):
+            key_hash.update(data)
+
+def hash_table_into(key_hash, data_dir: Path, table: str):
+    """
+    Add the name and content of a table to a hash. The files of the tables
+    stored with the arrow and parquet backends are never modified once
+    written, so their content is hashed directly, while the bytes of the
+    data.sqlite file depend on its whole history (and on the write-ahead log),
+    so for the sqlite backend the rows of the table are hashed instead.
+    """
+    key_hash.update("\0table\0{}\0".format(table).encode())
+    if find_table_backend(data_dir, table) == "sqlite":
+        with sqlite3.connect(data_dir/sqlite_file_name) as sqlite3_connection:
+            for chunk_df in pandas.read_sql('SELECT * FROM "{}"'.format(table), sqlite3_connection, chunksize=sqlite_batch_rows):
+                key_hash.update(json.dumps(list(chunk_df.columns)).encode())
+                key_hash.update(pandas.util.hash_pandas_object(chunk_df, index=False).to_numpy().tobytes())
+    else:
+        for file_path in table_files(data_dir, table):
+            hash_file_into(key_hash, file_path)
+
+def task_cache_key(
+    task_name: str,
+    parameters: dict,
+    input_tables: list[tuple[Path, str]] = [],
+    input_files: list[Path] = [],
+):
+    """
+    Compute the cache key of a task from its parameters, the (data directory,
+    table) tuples of its input tables, its other input files and the source
+    of the shared modules in `task_cache_modules`, so a change in any of
+    them invalidates the cached results. Only the names and contents of the
+    files are used, not their location, so the same inputs give the same key
+    in any run.
+    """
+    key_hash = hashlib.sha256()
+    key_hash.update(json.dumps({"task": task_name, "version": task_cache_version, "parameters": parameters}, sort_keys=True, default=str).encode())
+    for module in task_cache_modules:
+        key_hash.update(b"\0module\0")
+        hash_file_into(key_hash, Path(__file__).resolve().parent/module)
+    for data_dir, table in input_tables:
+        hash_table_into(key_hash, data_dir, table)
+    for file_path in input_files:
+        key_hash.update(b"\0file\0")
+        hash_file_into(key_hash, file_path)
+    return key_hash.hexdigest()
+
+def link_or_copy(source: str, destination: str):
+    """
+    Hard link a file if possible, since the table files are never modified
+    once written, otherwise copy it. The sqlite files (and their write-ahead
+    logs) are modified in place, so they are always copied.
+    """
+    if os.path.lexists(destination):
+        os.unlink(destination)
+    if ".sqlite" not in os.path.basename(source):
+        try:
+            os.link(source, destination)
+            return destination
+        except OSError:  # e.g. the cache is in another file system
+            pass
+    return shutil.copy2(source, destination)
+
+def cached_task_path(cache_dir: Path, task_name: str, key: str):
+    return cache_dir/task_name/key
+
+def restore_cached_task(
+    cache_dir: Path,
+    task_name: str,
+    key: str,
+    task_path: Path,
+    script_logger: logging.Logger,
+    outputs: dict[str, Path] = {},
+):
+    """
+    Copy the results of a task from the cache into its task directory, and
+    the outputs outside of the task directory to their paths in `outputs`.
+    Returns `False` if the key is not in the cache.
+    """
+    entry_path = cached_task_path(cache_dir, task_name, key)
+    if not entry_path.is_dir():
+        return False
+
+    script_logger.info("Reusing the cached results of the task {} ({})".format(task_name, key))
+    shutil.copytree(entry_path/"task", task_path, copy_function=link_or_copy, dirs_exist_ok=True)
+    for name, file_path in outputs.items():
+        if (entry_path/"outputs"/name).is_file():
+            link_or_copy(str(entry_path/"outputs"/name), str(file_path))
+    return True
+
+def store_cached_task(
+    cache_dir: Path,
+    task_name: str,
+    key: str,
+    task_path: Path,
+    script_logger: logging.Logger,
+    outputs: dict[str, Path] = {},
+):
+    """
+    Save the results of a task in the cache, i.e. the files of its task
+    directory and the files in `outputs`. The entry is written with a hidden
+    name and renamed once complete, so an incomplete entry is never used.
+    """
+    entry_path = cached_task_path(cache_dir, task_name, key)
+    if entry_path.is_dir():
+        return
+
+    script_logger.info("Saving the results of the task {} in the cache ({})".format(task_name, key))
+    temporary_path = entry_path.parent/("." + key)
+    if temporary_path.is_dir():
+        shutil.rmtree(temporary_path)
+    shutil.copytree(task_path, temporary_path/"task", ignore=task_cache_ignore, copy_function=link_or_copy)
+    (temporary_path/"outputs").mkdir()
+    for name, file_path in outputs.items():
+        if file_path.is_file():
+            link_or_copy(str(file_path), str(temporary_path/"outputs"/name))
+
+    try:
+        temporary_path.rename(entry_path)
+    except OSError:  # The same results were saved in the meantime, e.g. by another run
+        shutil.rmtree(temporary_path)
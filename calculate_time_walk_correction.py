@@ -28,12 +28,19 @@ import lip_pps_run_manager as RM
 import logging
 import pandas
 import numpy
-import sqlite3
 
 from utilities import filter_dataframe
 from utilities import make_multi_scatter_plot
 from utilities import make_time_correlation_plot
 from utilities import make_board_scatter_with_fit_plot
+from utilities import etroc1_data_view
+from utilities import etroc1_derived_table
+from storage_utilities import EventTensor
+from storage_utilities import write_table
+from storage_utilities import find_table_backend
+from cache_utilities import task_cache_key
+from cache_utilities import restore_cached_task
+from cache_utilities import store_cached_task
 
 import scipy.odr
 import plotly.express as px
@@ -45,38 +52,38 @@ def calculate_delta_toa(
     board_list:list[int],
     original_df:pandas.DataFrame,
     data_df:pandas.DataFrame,
-    pivot_df:pandas.DataFrame,
+    event_tensor:EventTensor,
+    hit_index:tuple[numpy.ndarray, numpy.ndarray],
     ):
     delta_column = "delta_toa_to_reference_iteration_{}".format(iteration)
+    delta_layer = numpy.full(event_tensor.hits.shape, numpy.nan)
     if iteration > 0:
         delta_column_twc = "delta_toa_to_reference_iteration_{}_twc".format(iteration - 1)
+        delta_layer_twc = numpy.full(event_tensor.hits.shape, numpy.nan)
+
+    if iteration == 0:
+        time_column = "time_of_arrival_ns"
+    else:
+        time_column = "time_of_arrival_twc_iteration_{}".format(iteration-1)
+        if iteration == 1:
+            prev_time_column = "time_of_arrival_ns"
+        else:
+            prev_time_column = "time_of_arrival_twc_iteration_{}".format(iteration-2)
+
     for board_id in board_list:
-        delta_board_column = (delta_column, board_id)
-        if iteration > 0:
-            delta_board_column_twc = (delta_column_twc, board_id)
-            prev_columns_to_sum = []
-
-        columns_to_sum = []
-        for other_board in board_list:
-            if other_board == board_id:
-                continue
-            if iteration == 0:
-                columns_to_sum += [("time_of_arrival_ns", other_board)]
-            else:
-                columns_to_sum += [("time_of_arrival_twc_iteration_{}".format(iteration-1), other_board)]
-
-                if iteration == 1:
-                    prev_columns_to_sum += [("time_of_arrival_ns", other_board)]
-                else:
-                    prev_columns_to_sum += [("time_of_arrival_twc_iteration_{}".format(iteration-2), other_board)]
+        board_idx = event_tensor.board_index(board_id)
+        other_boards_idx = [event_tensor.board_index(other_board) for other_board in board_list if other_board != board_id]
 
+        # The missing boards are left out of the sums, like when summing the columns of a dataframe
         if iteration > 0:
-            pivot_df[delta_board_column_twc] = pivot_df[prev_columns_to_sum].sum(axis=1)/(len(board_list) - 1) - pivot_df[("time_of_arrival_twc_iteration_{}".format(iteration-1), board_id)]
-        pivot_df[delta_board_column] = pivot_df[columns_to_sum].sum(axis=1)/(len(board_list) - 1) - pivot_df[("time_of_arrival_ns", board_id)]
+            delta_layer_twc[:, board_idx] = numpy.nansum(event_tensor[prev_time_column][:, other_boards_idx], axis=1)/(len(board_list) - 1) - event_tensor[time_column][:, board_idx]
+        delta_layer[:, board_idx] = numpy.nansum(event_tensor[time_column][:, other_boards_idx], axis=1)/(len(board_list) - 1) - event_tensor["time_of_arrival_ns"][:, board_idx]
     if iteration > 0:
-        data_df[delta_column_twc] = pivot_df.stack()[delta_column_twc]
+        event_tensor[delta_column_twc] = delta_layer_twc
+        data_df[delta_column_twc] = delta_layer_twc[hit_index]
         original_df[delta_column_twc] = data_df[delta_column_twc]
-    data_df[delta_column] = pivot_df.stack()[delta_column]
+    event_tensor[delta_column] = delta_layer
+    data_df[delta_column] = delta_layer[hit_index]
     original_df[delta_column] = data_df[delta_column]
 
 def fit_poly(
@@ -103,7 +110,7 @@ def fit_and_plot_twc(
     iteration:int,
     board_list:list[int],
     data_df:pandas.DataFrame,
-    pivot_df:pandas.DataFrame,
+    event_tensor:EventTensor,
     poly_order:int = 2,
     full_html: bool = False,  # For saving a html containing only a div with the plot
     extra_title: str = ""
@@ -125,11 +132,11 @@ def fit_and_plot_twc(
     delta_column = "delta_toa_to_reference_iteration_{}".format(iteration)
     delta_twc_column = "delta_toa_to_reference_iteration_{}_twc".format(iteration - 1)
     for board_id in board_list:
-        accepted = pivot_df[("accepted", board_id)]
-        x_column = pivot_df.loc[accepted][("time_over_threshold_ns", board_id)].astype(float)
+        accepted = event_tensor[("accepted", board_id)]
+        x_column = event_tensor[("time_over_threshold_ns", board_id)].loc[accepted].astype(float)
 
         if iteration > 0:
-            y_column = pivot_df.loc[accepted][(delta_twc_column, board_id)].astype(float)
+            y_column = event_tensor[(delta_twc_column, board_id)].loc[accepted].astype(float)
 
             # Save fit results for storing in dataframe later
             poly, dict1 = fit_poly(poly_order, x_column, y_column)
@@ -139,7 +146,7 @@ def fit_and_plot_twc(
             row_list.append(dict1)
 
             make_board_scatter_with_fit_plot(
-                data_df = pivot_df,
+                event_tensor = event_tensor,
                 base_path = previous_iteration_path,
                 run_name = Carl.run_name,
                 board_id = board_id,
@@ -154,7 +161,7 @@ def fit_and_plot_twc(
                 extra_title = extra_title,
             )
 
-        y_column = pivot_df.loc[accepted][(delta_column, board_id)].astype(float)
+        y_column = event_tensor[(delta_column, board_id)].loc[accepted].astype(float)
 
         # Save fit results for storing in dataframe later
         poly, dict1 = fit_poly(poly_order, x_column, y_column)
@@ -164,7 +171,7 @@ def fit_and_plot_twc(
         row_list.append(dict1)
 
         make_board_scatter_with_fit_plot(
-            data_df = pivot_df,
+            event_tensor = event_tensor,
             base_path = iteration_path,
             run_name = Carl.run_name,
             board_id = board_id,
@@ -203,10 +210,9 @@ def fit_and_plot_twc(
         use_base_dimensions=False,
     )
 
-    tmp_pivot_df = pivot_df.copy()
-    tmp_pivot_df.columns = ["{}_{}".format(x, y) for x, y in tmp_pivot_df.columns]
+    tensor_df = event_tensor.to_frame()
     make_time_correlation_plot(
-        data_df=tmp_pivot_df.loc[tmp_pivot_df['accepted_{}'.format(board_id)]],
+        data_df=tensor_df.loc[tensor_df['accepted_{}'.format(board_id)]],
         base_path=iteration_path,
         run_name=Carl.run_name,
         board_ids=board_list,
@@ -225,21 +231,22 @@ def apply_twc(
     board_list:list[int],
     original_df:pandas.DataFrame,
     data_df:pandas.DataFrame,
-    pivot_df:pandas.DataFrame,
+    event_tensor:EventTensor,
+    hit_index:tuple[numpy.ndarray, numpy.ndarray],
     fit_df:pandas.DataFrame,
     ):
     fit_info_df = fit_df.query('twc_applied==False').drop(['twc_applied'], axis=1).set_index(['twc_iteration','board_id'])
     toa_column = "time_of_arrival_ns"
     tot_column = "time_over_threshold_ns"
     twc_column = "time_of_arrival_twc_iteration_{}".format(iteration)
+    twc_layer = numpy.full(event_tensor.hits.shape, numpy.nan)
     for board_id in board_list:
-        toa_board_column = (toa_column, board_id)
-        tot_board_column = (tot_column, board_id)
-        twc_board_column = (twc_column, board_id)
+        board_idx = event_tensor.board_index(board_id)
         poly = numpy.poly1d(fit_info_df.loc[(iteration,board_id)][::-1])
 
-        pivot_df[twc_board_column] = pivot_df[toa_board_column] + poly(pivot_df[tot_board_column])
-    data_df[twc_column] = pivot_df.stack()[twc_column]
+        twc_layer[:, board_idx] = event_tensor[toa_column][:, board_idx] + poly(event_tensor[tot_column][:, board_idx])
+    event_tensor[twc_column] = twc_layer
+    data_df[twc_column] = twc_layer[hit_index]
     original_df[twc_column] = data_df[twc_column]
 
 def calculate_time_walk_correction_task(
@@ -248,69 +255,86 @@ def calculate_time_walk_correction_task(
     drop_old_data:bool=True,
     iterations:int=1,
     poly_order:int=2,
+    cache_dir:Path=None,
     ):
     if Homer.task_completed("apply_time_cuts"):
         with Homer.handle_task("calculate_time_walk_correction", drop_old_data=drop_old_data) as Carl:
-            with sqlite3.connect(Carl.get_task_path("calculate_times_in_ns")/'data.sqlite') as input_sqlite3_connection, \
-                 sqlite3.connect(Carl.task_path/'data.sqlite') as output_sqlite3_connection:
-                original_df = pandas.read_sql('SELECT * FROM etroc1_data', input_sqlite3_connection, index_col=None)
-                board_list = sorted(original_df['data_board_id'].unique())
-
-                data_df = filter_dataframe(
-                    df=original_df,
-                    filter_files={
-                        "event": Carl.path_directory/"event_filter.fd",
-                        "time": Carl.path_directory/"time_filter.fd",
-                    },
-                    script_logger=script_logger,
+            storage_backend = find_table_backend(Carl.path_directory/"data", "etroc1_data")  # The derived data is stored in the same format as the input data
+            data_view = etroc1_data_view(Carl, ["calculate_times_in_ns"])
+
+            cache_key = None
+            if cache_dir is not None:
+                cache_key = task_cache_key(
+                    "calculate_time_walk_correction",
+                    {"iterations": iterations, "poly_order": poly_order},
+                    input_tables=data_view.tables(),
+                    input_files=[
+                        Carl.path_directory/"event_filter.npz",
+                        Carl.path_directory/"event_filter.fd",
+                        Carl.path_directory/"time_filter.npz",
+                        Carl.path_directory/"time_filter.fd",
+                        Path(__file__),
+                    ],
                 )
+                if restore_cached_task(cache_dir, "calculate_time_walk_correction", cache_key, Carl.task_path, script_logger):
+                    return
+
+            original_df = data_view.read(columns=["event", "data_board_id", "time_of_arrival_ns", "time_over_threshold_ns"])
+            board_list = sorted(original_df['data_board_id'].unique())
+
+            data_df = filter_dataframe(
+                df=original_df,
+                filter_files={
+                    "event": Carl.path_directory/"event_filter.npz",
+                    "time": Carl.path_directory/"time_filter.npz",
+                },
+                script_logger=script_logger,
+            )
 
-                pivot_df = data_df.pivot(
-                    index = 'event',
-                    columns = 'data_board_id',
-                    values = list(set(data_df.columns) - {'data_board_id', 'event'}),
-                )
+            # The hits of each event side by side, with a column per board
+            event_tensor = data_view.tensor(["time_of_arrival_ns", "time_over_threshold_ns"])
+            hit_index = event_tensor.locate(data_df["event"].to_numpy(), data_df["data_board_id"].to_numpy())
+            accepted_layer = numpy.zeros(event_tensor.hits.shape, dtype=bool)
+            accepted_layer[hit_index] = (data_df["accepted"] == True).to_numpy()
+            event_tensor["accepted"] = accepted_layer
+
+            data_df["data_board_id_cat"] = data_df["data_board_id"].astype(str)
+            original_df.set_index(["event", "data_board_id"], inplace=True)
+            data_df.set_index(["event", "data_board_id"], inplace=True)
+
+            full_fit_df: pandas.DataFrame = None
+            for iteration in range(iterations):
+                calculate_delta_toa(iteration, board_list, original_df, data_df, event_tensor, hit_index)
+                fit_df = fit_and_plot_twc(Carl, iteration, board_list, data_df, event_tensor, poly_order=poly_order)
+                apply_twc(iteration, board_list, original_df, data_df, event_tensor, hit_index, fit_df)
+
+                if full_fit_df is None:
+                    full_fit_df = fit_df
+                else:
+                    full_fit_df = full_fit_df.append(fit_df)
+            calculate_delta_toa(iterations, board_list, original_df, data_df, event_tensor, hit_index)
+            fit_df = fit_and_plot_twc(Carl, iterations, board_list, data_df, event_tensor, poly_order=poly_order)
+            full_fit_df = full_fit_df.append(fit_df).query("twc_iteration < {}".format(iterations)).reset_index(drop=True)
 
-                data_df["data_board_id_cat"] = data_df["data_board_id"].astype(str)
-                original_df.set_index(["event", "data_board_id"], inplace=True)
-                data_df.set_index(["event", "data_board_id"], inplace=True)
-
-                full_fit_df: pandas.DataFrame = None
-                for iteration in range(iterations):
-                    calculate_delta_toa(iteration, board_list, original_df, data_df, pivot_df)
-                    fit_df = fit_and_plot_twc(Carl, iteration, board_list, data_df, pivot_df, poly_order=poly_order)
-                    apply_twc(iteration, board_list, original_df, data_df, pivot_df, fit_df)
-
-                    if full_fit_df is None:
-                        full_fit_df = fit_df
-                    else:
-                        full_fit_df = full_fit_df.append(fit_df)
-                calculate_delta_toa(iterations, board_list, original_df, data_df, pivot_df)
-                fit_df = fit_and_plot_twc(Carl, iterations, board_list, data_df, pivot_df, poly_order=poly_order)
-                full_fit_df = full_fit_df.append(fit_df).query("twc_iteration < {}".format(iterations)).reset_index(drop=True)
-
-                original_df.reset_index(inplace=True)
-
-                twc_df = pandas.DataFrame([{'max_twc_iterations': iterations}], columns=['max_twc_iterations'])
-
-                original_df.to_sql('etroc1_data',
-                               output_sqlite3_connection,
-                               index=False,
-                               if_exists='replace')
-                full_fit_df.to_sql('twc_fit_info',
-                               output_sqlite3_connection,
-                               index=False,
-                               if_exists='replace')
-                twc_df.to_sql('twc_info',
-                               output_sqlite3_connection,
-                               index=False,
-                               if_exists='replace')
+            original_df.reset_index(inplace=True)
+
+            twc_df = pandas.DataFrame([{'max_twc_iterations': iterations}], columns=['max_twc_iterations'])
+
+            # Only the derived columns are saved, they are joined with the original data when read
+            original_df.drop(labels=["time_of_arrival_ns", "time_over_threshold_ns"], axis=1, inplace=True)
+            write_table(original_df, Carl.task_path, etroc1_derived_table, backend=storage_backend)
+            write_table(full_fit_df, Carl.task_path, 'twc_fit_info', backend=storage_backend)
+            write_table(twc_df, Carl.task_path, 'twc_info', backend=storage_backend)
+
+            if cache_key is not None:
+                store_cached_task(cache_dir, "calculate_time_walk_correction", cache_key, Carl.task_path, script_logger)
 
 def script_main(
     output_directory:Path,
     make_plots:bool=True,
     iterations:int=1,
     poly_order:int=2,
+    cache_dir:Path=None,
     ):
 
     script_logger = logging.getLogger('calculate_twc')
@@ -321,7 +345,7 @@ def script_main(
         if not Homer.task_completed("apply_time_cuts"):
             raise RuntimeError("You can only run this script after applying  time cuts")
 
-        calculate_time_walk_correction_task(Homer, script_logger=script_logger, iterations=iterations, poly_order=poly_order)
+        calculate_time_walk_correction_task(Homer, script_logger=script_logger, iterations=iterations, poly_order=poly_order, cache_dir=cache_dir)
 
 if __name__ == '__main__':
     import argparse
@@ -368,6 +392,14 @@ if __name__ == '__main__':
         dest = 'order',
         type = int,
     )
+    parser.add_argument(
+        '--cache-dir',
+        metavar = 'path',
+        help = 'If set, the results of the task are saved in this directory, which can be shared by several runs, and reused whenever the task is run again with the same input data, cuts and parameters',
+        default = None,
+        dest = 'cache_dir',
+        type = str,
+    )
 
     args = parser.parse_args()
 
@@ -387,4 +419,8 @@ if __name__ == '__main__':
         elif args.log_level == "NOTSET":
             logging.basicConfig(level=0)
 
-    script_main(Path(args.out_directory), iterations=args.iterations, poly_order=args.order)
\ No newline at end of file
+    cache_dir = None
+    if args.cache_dir is not None:
+        cache_dir = Path(args.cache_dir)
+
+    script_main(Path(args.out_directory), iterations=args.iterations, poly_order=args.order, cache_dir=cache_dir)
\ No newline at end of file
@@ -28,9 +28,17 @@ import lip_pps_run_manager as RM
 import logging
 import pandas
 import numpy
-import sqlite3
 
 from utilities import plot_times_in_ns_task
+from utilities import etroc1_data_view
+from utilities import etroc1_derived_table
+from storage_utilities import read_table
+from storage_utilities import write_table
+from storage_utilities import find_table_backend
+from storage_utilities import read_filter
+from cache_utilities import task_cache_key
+from cache_utilities import restore_cached_task
+from cache_utilities import store_cached_task
 
 
 def calculate_times_in_ns_task(
@@ -38,63 +46,70 @@ def calculate_times_in_ns_task(
     script_logger: logging.Logger,
     drop_old_data:bool=True,
     fbin_choice:str="mean",
+    cache_dir:Path=None,
     ):
     if Fermat.task_completed("apply_event_cuts"):
         with Fermat.handle_task("calculate_times_in_ns", drop_old_data=drop_old_data) as Einstein:
-            with sqlite3.connect(Einstein.path_directory/"data"/'data.sqlite') as input_sqlite3_connection, \
-                 sqlite3.connect(Einstein.task_path/'data.sqlite') as output_sqlite3_connection:
-                data_df = pandas.read_sql('SELECT * FROM etroc1_data', input_sqlite3_connection, index_col=None)
-
-                filter_df = pandas.read_feather(Einstein.path_directory/"event_filter.fd")
-                filter_df.set_index("event", inplace=True)
-
-                from cut_etroc1_single_run import apply_event_filter
-                data_df = apply_event_filter(data_df, filter_df)
-                accepted_data_df = data_df.loc[data_df['accepted']==True]
-                board_grouped_accepted_data_df = accepted_data_df.groupby(['data_board_id'])
-
-                board_info_df = board_grouped_accepted_data_df[['calibration_code']].mean()
-                board_info_df.rename(columns = {'calibration_code':'calibration_code_mean'}, inplace = True)
-                board_info_df['calibration_code_median'] = board_grouped_accepted_data_df[['calibration_code']].median()
-                board_info_df['fbin_mean'] = 3.125/board_info_df['calibration_code_mean']
-                board_info_df['fbin_median'] = 3.125/board_info_df['calibration_code_median']
-
-                #accepted_data_df.set_index("data_board_id", inplace=True)
-                #accepted_data_df["fbin"] = board_info_df['fbin_mean']
-                #accepted_data_df.reset_index(inplace=True)
-
-                #accepted_data_df["time_of_arrival_ns"] = 12.5 - accepted_data_df['time_of_arrival']*accepted_data_df['fbin']
-                #accepted_data_df["time_over_threshold_ns"] = (accepted_data_df["time_over_threshold"]*2 - (accepted_data_df["time_over_threshold"]/32.).apply(numpy.floor))*accepted_data_df['fbin']
-
-                data_df.set_index("data_board_id", inplace=True)
-                if fbin_choice == "mean":
-                    data_df["fbin"] = board_info_df['fbin_mean']
-                elif fbin_choice == "median":
-                    data_df["fbin"] = board_info_df['fbin_median']
-                elif fbin_choice == "event":
-                    data_df["fbin"] = 3.125/data_df['calibration_code']
-                data_df.reset_index(inplace=True)
-
-                data_df["time_of_arrival_ns"] = 12.5 - data_df['time_of_arrival']*data_df['fbin']
-                data_df["time_over_threshold_ns"] = (data_df["time_over_threshold"]*2 - (data_df["time_over_threshold"]/32.).apply(numpy.floor))*data_df['fbin']
-
-                board_info_df.to_sql('board_info_data',
-                                     output_sqlite3_connection,
-                                     #index=False,
-                                     if_exists='replace')
-
-                data_df.drop(labels=['accepted', 'event_filter'], axis=1, inplace=True)
-
-                data_df.to_sql('etroc1_data',
-                               output_sqlite3_connection,
-                               index=False,
-                               if_exists='replace')
+            input_dir = Einstein.path_directory/"data"
+
+            cache_key = None
+            if cache_dir is not None:
+                cache_key = task_cache_key(
+                    "calculate_times_in_ns",
+                    {"fbin_choice": fbin_choice},
+                    input_tables=[(input_dir, "etroc1_data")],
+                    input_files=[Einstein.path_directory/"event_filter.npz", Einstein.path_directory/"event_filter.fd", Path(__file__)],
+                )
+                if restore_cached_task(cache_dir, "calculate_times_in_ns", cache_key, Einstein.task_path, script_logger):
+                    return
+
+            storage_backend = find_table_backend(input_dir, "etroc1_data")  # The derived data is stored in the same format as the input data
+            data_df = read_table(input_dir, "etroc1_data", columns=["event", "data_board_id", "calibration_code", "time_of_arrival", "time_over_threshold"])
+
+            from cut_etroc1_single_run import apply_event_filter
+            data_df = apply_event_filter(data_df, read_filter(Einstein.path_directory/"event_filter.npz"))
+            accepted_data_df = data_df.loc[data_df['accepted']==True]
+            board_grouped_accepted_data_df = accepted_data_df.groupby(['data_board_id'])
+
+            board_info_df = board_grouped_accepted_data_df[['calibration_code']].mean()
+            board_info_df.rename(columns = {'calibration_code':'calibration_code_mean'}, inplace = True)
+            board_info_df['calibration_code_median'] = board_grouped_accepted_data_df[['calibration_code']].median()
+            board_info_df['fbin_mean'] = 3.125/board_info_df['calibration_code_mean']
+            board_info_df['fbin_median'] = 3.125/board_info_df['calibration_code_median']
+
+            #accepted_data_df.set_index("data_board_id", inplace=True)
+            #accepted_data_df["fbin"] = board_info_df['fbin_mean']
+            #accepted_data_df.reset_index(inplace=True)
+
+            #accepted_data_df["time_of_arrival_ns"] = 12.5 - accepted_data_df['time_of_arrival']*accepted_data_df['fbin']
+            #accepted_data_df["time_over_threshold_ns"] = (accepted_data_df["time_over_threshold"]*2 - (accepted_data_df["time_over_threshold"]/32.).apply(numpy.floor))*accepted_data_df['fbin']
+
+            data_df.set_index("data_board_id", inplace=True)
+            if fbin_choice == "mean":
+                data_df["fbin"] = board_info_df['fbin_mean']
+            elif fbin_choice == "median":
+                data_df["fbin"] = board_info_df['fbin_median']
+            elif fbin_choice == "event":
+                data_df["fbin"] = 3.125/data_df['calibration_code']
+            data_df.reset_index(inplace=True)
+
+            data_df["time_of_arrival_ns"] = 12.5 - data_df['time_of_arrival']*data_df['fbin']
+            data_df["time_over_threshold_ns"] = (data_df["time_over_threshold"]*2 - (data_df["time_over_threshold"]/32.).apply(numpy.floor))*data_df['fbin']
+
+            write_table(board_info_df, Einstein.task_path, 'board_info_data', backend=storage_backend, index=True)
+
+            # Only the derived columns are saved, they are joined with the original data when read
+            write_table(data_df[["event", "data_board_id", "fbin", "time_of_arrival_ns", "time_over_threshold_ns"]], Einstein.task_path, etroc1_derived_table, backend=storage_backend)
+
+            if cache_key is not None:
+                store_cached_task(cache_dir, "calculate_times_in_ns", cache_key, Einstein.task_path, script_logger)
 
 def script_main(
     output_directory:Path,
     make_plots:bool=True,
     max_toa:float=0,
     max_tot:float=0,
+    cache_dir:Path=None,
     ):
 
     script_logger = logging.getLogger('apply_event_cuts')
@@ -110,14 +125,14 @@ def script_main(
         if not Fermat.task_completed("apply_event_cuts"):
             raise RuntimeError("You can only run this script after applying event cuts")
 
-        calculate_times_in_ns_task(Fermat, script_logger=script_logger)
+        calculate_times_in_ns_task(Fermat, script_logger=script_logger, cache_dir=cache_dir)
 
         if make_plots:
             plot_times_in_ns_task(
                 Fermat,
                 script_logger=script_logger,
                 task_name="plot_times_in_ns_before_cuts",
-                data_file=Fermat.get_task_path("calculate_times_in_ns")/'data.sqlite',
+                data_view=etroc1_data_view(Fermat, ["calculate_times_in_ns"]),
                 filter_files={},
                 max_toa=max_toa,
                 max_tot=max_tot,
@@ -129,8 +144,8 @@ def script_main(
                 Fermat,
                 script_logger=script_logger,
                 task_name="plot_times_in_ns_after_cuts",
-                data_file=Fermat.get_task_path("calculate_times_in_ns")/'data.sqlite',
-                filter_files={"event": Fermat.path_directory/"event_filter.fd"},
+                data_view=etroc1_data_view(Fermat, ["calculate_times_in_ns"]),
+                filter_files={"event": Fermat.path_directory/"event_filter.npz"},
                 max_toa=max_toa,
                 max_tot=max_tot,
                 min_toa=0,
@@ -182,6 +197,14 @@ if __name__ == '__main__':
         dest = 'max_tot',
         type = float,
     )
+    parser.add_argument(
+        '--cache-dir',
+        metavar = 'path',
+        help = 'If set, the results of the task are saved in this directory, which can be shared by several runs, and reused whenever the task is run again with the same input data, cuts and parameters',
+        default = None,
+        dest = 'cache_dir',
+        type = str,
+    )
 
     args = parser.parse_args()
 
@@ -201,4 +224,8 @@ if __name__ == '__main__':
         elif args.log_level == "NOTSET":
             logging.basicConfig(level=0)
 
-    script_main(Path(args.out_directory), max_toa=args.max_toa, max_tot=args.max_tot)
\ No newline at end of file
+    cache_dir = None
+    if args.cache_dir is not None:
+        cache_dir = Path(args.cache_dir)
+
+    script_main(Path(args.out_directory), max_toa=args.max_toa, max_tot=args.max_tot, cache_dir=cache_dir)
\ No newline at end of file
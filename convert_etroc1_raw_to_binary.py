@@ -0,0 +1,184 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
+                         #   https://docs.python.org/3/library/pathlib.html
+
+import logging
+
+from ingest_utilities import raw_data_formats
+from ingest_utilities import detect_raw_data_format
+from ingest_utilities import iterate_etroc1_raw_data
+from ingest_utilities import etroc1_records_from_dataframe
+from ingest_utilities import write_etroc1_binary_header
+from ingest_utilities import strip_compression_suffix
+
+def convert_etroc1_raw_to_binary(
+    input_file: Path,
+    output_file: Path,
+    script_logger: logging.Logger,
+    layout: str,
+    ignore_rows:int=0,
+    parser:str="pandas",
+    chunk_size:int=1000000,
+):
+    if layout not in raw_data_formats:
+        raise RuntimeError("Unknown raw data layout: {}".format(layout))
+    columns = raw_data_formats[layout]["columns"]
+
+    records = 0
+    with open(output_file, "wb") as out_file:
+        # Write a placeholder header, which is updated with the number of records at the end
+        write_etroc1_binary_header(out_file, records, layout)
+
+        for df in iterate_etroc1_raw_data(input_file, columns, script_logger, parser=parser, skip_rows=ignore_rows, chunk_size=chunk_size):
+            out_file.write(etroc1_records_from_dataframe(df).tobytes())
+            records += len(df)
+
+        out_file.seek(0)
+        write_etroc1_binary_header(out_file, records, layout)
+
+    script_logger.info("Converted {} records from {} into {}".format(records, input_file, output_file))
+
+def script_main(
+        input_file:Path,
+        output_file:Path,
+        layout:str=None,
+        ignore_rows:int=None,
+        parser:str="pandas",
+        ):
+
+    script_logger = logging.getLogger('convert_raw')
+
+    if not input_file.is_file():
+        script_logger.info("The input file should be an existing file")
+        return
+
+    uncompressed_name = strip_compression_suffix(input_file)
+
+    if layout is None:  # Detect the layout from the content, falling back to the extension: the txt summaries come from the beam runs, all others are dat files from charge injection
+        layout = detect_raw_data_format(input_file)
+        if layout is None:
+            if uncompressed_name.suffix == ".txt":
+                layout = "txt"
+            else:
+                layout = "dat"
+            script_logger.warning("Could not detect the layout of the raw data file, assuming it is a {} file".format(layout))
+
+    if ignore_rows is None:  # The txt summaries have a header line
+        ignore_rows = raw_data_formats[layout]["skip_rows"]
+
+    if output_file is None:
+        output_file = uncompressed_name.with_suffix(".bin")
+
+    if output_file.resolve() == input_file.resolve():
+        raise RuntimeError("The output file can not be the same as the input file")
+
+    convert_etroc1_raw_to_binary(
+        input_file,
+        output_file,
+        script_logger=script_logger,
+        layout=layout,
+        ignore_rows=ignore_rows,
+        parser=parser,
+    )
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Converts a raw data file (txt or dat) taken with the KC 705 FPGA development board connected to an ETROC1 into a compact binary file, which can be read directly by the processing scripts')
+    parser.add_argument(
+        '--file',
+        metavar = 'path',
+        help = 'Path to the raw data file to convert.',
+        required = True,
+        dest = 'file',
+        type = str,
+    )
+    parser.add_argument(
+        '--out-file',
+        metavar = 'path',
+        help = 'Path to the output binary file. Default: the input file with the .bin extension',
+        default = None,
+        dest = 'out_file',
+        type = str,
+    )
+    parser.add_argument(
+        '-l',
+        '--log-level',
+        help = 'Set the logging level. Default: WARNING',
+        choices = ["CRITICAL","ERROR","WARNING","INFO","DEBUG","NOTSET"],
+        default = "WARNING",
+        dest = 'log_level',
+    )
+    parser.add_argument(
+        '--log-file',
+        help = 'If set, the full log will be saved to a file (i.e. the log level is ignored)',
+        action = 'store_true',
+        dest = 'log_file',
+    )
+    parser.add_argument(
+        '--layout',
+        help = "The layout of the raw data file: txt (beam summary with date and time) or dat (charge injection). Default: detected from the file content",
+        choices = list(raw_data_formats),
+        default = None,
+        dest = 'layout',
+    )
+    parser.add_argument(
+        '--ignore-rows',
+        metavar = 'int',
+        help = "Number of rows to ignore at the start of the raw data file. Default: 1 for the txt layout, 0 for the dat layout",
+        default = None,
+        dest = 'ignore_rows',
+        type = int,
+    )
+    parser.add_argument(
+        '--parser',
+        help = "The backend used to parse the raw data file. The pyarrow backend is multithreaded but requires the columns to be separated by a single space. Default: pandas",
+        choices = ["pandas", "pyarrow"],
+        default = "pandas",
+        dest = 'parser',
+    )
+
+    args = parser.parse_args()
+
+    if args.log_file:
+        logging.basicConfig(filename='logging.log', filemode='w', encoding='utf-8', level=logging.NOTSET)
+    else:
+        if args.log_level == "CRITICAL":
+            logging.basicConfig(level=50)
+        elif args.log_level == "ERROR":
+            logging.basicConfig(level=40)
+        elif args.log_level == "WARNING":
+            logging.basicConfig(level=30)
+        elif args.log_level == "INFO":
+            logging.basicConfig(level=20)
+        elif args.log_level == "DEBUG":
+            logging.basicConfig(level=10)
+        elif args.log_level == "NOTSET":
+            logging.basicConfig(level=0)
+
+    out_file = None
+    if args.out_file is not None:
+        out_file = Path(args.out_file)
+
+    script_main(Path(args.file), out_file, layout=args.layout, ignore_rows=args.ignore_rows, parser=args.parser)
@@ -29,11 +29,16 @@ import logging
 import shutil
 import pandas
 import numpy as np
-import sqlite3
 
 from utilities import plot_etroc1_task
 from utilities import build_plots
 from utilities import apply_event_filter
+from utilities import etroc1_plot_columns
+from storage_utilities import read_table
+from storage_utilities import TableView
+from storage_utilities import EventTensor
+from storage_utilities import CutflowFilter
+from storage_utilities import write_filter
 
 
 def apply_numeric_comparison_to_column(
@@ -58,7 +63,7 @@ def apply_numeric_comparison_to_column(
         raise RuntimeError("Unknown cut direction for {}: {}".format(callee_info, cut_direction))
 
 def data_df_apply_single_cut(
-    data_df: pandas.DataFrame,
+    event_tensor: EventTensor,
     board_id:int,
     variable:str,
     cut_type:str,
@@ -66,15 +71,15 @@ def data_df_apply_single_cut(
     keep_nan:bool=False,
     ):
     if keep_nan:
-        extra_rows_to_keep = data_df[(variable, board_id)].isna()
+        extra_rows_to_keep = event_tensor[(variable, board_id)].isna()
     else:
         extra_rows_to_keep = False
 
-    return (apply_numeric_comparison_to_column(data_df[(variable, board_id)], cut_type, cut_value, "single cut") | extra_rows_to_keep)
+    return (apply_numeric_comparison_to_column(event_tensor[(variable, board_id)], cut_type, cut_value, "single cut") | extra_rows_to_keep)
 
 def df_apply_cut(
     df: pandas.DataFrame,
-    data_df: pandas.DataFrame,
+    event_tensor: EventTensor,
     board_id:str,
     variable:str,
     cut_type:str,
@@ -82,12 +87,12 @@ def df_apply_cut(
     keep_nan:bool=False,
     ):
     if board_id != "*" and board_id != "#":
-        df['accepted'] &= data_df_apply_single_cut(data_df, int(board_id), variable, cut_type, cut_value, keep_nan=keep_nan)
+        df['accepted'] &= data_df_apply_single_cut(event_tensor, int(board_id), variable, cut_type, cut_value, keep_nan=keep_nan)
     else:
         full_cut = None
-        board_ids = data_df.stack().reset_index(level="data_board_id")["data_board_id"].unique()
+        board_ids = event_tensor.boards_with_hits()
         for this_board_id in board_ids:
-            cut = data_df_apply_single_cut(data_df, int(this_board_id), variable, cut_type, cut_value, keep_nan=keep_nan)
+            cut = data_df_apply_single_cut(event_tensor, int(this_board_id), variable, cut_type, cut_value, keep_nan=keep_nan)
             if full_cut is None:
                 full_cut = cut
             else:
@@ -101,8 +106,22 @@ def df_apply_cut(
 
     return df
 
+def event_cuts_columns(
+    cuts_df: pandas.DataFrame,
+    ):
+    """
+    Returns the columns of the data which are needed besides the event tensor
+    to apply the cuts of `cuts_df`, i.e. the columns of the partial cut plots
+    if any cut has an output defined
+    """
+    columns = ["event", "data_board_id"]
+    if "output" in cuts_df and cuts_df["output"].apply(lambda output: isinstance(output, str)).any():
+        columns += etroc1_plot_columns
+    return list(dict.fromkeys(columns))
+
 def apply_event_cuts(
     data_df: pandas.DataFrame,
+    event_tensor: EventTensor,
     cuts_df: pandas.DataFrame,
     script_logger: logging.Logger,
     Johnny: RM.TaskManager,
@@ -116,38 +135,41 @@ def apply_event_cuts(
        calibration_code         0         >        140
     time_over_threshold         3        >=        300
     ```
-    this function returns a series with the index `event` and the value
-    either `True` or `False` stating if the even satisfies ALL the
-    cuts at the same time.
+    this function returns a `CutflowFilter` with the result of each cut for
+    each event, so the events which satisfy ALL the cuts at the same time,
+    or only the first cuts, can be found. The cuts are evaluated on
+    `event_tensor`, which must have a layer for each variable which is cut
+    on.
     """
-    board_id_list = data_df['data_board_id'].unique()
+    board_id_list = event_tensor.boards
     for board_id in cuts_df['board_id'].unique():
         if board_id != "*" and board_id != "#":
             if int(board_id) not in board_id_list:
                 raise ValueError("The board_id defined in the cuts file ({}) can not be found in the data. The set of board_ids defined in data is: {}".format(board_id, board_id_list))
 
-    pivot_data_df = data_df.pivot(
-        index = 'event',
-        columns = 'data_board_id',
-        values = list(set(data_df.columns) - {'data_board_id', 'event'}),
-    )
-
     base_path = Johnny.task_path.resolve()/"CutflowPlots"
     base_path.mkdir(exist_ok=True)
 
-    triggers_accepted_df = pandas.DataFrame({'accepted': True}, index=pivot_data_df.index)
+    cut_masks = []
+    cut_names = []
+    cut_outputs = []
     for idx, cut_row in cuts_df.iterrows():
-        triggers_accepted_df = df_apply_cut(triggers_accepted_df, pivot_data_df, cut_row['board_id'], cut_row['variable'], cut_row['cut_type'], cut_row['cut_value'], keep_nan=keep_events_without_data)
+        cut_accepted_df = pandas.DataFrame({'accepted': True}, index=event_tensor.event_index)
+        cut_accepted_df = df_apply_cut(cut_accepted_df, event_tensor, cut_row['board_id'], cut_row['variable'], cut_row['cut_type'], cut_row['cut_value'], keep_nan=keep_events_without_data)
+        cut_masks += [cut_accepted_df['accepted'].to_numpy()]
+        cut_names += [str(idx)]
+        cut_outputs += [""]
 
         if "output" in cut_row and isinstance(cut_row["output"], str):
+            cut_outputs[-1] = cut_row["output"]
             script_logger.info("Making partial cut plots after cut {}:\n{}".format(idx, cut_row))
             base_name = str(idx) + "-" + cut_row["output"]
             (base_path/base_name).mkdir(exist_ok=True)
-            this_data_df = apply_event_filter(data_df, triggers_accepted_df)
+            this_data_df = apply_event_filter(data_df, CutflowFilter.from_masks(event_tensor.events, cut_masks))
             build_plots(this_data_df, Johnny.run_name, Johnny.task_name, base_path/base_name, extra_title="Partial Cuts")
             del this_data_df
 
-    return triggers_accepted_df
+    return CutflowFilter.from_masks(event_tensor.events, cut_masks, cuts=cut_names, outputs=cut_outputs)
 
 def apply_event_cuts_task(
     AdaLovelace: RM.RunManager,
@@ -160,25 +182,25 @@ def apply_event_cuts_task(
             if not (Miso.path_directory/"cuts.csv").is_file():
                 script_logger.info("A cuts file is not defined for run {}".format(AdaLovelace.run_name))
             else:
-                with sqlite3.connect(Miso.path_directory/"data"/'data.sqlite') as input_sqlite3_connection:
-                    cuts_df = pandas.read_csv(Miso.path_directory/"cuts.csv")
+                cuts_df = pandas.read_csv(Miso.path_directory/"cuts.csv")
 
-                    if ("board_id" not in cuts_df or
-                        "variable" not in cuts_df or
-                        "cut_type" not in cuts_df or
-                        "cut_value" not in cuts_df
-                        ):
-                        script_logger.error("The cuts file does not have the correct format")
-                        raise RuntimeError("Bad cuts config file")
-                    cuts_df.to_csv(Miso.task_path/'cuts.backup.csv', index=False)
+                if ("board_id" not in cuts_df or
+                    "variable" not in cuts_df or
+                    "cut_type" not in cuts_df or
+                    "cut_value" not in cuts_df
+                    ):
+                    script_logger.error("The cuts file does not have the correct format")
+                    raise RuntimeError("Bad cuts config file")
+                cuts_df.to_csv(Miso.task_path/'cuts.backup.csv', index=False)
 
-                    input_df = pandas.read_sql('SELECT * FROM etroc1_data', input_sqlite3_connection, index_col=None)
+                input_df = read_table(Miso.path_directory/"data", "etroc1_data", columns=event_cuts_columns(cuts_df))
+                event_tensor = TableView(Miso.path_directory/"data", "etroc1_data").tensor(list(cuts_df['variable'].unique()))  # Only the variables which are cut on
 
-                    filtered_events_df = apply_event_cuts(input_df, cuts_df, script_logger=script_logger, Johnny=Miso, keep_events_without_data=keep_events_without_data)
+                event_filter = apply_event_cuts(input_df, event_tensor, cuts_df, script_logger=script_logger, Johnny=Miso, keep_events_without_data=keep_events_without_data)
 
-                    script_logger.info('Saving run event filter metadata...')
-                    filtered_events_df.reset_index().to_feather(Miso.task_path/'event_filter.fd')
-                    filtered_events_df.reset_index().to_feather(Miso.path_directory/'event_filter.fd')
+                script_logger.info('Saving run event filter metadata...')
+                write_filter(event_filter, Miso.task_path/'event_filter.npz')
+                write_filter(event_filter, Miso.path_directory/'event_filter.npz')
 
 def script_main(
         output_directory:Path,
@@ -200,7 +222,7 @@ def script_main(
         )
 
         if Bob.task_completed("apply_event_cuts") and make_plots:
-            plot_etroc1_task(Bob, "plot_after_cuts", Bob.path_directory/"data"/"data.sqlite", filter_files={"event": Bob.path_directory/"event_filter.fd"})
+            plot_etroc1_task(Bob, "plot_after_cuts", Bob.path_directory/"data", filter_files={"event": Bob.path_directory/"event_filter.npz"})
 
 
 
@@ -29,24 +29,35 @@ import logging
 import shutil
 import pandas
 import numpy as np
-import sqlite3
 
 from utilities import plot_etroc1_task
 from utilities import plot_times_in_ns_task
 from utilities import build_plots
 from utilities import build_time_plots
 from utilities import apply_event_filter
+from utilities import time_plot_columns
+from utilities import etroc1_data_view
 
 from cut_etroc1_single_run import df_apply_cut
 from cut_etroc1_single_run import apply_numeric_comparison_to_column
 
+from storage_utilities import EventTensor
+from storage_utilities import CutflowFilter
+from storage_utilities import has_filter
+from storage_utilities import read_filter
+from storage_utilities import write_filter
+
+from cache_utilities import task_cache_key
+from cache_utilities import restore_cached_task
+from cache_utilities import store_cached_task
+
 from math import sqrt
 
 
 
 def df_apply_diagonal_cut(
     accepted_df: pandas.DataFrame,
-    data_df: pandas.DataFrame,
+    event_tensor: EventTensor,
     cut_direction:str,
     column_1:tuple,
     column_2:tuple,
@@ -54,11 +65,11 @@ def df_apply_diagonal_cut(
     keep_nan:bool=False,
     ):
     if keep_nan:
-        extra_rows_to_keep = data_df[column_1].isna() | data_df[column_2].isna()
+        extra_rows_to_keep = event_tensor[column_1].isna() | event_tensor[column_2].isna()
     else:
         extra_rows_to_keep = False
 
-    distance = data_df[column_1] + data_df[column_2]
+    distance = event_tensor[column_1] + event_tensor[column_2]
 
     accepted_df['accepted'] &= apply_numeric_comparison_to_column(distance, cut_direction, distance_value, "diagonal cut") | extra_rows_to_keep
 
@@ -66,7 +77,7 @@ def df_apply_diagonal_cut(
 
 def df_apply_diagonal_distance_cut(
     accepted_df: pandas.DataFrame,
-    data_df: pandas.DataFrame,
+    event_tensor: EventTensor,
     cut_direction:str,
     column_1:tuple,
     column_2:tuple,
@@ -74,11 +85,11 @@ def df_apply_diagonal_distance_cut(
     keep_nan:bool=False,
     ):
     if keep_nan:
-        extra_rows_to_keep = data_df[column_1].isna() | data_df[column_2].isna()
+        extra_rows_to_keep = event_tensor[column_1].isna() | event_tensor[column_2].isna()
     else:
         extra_rows_to_keep = False
 
-    distance = (data_df[column_1] - data_df[column_2]).abs()/sqrt(2)
+    distance = (event_tensor[column_1] - event_tensor[column_2]).abs()/sqrt(2)
 
     accepted_df['accepted'] &= apply_numeric_comparison_to_column(distance, cut_direction, distance_value, "diagonal distance") | extra_rows_to_keep
 
@@ -86,7 +97,7 @@ def df_apply_diagonal_distance_cut(
 
 def df_apply_fit_distance_cut(
     accepted_df: pandas.DataFrame,
-    data_df: pandas.DataFrame,
+    event_tensor: EventTensor,
     cut_direction:str,
     column_1:tuple,
     column_2:tuple,
@@ -94,15 +105,15 @@ def df_apply_fit_distance_cut(
     keep_nan:bool=False,
     ):
     if keep_nan:
-        extra_rows_to_keep = data_df[column_1].isna() | data_df[column_2].isna()
+        extra_rows_to_keep = event_tensor[column_1].isna() | event_tensor[column_2].isna()
     else:
         extra_rows_to_keep = False
 
     import scipy.stats
-    fit = scipy.stats.linregress(x=data_df[column_1].astype(float), y=data_df[column_2].astype(float))
+    fit = scipy.stats.linregress(x=event_tensor[column_1].astype(float), y=event_tensor[column_2].astype(float))
 
     # https://en.wikipedia.org/wiki/Distance_from_a_point_to_a_line
-    distance = (data_df[column_1]*fit.slope - data_df[column_2] + fit.intercept)/(sqrt(fit.slope**2 + 1))
+    distance = (event_tensor[column_1]*fit.slope - event_tensor[column_2] + fit.intercept)/(sqrt(fit.slope**2 + 1))
 
     accepted_df['accepted'] &= apply_numeric_comparison_to_column(distance.abs(), cut_direction, distance_value, "fit distance") | extra_rows_to_keep
 
@@ -110,7 +121,7 @@ def df_apply_fit_distance_cut(
 
 def df_apply_circle_cut(
     accepted_df: pandas.DataFrame,
-    data_df: pandas.DataFrame,
+    event_tensor: EventTensor,
     cut_direction:str,
     column_1:tuple,
     column_2:tuple,
@@ -120,11 +131,11 @@ def df_apply_circle_cut(
     keep_nan:bool=False,
     ):
     if keep_nan:
-        extra_rows_to_keep = data_df[column_1].isna() | data_df[column_2].isna()
+        extra_rows_to_keep = event_tensor[column_1].isna() | event_tensor[column_2].isna()
     else:
         extra_rows_to_keep = False
 
-    distance = (data_df[column_1] - center_1)**2 + (data_df[column_2] - center_2)**2
+    distance = (event_tensor[column_1] - center_1)**2 + (event_tensor[column_2] - center_2)**2
 
     if cut_direction == "inside":
         accepted_df['accepted'] &= (distance < radius**2) | extra_rows_to_keep
@@ -137,7 +148,7 @@ def df_apply_circle_cut(
 
 def df_apply_corner_cut(
     accepted_df: pandas.DataFrame,
-    data_df: pandas.DataFrame,
+    event_tensor: EventTensor,
     corner_direction:int,
     cut_direction:str,
     column_1:tuple,
@@ -155,30 +166,30 @@ def df_apply_corner_cut(
       4 - down-left
     """
     if keep_nan:
-        extra_rows_to_keep = data_df[column_1].isna() | data_df[column_2].isna()
+        extra_rows_to_keep = event_tensor[column_1].isna() | event_tensor[column_2].isna()
     else:
         extra_rows_to_keep = False
 
-    region_1 = (data_df[column_1] < edge_1) & (data_df[column_2] < edge_2 - radius)
-    region_2 = (data_df[column_1] < edge_1 - radius) & (data_df[column_2] < edge_2)
-    region_3 = ((data_df[column_1] - (edge_1 - radius))**2 + (data_df[column_2] - (edge_2 - radius))**2) < radius**2
+    region_1 = (event_tensor[column_1] < edge_1) & (event_tensor[column_2] < edge_2 - radius)
+    region_2 = (event_tensor[column_1] < edge_1 - radius) & (event_tensor[column_2] < edge_2)
+    region_3 = ((event_tensor[column_1] - (edge_1 - radius))**2 + (event_tensor[column_2] - (edge_2 - radius))**2) < radius**2
 
     if corner_direction == 1:  # up-right
-        region_1 = (data_df[column_1] < edge_1) & (data_df[column_2] <= edge_2 - radius)
-        region_2 = (data_df[column_1] <= edge_1 - radius) & (data_df[column_2] < edge_2)
-        region_3 = ((data_df[column_1] - (edge_1 - radius))**2 + (data_df[column_2] - (edge_2 - radius))**2) < radius**2
+        region_1 = (event_tensor[column_1] < edge_1) & (event_tensor[column_2] <= edge_2 - radius)
+        region_2 = (event_tensor[column_1] <= edge_1 - radius) & (event_tensor[column_2] < edge_2)
+        region_3 = ((event_tensor[column_1] - (edge_1 - radius))**2 + (event_tensor[column_2] - (edge_2 - radius))**2) < radius**2
     elif corner_direction == 2:  # up-left
-        region_1 = (data_df[column_1] > edge_1) & (data_df[column_2] <= edge_2 - radius)
-        region_2 = (data_df[column_1] >= edge_1 + radius) & (data_df[column_2] < edge_2)
-        region_3 = ((data_df[column_1] - (edge_1 + radius))**2 + (data_df[column_2] - (edge_2 - radius))**2) < radius**2
+        region_1 = (event_tensor[column_1] > edge_1) & (event_tensor[column_2] <= edge_2 - radius)
+        region_2 = (event_tensor[column_1] >= edge_1 + radius) & (event_tensor[column_2] < edge_2)
+        region_3 = ((event_tensor[column_1] - (edge_1 + radius))**2 + (event_tensor[column_2] - (edge_2 - radius))**2) < radius**2
     elif corner_direction == 3:  # down-right
-        region_1 = (data_df[column_1] < edge_1) & (data_df[column_2] >= edge_2 + radius)
-        region_2 = (data_df[column_1] <= edge_1 - radius) & (data_df[column_2] > edge_2)
-        region_3 = ((data_df[column_1] - (edge_1 - radius))**2 + (data_df[column_2] - (edge_2 + radius))**2) < radius**2
+        region_1 = (event_tensor[column_1] < edge_1) & (event_tensor[column_2] >= edge_2 + radius)
+        region_2 = (event_tensor[column_1] <= edge_1 - radius) & (event_tensor[column_2] > edge_2)
+        region_3 = ((event_tensor[column_1] - (edge_1 - radius))**2 + (event_tensor[column_2] - (edge_2 + radius))**2) < radius**2
     elif corner_direction == 4:  # down-left
-        region_1 = (data_df[column_1] > edge_1) & (data_df[column_2] >= edge_2 + radius)
-        region_2 = (data_df[column_1] >= edge_1 + radius) & (data_df[column_2] > edge_2)
-        region_3 = ((data_df[column_1] - (edge_1 + radius))**2 + (data_df[column_2] - (edge_2 + radius))**2) < radius**2
+        region_1 = (event_tensor[column_1] > edge_1) & (event_tensor[column_2] >= edge_2 + radius)
+        region_2 = (event_tensor[column_1] >= edge_1 + radius) & (event_tensor[column_2] > edge_2)
+        region_3 = ((event_tensor[column_1] - (edge_1 + radius))**2 + (event_tensor[column_2] - (edge_2 + radius))**2) < radius**2
     else:
         raise RuntimeError("Unknown corner direction for corner: {}".format(corner_direction))
 
@@ -193,7 +204,7 @@ def df_apply_corner_cut(
 
 def df_apply_1d_distance_cut(
     accepted_df: pandas.DataFrame,
-    data_df: pandas.DataFrame,
+    event_tensor: EventTensor,
     cut_direction:str,
     column_1:tuple,
     center:str,
@@ -201,11 +212,11 @@ def df_apply_1d_distance_cut(
     keep_nan:bool=False,
     ):
     if keep_nan:
-        extra_rows_to_keep = data_df[column_1].isna()
+        extra_rows_to_keep = event_tensor[column_1].isna()
     else:
         extra_rows_to_keep = False
 
-    distance = (data_df[column_1] - center).abs()
+    distance = (event_tensor[column_1] - center).abs()
 
     if cut_direction == "inside":
         accepted_df['accepted'] &= (distance < limit) | extra_rows_to_keep
@@ -218,7 +229,7 @@ def df_apply_1d_distance_cut(
 
 def df_apply_time_cut_governor(
     accepted_df: pandas.DataFrame,
-    data_df: pandas.DataFrame,
+    event_tensor: EventTensor,
     cut_type:str,
     cut_direction:str,
     variable_1:str,
@@ -233,7 +244,7 @@ def df_apply_time_cut_governor(
     if cut_type == "simple":
         return df_apply_cut(
             accepted_df,
-            data_df,
+            event_tensor,
             board_id=board_id_1,
             variable=variable_1,
             cut_type=cut_direction,
@@ -243,7 +254,7 @@ def df_apply_time_cut_governor(
     elif cut_type == "circle":
         return df_apply_circle_cut(
             accepted_df,
-            data_df,
+            event_tensor,
             cut_direction,
             (variable_1, board_id_1),
             (variable_2, board_id_2),
@@ -255,7 +266,7 @@ def df_apply_time_cut_governor(
     elif cut_type == "corner-ur":
         return df_apply_corner_cut(
             accepted_df,
-            data_df,
+            event_tensor,
             1,
             cut_direction,
             (variable_1, board_id_1),
@@ -268,7 +279,7 @@ def df_apply_time_cut_governor(
     elif cut_type == "corner-ul":
         return df_apply_corner_cut(
             accepted_df,
-            data_df,
+            event_tensor,
             2,
             cut_direction,
             (variable_1, board_id_1),
@@ -281,7 +292,7 @@ def df_apply_time_cut_governor(
     elif cut_type == "corner-dr":
         return df_apply_corner_cut(
             accepted_df,
-            data_df,
+            event_tensor,
             3,
             cut_direction,
             (variable_1, board_id_1),
@@ -294,7 +305,7 @@ def df_apply_time_cut_governor(
     elif cut_type == "corner-dl":
         return df_apply_corner_cut(
             accepted_df,
-            data_df,
+            event_tensor,
             4,
             cut_direction,
             (variable_1, board_id_1),
@@ -307,7 +318,7 @@ def df_apply_time_cut_governor(
     elif cut_type == "fit-dist":
         return df_apply_fit_distance_cut(
             accepted_df,
-            data_df,
+            event_tensor,
             cut_direction,
             (variable_1, board_id_1),
             (variable_2, board_id_2),
@@ -317,7 +328,7 @@ def df_apply_time_cut_governor(
     elif cut_type == "diag-dist":
         return df_apply_diagonal_distance_cut(
             accepted_df,
-            data_df,
+            event_tensor,
             cut_direction,
             (variable_1, board_id_1),
             (variable_2, board_id_2),
@@ -327,7 +338,7 @@ def df_apply_time_cut_governor(
     elif cut_type == "diagonal":
         return df_apply_diagonal_cut(
             accepted_df,
-            data_df,
+            event_tensor,
             cut_direction,
             (variable_1, board_id_1),
             (variable_2, board_id_2),
@@ -337,7 +348,7 @@ def df_apply_time_cut_governor(
     elif cut_type == "1d-dist":
         return df_apply_1d_distance_cut(
             accepted_df,
-            data_df,
+            event_tensor,
             cut_direction,
             (variable_1, board_id_1),
             value_1,
@@ -347,9 +358,34 @@ def df_apply_time_cut_governor(
     else:
         raise RuntimeError("Unknown cut type: {}".format(cut_type))
 
+def time_cuts_variables(
+    time_cuts_df: pandas.DataFrame,
+    ):
+    """
+    Returns the variables used by the time cuts of `time_cuts_df`, skipping
+    the commented rows
+    """
+    active_cuts_df = time_cuts_df.loc[time_cuts_df['cut_type'].str[0] != "#"]
+    variables = list(active_cuts_df['variable_1'].dropna()) + list(active_cuts_df['variable_2'].dropna())
+    return list(dict.fromkeys(variables))
+
+def time_cuts_columns(
+    time_cuts_df: pandas.DataFrame,
+    ):
+    """
+    Returns the columns of the data which are needed besides the event tensor
+    to apply the time cuts of `time_cuts_df`, i.e. the columns of the partial
+    cut plots if any cut has an output defined
+    """
+    columns = ["event", "data_board_id"]
+    if "output" in time_cuts_df and time_cuts_df["output"].apply(lambda output: isinstance(output, str)).any():
+        columns += time_plot_columns
+    return list(dict.fromkeys(columns))
+
 def apply_time_cuts(
     Shinji: RM.TaskManager,
     data_df: pandas.DataFrame,
+    event_tensor: EventTensor,
     time_cuts_df: pandas.DataFrame,
     script_logger: logging.Logger,
     max_toa:float=20,
@@ -365,11 +401,15 @@ def apply_time_cuts(
       corner        outside  time_over_threshold_ns           0  time_over_threshold_ns           1      2.6      2.3      0.8
       simple              <  time_over_threshold_ns           0                     NaN         NaN        6      NaN      NaN
     ```
-    this function returns a series with the index `event` and the value
-    either `True` or `False` stating if the even satisfies ALL the
-    cuts at the same time.
+    this function returns a `CutflowFilter` with the result of each cut for
+    each event, so the events which satisfy ALL the cuts at the same time,
+    or only the cuts up to each step of the cutflow, can be found. The
+    partial cut plots are made for the steps with an output. The cuts are
+    evaluated on `event_tensor`, which
+    must have a layer for each variable which is cut on and for the times in
+    ns used in the partial cut plots.
     """
-    board_id_list = data_df['data_board_id'].unique()
+    board_id_list = event_tensor.boards
     for board_id in time_cuts_df['board_id_1'].unique():
         if board_id != "*" and board_id != "#":
             if int(board_id) not in board_id_list:
@@ -379,22 +419,22 @@ def apply_time_cuts(
             if int(board_id) not in board_id_list:
                 raise ValueError("The board_id defined in the cuts file ({}) can not be found in the data. The set of board_ids defined in data is: {}".format(board_id, board_id_list))
 
-    pivot_data_df = data_df.pivot(
-        index = 'event',
-        columns = 'data_board_id',
-        values = list(set(data_df.columns) - {'data_board_id', 'event'}),
-    )
-
     base_path = Shinji.task_path.resolve()/"CutflowPlots"
     base_path.mkdir(exist_ok=True)
 
-    triggers_accepted_df = pandas.DataFrame({'accepted': True}, index=pivot_data_df.index)
+    event_filter = None  # Only used for the partial cut plots
+    if Shinji.task_completed("apply_event_cuts") and has_filter(Shinji.get_task_path("apply_event_cuts")/"event_filter.npz"):
+        event_filter = read_filter(Shinji.get_task_path("apply_event_cuts")/"event_filter.npz")
+
+    cut_masks = []
+    cut_names = []
+    cut_outputs = []
     for idx, cut_row in time_cuts_df.iterrows():
         if cut_row['cut_type'][0] == "#":  # If first character is #, then we skip the row
             continue
-        triggers_accepted_df = df_apply_time_cut_governor(
-            triggers_accepted_df,
-            pivot_data_df,
+        cut_accepted_df = df_apply_time_cut_governor(
+            pandas.DataFrame({'accepted': True}, index=event_tensor.event_index),
+            event_tensor,
             cut_row['cut_type'],
             cut_row['cut_direction'],
             cut_row['variable_1'],
@@ -406,25 +446,26 @@ def apply_time_cuts(
             cut_row['value_3'],
             keep_nan=keep_events_without_data,
         )
+        cut_masks += [cut_accepted_df['accepted'].to_numpy()]
+        cut_names += [str(idx)]
+        cut_outputs += [""]
 
         if "output" in cut_row and isinstance(cut_row["output"], str):
+            cut_outputs[-1] = cut_row["output"]
             script_logger.info("Making partial cut plots after cut {}:\n{}".format(idx, cut_row))
             base_name = str(idx) + "-" + cut_row["output"]
             (base_path/base_name).mkdir(exist_ok=True)
             (base_path/base_name/"plots").mkdir(exist_ok=True)
             (base_path/base_name/"time_plots").mkdir(exist_ok=True)
             this_data_df = data_df
-            if Shinji.task_completed("apply_event_cuts"):
-                event_accepted_df = pandas.read_feather(Shinji.get_task_path("apply_event_cuts")/"event_filter.fd")
-                event_accepted_df.set_index("event", inplace=True)
-                this_data_df = apply_event_filter(this_data_df, event_accepted_df)
-            this_data_df = apply_event_filter(this_data_df, triggers_accepted_df, filter_name="time_filter")
-            triggers_accepted_df.reset_index().to_feather(base_path/base_name/'time_filter.fd')
+            if event_filter is not None:
+                this_data_df = apply_event_filter(this_data_df, event_filter)
+            this_data_df = apply_event_filter(this_data_df, CutflowFilter.from_masks(event_tensor.events, cut_masks), filter_name="time_filter")
             build_plots(this_data_df, Shinji.run_name, Shinji.task_name, base_path/base_name/"plots", extra_title="Partial Cuts")
-            build_time_plots(this_data_df, base_path/base_name/"time_plots", Shinji.run_name, Shinji.task_name, extra_title="Partial Cuts", max_toa=max_toa, max_tot=max_tot, min_toa=min_toa, min_tot=min_tot)
+            build_time_plots(this_data_df, event_tensor, base_path/base_name/"time_plots", Shinji.run_name, Shinji.task_name, extra_title="Partial Cuts", max_toa=max_toa, max_tot=max_tot, min_toa=min_toa, min_tot=min_tot)
             del this_data_df
 
-    return triggers_accepted_df
+    return CutflowFilter.from_masks(event_tensor.events, cut_masks, cuts=cut_names, outputs=cut_outputs)
 
 def apply_time_cuts_task(
     Dexter: RM.RunManager,
@@ -435,47 +476,70 @@ def apply_time_cuts_task(
     min_toa:float=-20,
     min_tot:float=-20,
     keep_events_without_data:bool = False,
+    cache_dir:Path = None,
 ):
     if Dexter.task_completed("calculate_times_in_ns"):
         with Dexter.handle_task("apply_time_cuts", drop_old_data=drop_old_data) as Shinji:
+            cache_key = None
+            cache_outputs = {"time_filter.npz": Shinji.path_directory/"time_filter.npz"}
+            if cache_dir is not None:
+                cache_key = task_cache_key(
+                    "apply_time_cuts",
+                    {
+                        "max_toa": max_toa,
+                        "max_tot": max_tot,
+                        "min_toa": min_toa,
+                        "min_tot": min_tot,
+                        "keep_events_without_data": keep_events_without_data,
+                    },
+                    input_tables=etroc1_data_view(Shinji, ["calculate_times_in_ns"]).tables(),
+                    input_files=[Shinji.path_directory/"time_cuts.csv", Shinji.get_task_path("apply_event_cuts")/"event_filter.npz", Shinji.get_task_path("apply_event_cuts")/"event_filter.fd", Path(__file__)],
+                )
+                if restore_cached_task(cache_dir, "apply_time_cuts", cache_key, Shinji.task_path, script_logger, outputs=cache_outputs):
+                    return
+
             if not (Shinji.path_directory/"time_cuts.csv").is_file():
                 script_logger.info("A time cuts file is not defined for run {}".format(Dexter.run_name))
             else:
-                with sqlite3.connect(Shinji.get_task_path("calculate_times_in_ns")/'data.sqlite') as input_sqlite3_connection:
-                    cuts_df = pandas.read_csv(Shinji.path_directory/"time_cuts.csv")
-
-                    if ("cut_type" not in cuts_df or
-                        "cut_direction" not in cuts_df or
-                        "variable_1" not in cuts_df or
-                        "board_id_1" not in cuts_df or
-                        "variable_2" not in cuts_df or
-                        "board_id_2" not in cuts_df or
-                        "value_1" not in cuts_df or
-                        "value_2" not in cuts_df or
-                        "value_3" not in cuts_df
-                        ):
-                        script_logger.error("The time cuts file does not have the correct format")
-                        raise RuntimeError("Bad time cuts config file")
-                    cuts_df.to_csv(Shinji.task_path/'cuts.backup.csv', index=False)
-
-                    input_df = pandas.read_sql('SELECT * FROM etroc1_data', input_sqlite3_connection, index_col=None)
-
-                    filtered_events_df = apply_time_cuts(
-                        Shinji,
-                        input_df,
-                        cuts_df,
-                        script_logger=script_logger,
-                        max_toa=max_toa,
-                        max_tot=max_tot,
-                        min_toa=min_toa,
-                        min_tot=min_tot,
-                        keep_events_without_data=keep_events_without_data,
-                    )
-                    filtered_events_df.reset_index(inplace=True)
-
-                    script_logger.info('Saving run event filter metadata...')
-                    filtered_events_df.to_feather(Shinji.task_path/'time_filter.fd')
-                    filtered_events_df.to_feather(Shinji.path_directory/'time_filter.fd')
+                cuts_df = pandas.read_csv(Shinji.path_directory/"time_cuts.csv")
+
+                if ("cut_type" not in cuts_df or
+                    "cut_direction" not in cuts_df or
+                    "variable_1" not in cuts_df or
+                    "board_id_1" not in cuts_df or
+                    "variable_2" not in cuts_df or
+                    "board_id_2" not in cuts_df or
+                    "value_1" not in cuts_df or
+                    "value_2" not in cuts_df or
+                    "value_3" not in cuts_df
+                    ):
+                    script_logger.error("The time cuts file does not have the correct format")
+                    raise RuntimeError("Bad time cuts config file")
+                cuts_df.to_csv(Shinji.task_path/'cuts.backup.csv', index=False)
+
+                data_view = etroc1_data_view(Shinji, ["calculate_times_in_ns"])
+                input_df = data_view.read(columns=time_cuts_columns(cuts_df))
+                event_tensor = data_view.tensor(time_cuts_variables(cuts_df) + ["time_of_arrival_ns", "time_over_threshold_ns"])
+
+                time_filter = apply_time_cuts(
+                    Shinji,
+                    input_df,
+                    event_tensor,
+                    cuts_df,
+                    script_logger=script_logger,
+                    max_toa=max_toa,
+                    max_tot=max_tot,
+                    min_toa=min_toa,
+                    min_tot=min_tot,
+                    keep_events_without_data=keep_events_without_data,
+                )
+
+                script_logger.info('Saving run event filter metadata...')
+                write_filter(time_filter, Shinji.task_path/'time_filter.npz')
+                write_filter(time_filter, Shinji.path_directory/'time_filter.npz')
+
+            if cache_key is not None:
+                store_cached_task(cache_dir, "apply_time_cuts", cache_key, Shinji.task_path, script_logger, outputs=cache_outputs)
 
 def script_main(
     output_directory:Path,
@@ -484,6 +548,7 @@ def script_main(
     max_toa:float=0,
     max_tot:float=0,
     keep_events_without_data:bool=False,
+    cache_dir:Path=None,
     ):
 
     script_logger = logging.getLogger('apply_time_cuts')
@@ -508,26 +573,27 @@ def script_main(
             min_toa=0,
             min_tot=0,
             keep_events_without_data=keep_events_without_data,
+            cache_dir=cache_dir,
         )
 
         if Dexter.task_completed("apply_time_cuts") and make_plots:
             plot_etroc1_task(
                 Dexter,
                 "plot_after_time_cuts",
-                Dexter.get_task_path("calculate_times_in_ns")/'data.sqlite',
+                Dexter.path_directory/"data",
                 filter_files={
-                    "event": Dexter.path_directory/"event_filter.fd",
-                    "time": Dexter.path_directory/"time_filter.fd",
+                    "event": Dexter.path_directory/"event_filter.npz",
+                    "time": Dexter.path_directory/"time_filter.npz",
                 }
             )
             plot_times_in_ns_task(
                 Dexter,
                 script_logger=script_logger,
                 task_name="plot_time_after_time_cuts",
-                data_file=Dexter.get_task_path("calculate_times_in_ns")/'data.sqlite',
+                data_view=etroc1_data_view(Dexter, ["calculate_times_in_ns"]),
                 filter_files={
-                    "event": Dexter.path_directory/"event_filter.fd",
-                    "time": Dexter.path_directory/"time_filter.fd",
+                    "event": Dexter.path_directory/"event_filter.npz",
+                    "time": Dexter.path_directory/"time_filter.npz",
                 },
                 max_toa=max_toa,
                 max_tot=max_tot,
@@ -587,6 +653,14 @@ if __name__ == '__main__':
         action = 'store_true',
         dest = 'keep_events_without_data',
     )
+    parser.add_argument(
+        '--cache-dir',
+        metavar = 'path',
+        help = 'If set, the results of the task are saved in this directory, which can be shared by several runs, and reused whenever the task is run again with the same input data, cuts and parameters',
+        default = None,
+        dest = 'cache_dir',
+        type = str,
+    )
 
     args = parser.parse_args()
 
@@ -606,9 +680,14 @@ if __name__ == '__main__':
         elif args.log_level == "NOTSET":
             logging.basicConfig(level=0)
 
+    cache_dir = None
+    if args.cache_dir is not None:
+        cache_dir = Path(args.cache_dir)
+
     script_main(
         Path(args.out_directory),
         max_toa=args.max_toa,
         max_tot=args.max_tot,
-        keep_events_without_data=args.keep_events_without_data
+        keep_events_without_data=args.keep_events_without_data,
+        cache_dir=cache_dir,
     )
\ No newline at end of file
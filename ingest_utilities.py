@@ -0,0 +1,1541 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
+                         #   https://docs.python.org/3/library/pathlib.html
+
+import logging
+import os
+import time
+import re
+import io
+import gzip
+import bz2
+import lzma
+import hashlib
+import concurrent.futures
+import pandas
+import numpy
+import pyarrow
+import pyarrow.csv
+
+try:  # Only needed to read zstd compressed raw data files
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Columns of the dat files from the charge injection runs, with the dtype each column is stored with
+etroc1_dat_columns = {
+    "data_board_id": "int8",
+    "time_of_arrival": "int16",
+    "time_over_threshold": "int16",
+    "calibration_code": "int16",
+    "hit_flag": "bool",
+}
+
+# Columns of the txt summary files from the beam and cosmic runs
+# The day and time only have a few distinct values, so they are read as categories instead of one string per row
+etroc1_txt_columns = dict(etroc1_dat_columns)
+etroc1_txt_columns["day"] = "category"
+etroc1_txt_columns["time"] = "category"
+
+arrow_types = {
+    "int8": pyarrow.int8(),
+    "int16": pyarrow.int16(),
+    "int32": pyarrow.int32(),
+    "int64": pyarrow.int64(),
+    "bool": pyarrow.bool_(),
+    "object": pyarrow.string(),
+    "category": pyarrow.dictionary(pyarrow.int32(), pyarrow.string()),
+}
+
+# Valid range of the codes measured by the ETROC1, all of them have 10 bits
+etroc1_code_ranges = {
+    "time_of_arrival": (0, 1023),
+    "time_over_threshold": (0, 1023),
+    "calibration_code": (0, 1023),
+}
+
+def validate_etroc1_data(
+    df: pandas.DataFrame,
+    columns: dict[str, str],
+    malformed: numpy.ndarray = None,
+):
+    """
+    Check the parsed rows, vectorized over whole columns, before they are
+    converted into the types in `columns`: missing or non numeric values
+    (malformed lines), unknown board ids, codes outside their range and
+    hit flags other than 0 or 1. Rows already known to be malformed, e.g.
+    lines with too many fields, are flagged in the `malformed` mask.
+    Returns the valid rows, converted into the final types, and the
+    invalid rows with the first check they failed in the `reason` column
+    (or `None` if all rows are valid).
+    """
+    checks = {
+        "malformed": df[[column for column in columns if column in df]].isna().any(axis=1),
+        "unknown_board": ~df["data_board_id"].isin(etroc1_board_ids),
+    }
+    if malformed is not None:
+        checks["malformed"] |= malformed
+    for column in etroc1_code_ranges:
+        if column in df:
+            checks[column + "_out_of_range"] = ~df[column].between(*etroc1_code_ranges[column])
+    checks["invalid_hit_flag"] = ~df["hit_flag"].isin([0, 1])
+
+    reason_codes = numpy.select([check.to_numpy() for check in checks.values()], range(1, len(checks) + 1), default=0)
+    invalid = reason_codes > 0
+
+    types = {column: columns[column] for column in columns if column in df}
+    if not invalid.any():
+        return df.astype(types), None
+
+    quarantine_df = df.loc[invalid].copy()
+    quarantine_df["reason"] = pandas.Categorical.from_codes(reason_codes[invalid] - 1, categories=list(checks))
+    return df.loc[~invalid].astype(types), quarantine_df
+
+def etroc1_row_mask(
+    hit_flag: numpy.ndarray,
+    data_board_id: numpy.ndarray,
+    keep_only_triggers: bool = False,
+    board_ids: list[int] = None,
+):
+    """
+    Boolean mask of the rows to keep while parsing: only the rows with the
+    hit flag set (if `keep_only_triggers`) and only the rows from the
+    boards in `board_ids` (if set). Returns `None` if all rows are kept.
+    Rows with an invalid hit flag are kept, so the validation finds them.
+    """
+    mask = None
+    if keep_only_triggers:
+        mask = hit_flag.astype(bool)
+    if board_ids is not None:
+        board_mask = numpy.isin(data_board_id, board_ids)
+        mask = board_mask if mask is None else mask & board_mask
+    return mask
+
+def limit_line_fields(
+    data: bytes,
+    max_fields: int,
+):
+    """
+    Cut the lines of a block of text, which holds only complete lines, with
+    more than `max_fields` whitespace separated fields down to their first
+    `max_fields` fields. The fields of all the lines are counted in one
+    vectorized pass, only the (rare) lines which are too long are rebuilt.
+    """
+    values = numpy.frombuffer(data, dtype=numpy.uint8)
+    if len(values) == 0:
+        return data
+    newline = values == ord("\n")
+    separator = newline | (values == ord(" ")) | (values == ord("\t")) | (values == ord("\r"))
+    field_start = ~separator
+    field_start[1:] &= separator[:-1]
+    line_start = numpy.flatnonzero(newline) + 1
+    line_start = numpy.concatenate(([0], line_start[line_start < len(values)]))
+    fields = numpy.add.reduceat(field_start, line_start, dtype=numpy.int32)  # Number of fields of each line
+    long_lines = numpy.flatnonzero(fields > max_fields)
+    if len(long_lines) == 0:
+        return data
+
+    lines = data.split(b"\n")
+    for line in long_lines.tolist():
+        lines[line] = b" ".join(lines[line].split()[:max_fields])
+    return b"\n".join(lines)
+
+class FieldLimitingReader(io.RawIOBase):
+    """
+    Read only stream over a text raw data stream which cuts the lines with
+    more than `max_fields` fields down to their first `max_fields` fields
+    (see `limit_line_fields`), a block of complete lines at a time. The
+    underlying stream is not closed.
+    """
+    def __init__(self, stream, max_fields: int, block_size: int = 1024*1024):
+        self._stream = stream
+        self._max_fields = max_fields
+        self._block_size = block_size
+        self._pending = b""  # Incomplete line at the end of the data read so far
+        self._data = memoryview(b"")
+        self._finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self._data) == 0 and not self._finished:
+            data = self._pending + self._stream.read(self._block_size)
+            if len(data) == len(self._pending):  # The end of the stream, the last line may not have an end of line
+                self._finished = True
+                end = len(data)
+            else:
+                end = data.rfind(b"\n") + 1
+            self._pending = data[end:]
+            self._data = memoryview(limit_line_fields(data[:end], self._max_fields))
+
+        size = min(len(buffer), len(self._data))
+        buffer[:size] = self._data[:size]
+        self._data = self._data[size:]
+        return size
+
+def pandas_parser(
+    input_file: Path,
+    columns: dict[str, str],
+    skip_rows: int = 0,
+    chunk_size: int = None,
+    keep_only_triggers: bool = False,
+    board_ids: list[int] = None,
+    validate: bool = False,
+):
+    """
+    Parser built on `pandas.read_csv`, yields tuples with the parsed
+    dataframe, the number of rows read from the file and the rows which
+    failed the validation (if `validate`, see `validate_etroc1_data`).
+    The rows removed by the filters keep their original index in the file.
+    When filtering and reading the whole file at once, the file is read in
+    blocks which are filtered as they are parsed, so the discarded rows
+    are never accumulated in memory.
+
+    When validating, the lines are parsed with an extra sentinel column and
+    the lines with even more fields are cut down to the sentinel column
+    while reading (see `FieldLimitingReader`), so every line with too many
+    fields is still read as a row, keeping the row numbers aligned with the
+    file, and put into quarantine as malformed.
+    """
+    filtering = keep_only_triggers or board_ids is not None
+    read_size = chunk_size
+    if read_size is None and (filtering or validate):
+        read_size = 1000000
+
+    names = list(columns)
+    source = input_file
+    opened_file = None
+    if validate:
+        names += ["extra_field"]
+        if isinstance(input_file, (str, os.PathLike)):
+            source = opened_file = open(input_file, "rb")
+        source = FieldLimitingReader(source, len(names))
+    try:
+        reader = pandas.read_csv(
+            source,
+            header=None,
+            delim_whitespace=True,
+            skiprows=skip_rows,
+            names=names,
+            index_col=False,
+            dtype={column: columns[column] for column in columns if columns[column] == "category"},
+            chunksize=read_size,
+        )
+        if read_size is None:
+            reader = [reader]
+
+        kept_dfs = []
+        quarantine_dfs = []
+        rows_read = 0
+        for df in reader:
+            rows_read += len(df)
+            if validate:  # Values which are not numbers become NaN, instead of failing the type conversion
+                extra_fields = df.pop("extra_field").notna().to_numpy()
+                for column in columns:
+                    if columns[column] != "category":
+                        df[column] = pandas.to_numeric(df[column], errors="coerce")
+            else:
+                df = df.astype(columns)
+            if filtering:
+                mask = etroc1_row_mask(df["hit_flag"].to_numpy(), df["data_board_id"].to_numpy(), keep_only_triggers, board_ids)
+                df = df.loc[mask]
+                if validate:
+                    extra_fields = extra_fields[mask]
+            quarantine_df = None
+            if validate:
+                df, quarantine_df = validate_etroc1_data(df, columns, malformed=extra_fields)
+
+            if chunk_size is not None:
+                yield df, rows_read, quarantine_df
+                rows_read = 0
+            else:
+                kept_dfs += [df]
+                if quarantine_df is not None:
+                    quarantine_dfs += [quarantine_df]
+
+        if chunk_size is None:
+            quarantine_df = pandas.concat(quarantine_dfs) if len(quarantine_dfs) > 0 else None
+            if len(kept_dfs) == 1:
+                yield kept_dfs[0], rows_read, quarantine_df
+            elif len(kept_dfs) > 1:
+                yield pandas.concat(kept_dfs).astype(columns), rows_read, quarantine_df  # The categories may differ between blocks
+            else:
+                yield pandas.DataFrame({column: pandas.Series(dtype=columns[column]) for column in columns}), rows_read, quarantine_df
+    finally:
+        if opened_file is not None:
+            opened_file.close()
+
+def filter_arrow_table(
+    table: pyarrow.Table,
+    row_numbers: numpy.ndarray,
+    keep_only_triggers: bool = False,
+    board_ids: list[int] = None,
+):
+    """
+    Convert an arrow table to a dataframe, applying the row filters to the
+    arrow table so the discarded rows are never converted. The rows get
+    their number in the file, from `row_numbers`, as index.
+    """
+    mask = etroc1_row_mask(
+        table.column("hit_flag").to_numpy(),
+        table.column("data_board_id").to_numpy(),
+        keep_only_triggers,
+        board_ids,
+    )
+    if mask is None:
+        df = table.to_pandas()
+        df.index = pandas.Index(row_numbers)
+        return df
+
+    df = table.filter(pyarrow.array(mask)).to_pandas()
+    df.index = pandas.Index(row_numbers[mask])
+    return df
+
+def pyarrow_parser(
+    input_file: Path,
+    columns: dict[str, str],
+    skip_rows: int = 0,
+    chunk_size: int = None,
+    keep_only_triggers: bool = False,
+    board_ids: list[int] = None,
+    validate: bool = False,
+):
+    """
+    Multithreaded parser built on `pyarrow.csv`, the columns are parsed
+    directly into their final types. Contrary to the pandas parser, the
+    columns must be separated by a single space. The row filters are
+    applied on the arrow tables, before converting into dataframes.
+
+    When validating, the numeric columns are parsed as 64 bit integers so
+    the values can be checked before the conversion into the final types,
+    and lines with the wrong number of fields are split into their fields
+    and put into quarantine as malformed, with their row number in the
+    file, like the pandas parser does, instead of stopping the parsing.
+    The file is then always read with the streaming reader, which knows
+    the line number of the invalid lines. Values which are not integers
+    still raise `pyarrow.ArrowInvalid`, see `parse_etroc1_text`.
+    """
+    invalid_lines = []  # The (row number, text) of the invalid lines not yet put into quarantine
+    invalid_rows = []  # The row numbers of all the invalid lines, to place the valid rows in the file
+    def skip_invalid_line(row):
+        invalid_lines.append((row.number - 1 - skip_rows, row.text))
+        invalid_rows.append(row.number - 1 - skip_rows)
+        return "skip"
+
+    read_options = pyarrow.csv.ReadOptions(
+        column_names=list(columns),
+        skip_rows=skip_rows,
+        use_threads=True,
+    )
+    parse_options = pyarrow.csv.ParseOptions(
+        delimiter=' ',
+        invalid_row_handler=skip_invalid_line if validate else None,
+    )
+    column_types = {column: arrow_types[columns[column]] for column in columns}
+    if validate:
+        column_types = {column: column_types[column] if columns[column] == "category" else pyarrow.int64() for column in columns}
+    convert_options = pyarrow.csv.ConvertOptions(column_types=column_types)
+
+    def quarantine_invalid_lines(lines):
+        invalid_df = pandas.DataFrame(
+            [(text.split(" ") + [None]*len(columns))[:len(columns)] for row, text in lines],  # Missing fields become None
+            columns=list(columns),
+            index=pandas.Index([row for row, text in lines]),
+        )
+        for column in columns:
+            if columns[column] != "category":
+                invalid_df[column] = pandas.to_numeric(invalid_df[column], errors="coerce")
+            else:
+                invalid_df[column] = invalid_df[column].astype("category")
+        mask = etroc1_row_mask(invalid_df["hit_flag"].to_numpy(), invalid_df["data_board_id"].to_numpy(), keep_only_triggers, board_ids)
+        if mask is not None:
+            invalid_df = invalid_df.loc[mask]
+        return validate_etroc1_data(invalid_df, columns, malformed=numpy.ones(len(invalid_df), dtype=bool))[1]
+
+    def finish_table(table, first_index, last=False):
+        row_numbers = numpy.arange(first_index, first_index + table.num_rows)
+        if len(invalid_rows) > 0:  # Skip over the row numbers of the invalid lines before each row
+            valid_rows_before = numpy.array(invalid_rows) - numpy.arange(len(invalid_rows))
+            row_numbers += numpy.searchsorted(valid_rows_before, row_numbers, side="right")
+        df = filter_arrow_table(table, row_numbers, keep_only_triggers, board_ids)
+        quarantine_df = None
+        if validate:
+            df, quarantine_df = validate_etroc1_data(df, columns)
+        # The reader may already have found invalid lines after the last row, they are left for the next table
+        lines = [line for line in invalid_lines if last or (table.num_rows > 0 and line[0] < row_numbers[-1])]
+        del invalid_lines[:len(lines)]
+        rows_read = table.num_rows + len(lines)
+        if len(lines) > 0:
+            invalid_df = quarantine_invalid_lines(lines)
+            if invalid_df is not None:
+                quarantine_df = invalid_df if quarantine_df is None else pandas.concat([quarantine_df, invalid_df]).sort_index()
+        return df, rows_read, quarantine_df
+
+    if chunk_size is None and not validate:
+        table = pyarrow.csv.read_csv(
+            input_file,
+            read_options=read_options,
+            parse_options=parse_options,
+            convert_options=convert_options,
+        )
+        yield finish_table(table, 0, last=True)
+        return
+
+    # Keep the index running across chunks, like the pandas chunk reader does
+    next_index = 0
+    batches = []
+    batch_rows = 0
+    with pyarrow.csv.open_csv(
+        input_file,
+        read_options=read_options,
+        parse_options=parse_options,
+        convert_options=convert_options,
+    ) as reader:
+        for batch in reader:
+            batches += [batch]
+            batch_rows += batch.num_rows
+            if chunk_size is None or batch_rows < chunk_size:
+                continue
+
+            table = pyarrow.Table.from_batches(batches)
+            while table.num_rows >= chunk_size:
+                yield finish_table(table.slice(0, chunk_size), next_index)
+                next_index += chunk_size
+                table = table.slice(chunk_size)
+            batches = table.to_batches()
+            batch_rows = table.num_rows
+
+    if chunk_size is None or batch_rows > 0 or len(invalid_lines) > 0:
+        yield finish_table(pyarrow.Table.from_batches(batches, schema=reader.schema), next_index, last=True)
+
+# Compact binary format for the ETROC1 hits: a fixed size header followed by fixed width records
+etroc1_binary_magic = b"ETROC1BF"
+etroc1_binary_version = 1
+etroc1_binary_header_dtype = numpy.dtype([
+    ("magic", "S8"),
+    ("version", "<u4"),
+    ("record_size", "<u4"),
+    ("records", "<u8"),
+    ("layout", "S8"),  # The raw data layout the records were converted from, txt or dat (empty in the older files)
+])
+etroc1_binary_record_dtype = numpy.dtype([
+    ("data_board_id", "i1"),
+    ("time_of_arrival", "<i2"),
+    ("time_over_threshold", "<i2"),
+    ("calibration_code", "<i2"),
+    ("hit_flag", "?"),
+    ("timestamp", "<M8[s]"),  # NaT for the layouts without a timestamp
+])
+
+# The compressed raw data files are recognised from the first bytes of the file, not from the extension
+compression_magic_bytes = {
+    "gz": b"\x1f\x8b",
+    "bz2": b"BZh",
+    "xz": b"\xfd7zXZ\x00",
+    "zst": b"\x28\xb5\x2f\xfd",
+}
+
+def detect_compression(input_file: Path):
+    """
+    Returns the compression format of the file (one of the keys of
+    `compression_magic_bytes`) or `None` if the file is not compressed
+    """
+    with open(input_file, "rb") as file:
+        start = file.read(max(len(magic) for magic in compression_magic_bytes.values()))
+    for compression in compression_magic_bytes:
+        if start.startswith(compression_magic_bytes[compression]):
+            return compression
+    return None
+
+def decompress_stream(stream, compression: str):
+    """
+    Wrap a binary stream of compressed data in a stream of the
+    decompressed data, which is decompressed as it is read
+    """
+    if compression is None:
+        return stream
+    if compression == "gz":
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    if compression == "bz2":
+        return bz2.BZ2File(stream, mode="rb")
+    if compression == "xz":
+        return lzma.LZMAFile(stream, mode="rb")
+    if compression == "zst":
+        if zstandard is None:
+            raise RuntimeError("The zstandard module is needed to read zstd compressed files, install it with: python -m pip install zstandard")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(stream, closefd=True), buffer_size=1024*1024)
+    raise ValueError("Unknown compression format: {}".format(compression))
+
+def open_raw_data_file(input_file: Path):
+    """
+    Open a raw data file for reading in binary mode, transparently
+    decompressing it if it is compressed
+    """
+    return decompress_stream(open(input_file, "rb"), detect_compression(input_file))
+
+def strip_compression_suffix(input_file: Path):
+    """
+    Remove the compression extension from a file name, e.g. `run_Split_0.dat.gz` -> `run_Split_0.dat`
+    """
+    if input_file.suffix[1:] in compression_magic_bytes:
+        return input_file.with_suffix("")
+    return input_file
+
+def is_etroc1_binary_file(input_file: Path):
+    with open_raw_data_file(input_file) as file:
+        return file.read(len(etroc1_binary_magic)) == etroc1_binary_magic
+
+def open_etroc1_binary_file(input_file: Path):
+    """
+    Memory map the records of a binary ETROC1 file, returning a numpy
+    structured array with the `etroc1_binary_record_dtype` dtype
+    """
+    header = numpy.fromfile(input_file, dtype=etroc1_binary_header_dtype, count=1)[0]
+    if header["magic"] != etroc1_binary_magic:
+        raise RuntimeError("The file {} is not a binary ETROC1 file".format(input_file))
+    if header["version"] != etroc1_binary_version or header["record_size"] != etroc1_binary_record_dtype.itemsize:
+        raise RuntimeError("The binary ETROC1 file {} has an unsupported version ({}) or record size ({})".format(input_file, header["version"], header["record_size"]))
+
+    if header["records"] == 0:
+        return numpy.zeros(0, dtype=etroc1_binary_record_dtype)
+
+    return numpy.memmap(
+        input_file,
+        dtype=etroc1_binary_record_dtype,
+        mode="r",
+        offset=etroc1_binary_header_dtype.itemsize,
+        shape=(int(header["records"]),),
+    )
+
+def read_etroc1_binary_layout(input_file: Path):
+    """
+    Returns the raw data layout stored in the header of a binary ETROC1
+    file, or `None` for the older files which do not store it
+    """
+    header = numpy.fromfile(input_file, dtype=etroc1_binary_header_dtype, count=1)[0]
+    layout = header["layout"].decode(errors="replace")
+    if layout == "":
+        return None
+    return layout
+
+def write_etroc1_binary_header(file, records: int, layout: str):
+    header = numpy.zeros(1, dtype=etroc1_binary_header_dtype)
+    header["magic"] = etroc1_binary_magic
+    header["version"] = etroc1_binary_version
+    header["record_size"] = etroc1_binary_record_dtype.itemsize
+    header["records"] = records
+    header["layout"] = layout.encode()
+    file.write(header.tobytes())
+
+def etroc1_records_from_dataframe(df: pandas.DataFrame):
+    """
+    Convert a parsed dataframe, in the txt or dat layout, into binary records
+    """
+    records = numpy.zeros(len(df), dtype=etroc1_binary_record_dtype)
+    for column in etroc1_dat_columns:
+        records[column] = df[column].to_numpy()
+    if "day" in df and "time" in df:
+        records["timestamp"] = decode_timestamps(df["day"], df["time"]).to_numpy().astype("datetime64[s]")
+    else:
+        records["timestamp"] = numpy.datetime64("NaT")
+    return records
+
+def binary_parser(
+    input_file: Path,
+    columns: dict[str, str],
+    skip_rows: int = 0,  # The binary files do not have any rows to skip, kept for a common interface with the other parsers
+    chunk_size: int = None,
+    keep_only_triggers: bool = False,
+    board_ids: list[int] = None,
+    validate: bool = False,
+):
+    """
+    Reader for the binary ETROC1 files, the records are memory mapped so
+    only the chunk being processed is read from disk. If the requested
+    columns include the day and time, the timestamp is returned in the
+    `datetime` column instead. The row filters are applied on the records,
+    before building the dataframes. A file without records yields a single
+    empty dataframe, like the text parsers.
+    """
+    records = open_etroc1_binary_file(input_file)
+    if chunk_size is None:
+        chunk_size = max(len(records), 1)
+
+    for start in range(0, max(len(records), 1), chunk_size):
+        chunk = records[start:start + chunk_size]
+        index = pandas.RangeIndex(start, start + len(chunk))
+        mask = etroc1_row_mask(chunk["hit_flag"], chunk["data_board_id"], keep_only_triggers, board_ids)
+        if mask is not None:
+            index = pandas.Index(start + numpy.flatnonzero(mask))
+            chunk = chunk[mask]
+
+        df = pandas.DataFrame(
+            {column: numpy.asarray(chunk[column]) for column in columns if column in etroc1_dat_columns},
+            index=index,
+        )
+        if "day" in columns and "time" in columns:
+            df["datetime"] = numpy.asarray(chunk["timestamp"]).astype("datetime64[ns]")
+        quarantine_df = None
+        if validate:
+            df, quarantine_df = validate_etroc1_data(df, columns)
+        yield df, len(index) if mask is None else len(mask), quarantine_df
+
+parser_backends = {
+    "pandas": pandas_parser,
+    "pyarrow": pyarrow_parser,
+    "binary": binary_parser,
+}
+
+class HashingArchiveReader(io.RawIOBase):
+    """
+    Read only stream over a raw data file which, as the file is read,
+    computes the SHA-256 hash of its content and writes a gzip compressed
+    copy of it. This way the parser reads the file only once, instead of
+    it being copied to the backup location and then read again. Closing
+    the stream reads whatever the parser did not consume, so the hash and
+    the archive always cover the full file. Files which are already
+    compressed are archived as they are.
+    """
+    def __init__(self, input_file: Path, archive_file: Path, compress: bool = True):
+        self._input = open(input_file, "rb")
+        if compress:
+            self._archive = gzip.open(archive_file, "wb", compresslevel=1)  # Text compresses well even at the fastest level, which keeps up with the parsers
+        else:
+            self._archive = open(archive_file, "wb")
+        self.hash = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self._input.readinto(buffer)
+        if size:
+            data = memoryview(buffer)[:size]
+            self.hash.update(data)
+            self._archive.write(data)
+        return size
+
+    def close(self):
+        if not self.closed:
+            buffer = bytearray(1024*1024)
+            while self.readinto(buffer):
+                pass
+            self._input.close()
+            self._archive.close()
+        super().close()
+
+def archive_raw_data(
+    input_file: Path,
+    backup_directory: Path,
+):
+    """
+    Open a stream which reads `input_file` while archiving it, with its
+    hash, into `backup_directory`. See `HashingArchiveReader`. Once the
+    stream is closed, call `finish_raw_data_archive` to save the hash.
+    The stream returns the raw bytes of the file, even if it is compressed.
+    """
+    if detect_compression(input_file) is not None:
+        return HashingArchiveReader(input_file, backup_directory/input_file.name, compress=False)
+    return HashingArchiveReader(input_file, backup_directory/(input_file.name + ".gz"))
+
+def finish_raw_data_archive(
+    archive_reader: HashingArchiveReader,
+    input_file: Path,
+    backup_directory: Path,
+):
+    archive_reader.close()
+    with open(backup_directory/(input_file.name + ".sha256"), "w") as hash_file:
+        hash_file.write("{}  {}\n".format(archive_reader.hash.hexdigest(), input_file.name))
+
+def write_raw_data_hashes(
+    backup_directory: Path,
+    output_file: Path,
+):
+    """
+    Collect the hashes of all the archived raw data files into a single
+    file, in the format used by `sha256sum`
+    """
+    with open(output_file, "w") as out_file:
+        for hash_file in sorted(backup_directory.glob("*.sha256")):
+            out_file.write(hash_file.read_text())
+
+def compute_file_hash(input_file: Path):
+    file_hash = hashlib.sha256()
+    with open(input_file, "rb") as file:
+        for data in iter(lambda: file.read(1024*1024), b""):
+            file_hash.update(data)
+    return file_hash.hexdigest()
+
+def raw_data_changed(
+    hash_file: Path,
+    input_files: list[Path],
+):
+    """
+    Check if any of the raw data files differs from the hash recorded when
+    the run was processed (or was not processed at all)
+    """
+    if not hash_file.is_file():
+        return True
+
+    recorded_hashes = {}
+    for line in hash_file.read_text().splitlines():
+        file_hash, file_name = line.split(maxsplit=1)
+        recorded_hashes[file_name] = file_hash
+
+    for input_file in input_files:
+        if recorded_hashes.get(input_file.name) != compute_file_hash(input_file):
+            return True
+    return False
+
+def parse_etroc1_text(
+    data: bytes,
+    columns: dict[str, str],
+    parser: str = "pandas",
+    keep_only_triggers: bool = False,
+    board_ids: list[int] = None,
+    validate: bool = False,
+):
+    """
+    Parse a block of text raw data held in memory, returning the parsed
+    dataframe, the number of rows and the quarantined rows. When
+    validating, if the pyarrow parser finds a value it can not convert the
+    block is parsed again with the pandas parser, which puts the malformed
+    rows into quarantine.
+    """
+    options = {"keep_only_triggers": keep_only_triggers, "board_ids": board_ids, "validate": validate}
+    try:
+        return next(parser_backends[parser](io.BytesIO(data), columns, **options))
+    except pyarrow.ArrowInvalid:
+        if not validate or parser != "pyarrow":
+            raise
+        return next(pandas_parser(io.BytesIO(data), columns, **options))
+
+def log_parse_speed(
+    script_logger: logging.Logger,
+    parser: str,
+    rows: int,
+    seconds: float,
+):
+    if seconds > 0:
+        speed = rows/seconds
+    else:
+        speed = float("inf")
+    script_logger.info("Parsed {} rows in {:.3f} s with the {} parser ({:.0f} rows/s)".format(rows, seconds, parser, speed))
+
+def offset_quarantine_index(
+    quarantine_df: pandas.DataFrame,
+    offset: int,
+):
+    """
+    Shift the row numbers of the quarantined rows
+    """
+    quarantine_df.index = quarantine_df.index + offset
+    return quarantine_df
+
+def log_skipped_rows(
+    script_logger: logging.Logger,
+    input_file: Path,
+    rows: int,
+    kept_rows: int,
+    quarantine_dfs: list[pandas.DataFrame],
+    statistics: dict = None,
+):
+    quarantine_df = pandas.concat(quarantine_dfs) if len(quarantine_dfs) > 0 else None
+    quarantined_rows = 0
+    if quarantine_df is not None:
+        quarantined_rows = len(quarantine_df)
+    skipped_rows = rows - kept_rows - quarantined_rows
+
+    script_logger.info("Read {} rows from {}, skipped {} rows while parsing, kept {} rows".format(rows, input_file.name, skipped_rows, kept_rows))
+    if quarantine_df is not None:
+        script_logger.warning("{} rows of {} failed the validation and were put into quarantine, per reason:\n{}".format(quarantined_rows, input_file.name, quarantine_df["reason"].value_counts().loc[lambda counts: counts > 0]))
+    if statistics is not None:
+        statistics["rows"] = rows
+        statistics["skipped_rows"] = skipped_rows
+        statistics["quarantined_rows"] = quarantined_rows
+        statistics["kept_rows"] = kept_rows
+        statistics["quarantine"] = quarantine_df
+
+def iterate_etroc1_raw_data(
+    input_file: Path,
+    columns: dict[str, str],
+    script_logger: logging.Logger,
+    parser: str = "pandas",
+    skip_rows: int = 0,
+    chunk_size: int = None,
+    backup_directory: Path = None,
+    keep_only_triggers: bool = False,
+    board_ids: list[int] = None,
+    statistics: dict = None,
+    validate: bool = False,
+):
+    """
+    Read a raw data file with the chosen parser backend (binary ETROC1
+    files are detected and always read with the binary backend), yielding
+    dataframes of at most `chunk_size` rows (or a single dataframe with
+    the whole file if `chunk_size` is `None`) with the columns already
+    converted to the types in `columns`. Once all the file has been read,
+    the parsing speed is reported through the logger.
+
+    The rows without the hit flag (if `keep_only_triggers`) and the rows
+    from boards not in `board_ids` (if set) are dropped by the parser
+    while reading, the kept rows keep their row number in the file as
+    index. The number of rows read and skipped is reported through the
+    logger and, if a `statistics` dictionary is given, saved into it.
+
+    If `validate` is set, the kept rows are checked with
+    `validate_etroc1_data` and the invalid rows are removed, they are
+    saved in the `quarantine` entry of the `statistics` dictionary.
+
+    If `backup_directory` is set, a compressed copy of the file and its
+    hash are saved there while the file is parsed. Compressed files (gz,
+    bz2, xz or zst) are decompressed on the fly while they are parsed.
+    """
+    compression = detect_compression(input_file)
+    if is_etroc1_binary_file(input_file):
+        if compression is not None:
+            raise RuntimeError("The binary ETROC1 file {} is compressed, it must be decompressed first since the binary files are memory mapped".format(input_file))
+        parser = "binary"
+    if parser not in parser_backends:
+        raise ValueError("Unknown parser backend {}, the available backends are: {}".format(parser, list(parser_backends)))
+
+    raw_stream = None  # Stream with the raw bytes of the file, if the parser does not read the file directly
+    archive_reader = None
+    if backup_directory is not None:
+        archive_reader = archive_raw_data(input_file, backup_directory)
+        if parser == "binary":  # The binary files are memory mapped, so they can not be parsed from the stream
+            finish_raw_data_archive(archive_reader, input_file, backup_directory)
+            archive_reader = None
+        else:
+            raw_stream = io.BufferedReader(archive_reader, buffer_size=1024*1024)
+    elif compression is not None:
+        raw_stream = open(input_file, "rb")
+
+    source = input_file
+    if raw_stream is not None:
+        if compression is not None:
+            script_logger.info("The file {} is {} compressed, decompressing it while reading".format(input_file.name, compression))
+        source = decompress_stream(raw_stream, compression)
+
+    try:
+        reader = parser_backends[parser](source, columns, skip_rows=skip_rows, chunk_size=chunk_size, keep_only_triggers=keep_only_triggers, board_ids=board_ids, validate=validate)
+
+        rows = 0
+        kept_rows = 0
+        quarantine_dfs = []
+        parse_time = 0
+        chunks = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                parsed = next(reader, None)
+            except pyarrow.ArrowInvalid as error:
+                # The pyarrow parser can not put values which are not numbers into quarantine, so if
+                # nothing was returned yet, start over with the pandas parser (the archive is still completed)
+                if not validate or parser != "pyarrow" or chunks > 0:
+                    raise
+                script_logger.warning("The pyarrow parser could not convert the data of {} ({}), parsing it again with the pandas parser".format(input_file.name, error))
+                if raw_stream is not None:
+                    source.close()
+                    raw_stream.close()
+                raw_stream = open(input_file, "rb")
+                source = decompress_stream(raw_stream, compression)
+                parser = "pandas"
+                reader = parser_backends[parser](source, columns, skip_rows=skip_rows, chunk_size=chunk_size, keep_only_triggers=keep_only_triggers, board_ids=board_ids, validate=validate)
+                continue
+            parse_time += time.perf_counter() - start
+            if parsed is None:
+                break
+            chunks += 1
+            df, rows_read, quarantine_df = parsed
+            rows += rows_read
+            kept_rows += len(df)
+            if quarantine_df is not None:
+                quarantine_dfs += [quarantine_df]
+            yield df
+
+        log_parse_speed(script_logger, parser, rows, parse_time)
+        log_skipped_rows(script_logger, input_file, rows, kept_rows, quarantine_dfs, statistics)
+    finally:
+        if raw_stream is not None:
+            source.close()
+            raw_stream.close()
+        if archive_reader is not None:
+            finish_raw_data_archive(archive_reader, input_file, backup_directory)
+
+def follow_etroc1_raw_data(
+    input_file: Path,
+    columns: dict[str, str],
+    script_logger: logging.Logger,
+    parser: str = "pandas",
+    skip_rows: int = 0,
+    poll_interval: float = 10,
+    idle_timeout: float = 300,
+    backup_directory: Path = None,
+    keep_only_triggers: bool = False,
+    board_ids: list[int] = None,
+    statistics: dict = None,
+    validate: bool = False,
+):
+    """
+    Follow a raw data file which is still being written, like `tail -f`.
+    Every `poll_interval` seconds the lines appended to the file since the
+    previous poll are parsed and yielded as a dataframe, a partially
+    written line is kept until it is complete. The index keeps running
+    across the yielded dataframes and the rows are filtered and validated
+    while they are parsed, like with `iterate_etroc1_raw_data`.
+    Following stops once the file has not grown for `idle_timeout`
+    seconds, or if the file is rotated (removed, replaced or truncated).
+    """
+    if parser not in parser_backends or parser == "binary":
+        raise ValueError("Unknown parser backend {} for following a text file, the available backends are: {}".format(parser, [backend for backend in parser_backends if backend != "binary"]))
+    if detect_compression(input_file) is not None or is_etroc1_binary_file(input_file):
+        raise RuntimeError("Only uncompressed text files can be followed, {} is not one".format(input_file))
+
+    file_id = os.stat(input_file).st_ino
+    if backup_directory is not None:
+        stream = archive_raw_data(input_file, backup_directory)
+    else:
+        stream = open(input_file, "rb", buffering=0)
+
+    pending = b""  # Incomplete line at the end of the data read so far
+    lines_to_skip = skip_rows
+    bytes_read = 0
+    next_index = 0
+    rows = 0
+    kept_rows = 0
+    quarantine_dfs = []
+    parse_time = 0
+    last_data_time = time.monotonic()
+    try:
+        while True:
+            data = stream.read()
+            if data:
+                bytes_read += len(data)
+                last_data_time = time.monotonic()
+            else:
+                try:
+                    stat = os.stat(input_file)
+                    rotated = stat.st_ino != file_id or stat.st_size < bytes_read
+                except FileNotFoundError:
+                    rotated = True
+                if rotated:
+                    script_logger.info("The file {} was rotated, stop following it".format(input_file))
+                    break
+                if time.monotonic() - last_data_time > idle_timeout:
+                    script_logger.info("The file {} did not grow in the last {} seconds, stop following it".format(input_file, idle_timeout))
+                    break
+
+            data = pending + data
+            end = data.rfind(b"\n") + 1
+            pending = data[end:]
+            data = data[:end]
+            while lines_to_skip > 0 and len(data) > 0:
+                data = data[data.find(b"\n") + 1:]
+                lines_to_skip -= 1
+
+            if len(data) > 0:
+                start = time.perf_counter()
+                df, rows_read, quarantine_df = parse_etroc1_text(data, columns, parser, keep_only_triggers=keep_only_triggers, board_ids=board_ids, validate=validate)
+                parse_time += time.perf_counter() - start
+                df.index = df.index + next_index
+                if quarantine_df is not None:
+                    quarantine_dfs += [offset_quarantine_index(quarantine_df, next_index)]
+                next_index += rows_read
+                rows += rows_read
+                kept_rows += len(df)
+                script_logger.info("Read {} new rows from {}, kept {} rows".format(rows_read, input_file.name, len(df)))
+                yield df
+
+            time.sleep(poll_interval)
+
+        if len(pending) > 0 and lines_to_skip == 0:  # The last line of the file may not have an end of line
+            start = time.perf_counter()
+            df, rows_read, quarantine_df = parse_etroc1_text(pending, columns, parser, keep_only_triggers=keep_only_triggers, board_ids=board_ids, validate=validate)
+            parse_time += time.perf_counter() - start
+            df.index = df.index + next_index
+            if quarantine_df is not None:
+                quarantine_dfs += [offset_quarantine_index(quarantine_df, next_index)]
+            rows += rows_read
+            kept_rows += len(df)
+            yield df
+
+        log_parse_speed(script_logger, parser, rows, parse_time)
+        log_skipped_rows(script_logger, input_file, rows, kept_rows, quarantine_dfs, statistics)
+    finally:
+        if backup_directory is not None:
+            finish_raw_data_archive(stream, input_file, backup_directory)
+        else:
+            stream.close()
+
+def read_etroc1_raw_data(
+    input_file: Path,
+    columns: dict[str, str],
+    script_logger: logging.Logger,
+    parser: str = "pandas",
+    skip_rows: int = 0,
+    backup_directory: Path = None,
+    keep_only_triggers: bool = False,
+    board_ids: list[int] = None,
+    statistics: dict = None,
+    validate: bool = False,
+):
+    """
+    Read a full raw data file into a single dataframe, see `iterate_etroc1_raw_data`
+    """
+    df = None
+    for df in iterate_etroc1_raw_data(
+        input_file,
+        columns,
+        script_logger,
+        parser=parser,
+        skip_rows=skip_rows,
+        backup_directory=backup_directory,
+        keep_only_triggers=keep_only_triggers,
+        board_ids=board_ids,
+        statistics=statistics,
+        validate=validate,
+    ):
+        pass
+    return df
+
+def read_etroc1_raw_data_with_statistics(
+    input_file: Path,
+    columns: dict[str, str],
+    script_logger: logging.Logger,
+    **kwargs,
+):
+    """
+    Same as `read_etroc1_raw_data`, but returns the parsing statistics
+    together with the dataframe, for when the file is read in another process
+    """
+    statistics = {}
+    df = read_etroc1_raw_data(input_file, columns, script_logger, statistics=statistics, **kwargs)
+    return df, statistics
+
+def find_byte_ranges(
+    input_file: Path,
+    ranges: int,
+    skip_rows: int = 0,
+):
+    """
+    Split a text file, after its first `skip_rows` lines, into at most
+    `ranges` byte ranges of similar size, with all the boundaries at the
+    start of a line. Returns a list of (start, end) tuples.
+    """
+    size = input_file.stat().st_size
+    with open(input_file, "rb") as file:
+        for _ in range(skip_rows):
+            file.readline()
+        first = file.tell()
+
+        boundaries = [first]
+        for idx in range(1, ranges):
+            position = first + (size - first) * idx // ranges
+            file.seek(max(position - 1, boundaries[-1]))  # Start one byte before, so a line starting exactly at the position is not skipped
+            file.readline()
+            position = file.tell()
+            if boundaries[-1] < position < size:
+                boundaries += [position]
+        boundaries += [size]
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+def parse_etroc1_byte_range(
+    input_file: Path,
+    columns: dict[str, str],
+    start: int,
+    end: int,
+    parser: str = "pandas",
+    keep_only_triggers: bool = False,
+    board_ids: list[int] = None,
+    validate: bool = False,
+):
+    with open(input_file, "rb") as file:
+        file.seek(start)
+        data = file.read(end - start)
+    return parse_etroc1_text(data, columns, parser, keep_only_triggers=keep_only_triggers, board_ids=board_ids, validate=validate)
+
+def read_etroc1_raw_data_parallel(
+    input_file: Path,
+    columns: dict[str, str],
+    script_logger: logging.Logger,
+    parser: str = "pandas",
+    skip_rows: int = 0,
+    max_workers: int = None,
+    backup_directory: Path = None,
+    keep_only_triggers: bool = False,
+    board_ids: list[int] = None,
+    statistics: dict = None,
+    validate: bool = False,
+):
+    """
+    Read a single large text raw data file in parallel with a process
+    pool: the file is split into byte ranges aligned to the start of the
+    lines, one per process, which are parsed independently and then merged
+    in file order, so the result is the same as with `read_etroc1_raw_data`.
+    Compressed and binary files can not be split, so they are read by a
+    single process. If `backup_directory` is set, the file is archived
+    while the byte ranges are parsed.
+    """
+    if detect_compression(input_file) is not None or is_etroc1_binary_file(input_file):
+        script_logger.info("The file {} can not be split into byte ranges, reading it in a single process".format(input_file.name))
+        return read_etroc1_raw_data(
+            input_file,
+            columns,
+            script_logger,
+            parser=parser,
+            skip_rows=skip_rows,
+            backup_directory=backup_directory,
+            keep_only_triggers=keep_only_triggers,
+            board_ids=board_ids,
+            statistics=statistics,
+            validate=validate,
+        )
+    if parser not in parser_backends or parser == "binary":
+        raise ValueError("Unknown parser backend {} for a text file, the available backends are: {}".format(parser, [backend for backend in parser_backends if backend != "binary"]))
+
+    if max_workers is None:
+        max_workers = os.cpu_count()
+    byte_ranges = find_byte_ranges(input_file, max_workers, skip_rows=skip_rows)
+    script_logger.info("Parsing {} in {} byte ranges with {} processes".format(input_file.name, len(byte_ranges), max_workers))
+
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(parse_etroc1_byte_range, input_file, columns, range_start, range_end, parser, keep_only_triggers, board_ids, validate) for range_start, range_end in byte_ranges]
+        if backup_directory is not None:
+            finish_raw_data_archive(archive_raw_data(input_file, backup_directory), input_file, backup_directory)
+        results = [future.result() for future in futures]
+
+    # Merge in file order, continuing the row numbers of each range from the previous one
+    dfs = []
+    quarantine_dfs = []
+    rows = 0
+    for df, rows_read, quarantine_df in results:
+        df.index = df.index + rows
+        if quarantine_df is not None:
+            quarantine_dfs += [offset_quarantine_index(quarantine_df, rows)]
+        rows += rows_read
+        dfs += [df]
+    del results
+    df = pandas.concat(dfs).astype(columns)  # The categories differ between ranges
+    del dfs
+    parse_time = time.perf_counter() - start
+
+    log_parse_speed(script_logger, parser, rows, parse_time)
+    log_skipped_rows(script_logger, input_file, rows, len(df), quarantine_dfs, statistics)
+    return df
+
+def decode_timestamps(
+    day: pandas.Series,
+    time: pandas.Series,
+):
+    """
+    Combine the day (YYYY-MM-DD) and time (HH:MM:SS) columns into a
+    datetime column. Each distinct day and each distinct time is only
+    parsed once, the result is then broadcast back to the rows through the
+    integer codes of the values, so no string is built per row.
+    """
+    day_codes, day_values = pandas.factorize(day)
+    time_codes, time_values = pandas.factorize(time)
+
+    days = pandas.to_datetime(day_values, format='%Y-%m-%d').to_numpy()
+    times = pandas.to_timedelta(time_values).to_numpy()
+
+    datetime = days[day_codes] + times[time_codes]
+    datetime[(day_codes < 0) | (time_codes < 0)] = numpy.datetime64("NaT")
+
+    return pandas.Series(datetime, index=day.index)
+
+# The charge injection data of a single run may be split into several files: [run name]_Split_[N].dat
+# (or .bin, once converted into the binary format), optionally compressed: [run name]_Split_[N].dat.gz
+split_file_regex = re.compile(r"^(?P<run_name>.*)_Split_(?P<split>\d+)\.(?P<extension>dat|bin)(?P<compression>\.(gz|bz2|xz|zst))?$")
+
+def find_run_splits(input_file: Path):
+    """
+    Given the file of one split of a run, find the files of all the splits
+    of that run in the same directory, sorted by split number. Returns a
+    list of (split number, file path) tuples.
+    """
+    match = split_file_regex.match(input_file.name)
+    if match is None:
+        return [(0, input_file)]
+
+    splits = []
+    for file in input_file.parent.iterdir():
+        file_match = split_file_regex.match(file.name)
+        if file.is_file() and file_match is not None and file_match.group("run_name") == match.group("run_name") and file_match.group("extension") == match.group("extension") and file_match.group("compression") == match.group("compression"):
+            splits += [(int(file_match.group("split")), file)]
+
+    return sorted(splits)
+
+def is_first_split_file(file: Path):
+    match = split_file_regex.match(file.name)
+    return match is not None and match.group("split") == "0"
+
+def get_split_run_name(file: Path):
+    """
+    Get the run name from the file name of one of its splits, e.g.
+    `[run name]_Split_0.dat.gz` -> `[run name]`
+    """
+    match = split_file_regex.match(file.name)
+    if match is None:
+        raise ValueError("The file {} is not a split of a charge injection run".format(file))
+    return match.group("run_name")
+
+def read_etroc1_raw_data_files(
+    input_files: list[Path],
+    columns: dict[str, str],
+    script_logger: logging.Logger,
+    parser: str = "pandas",
+    max_workers: int = None,
+    backup_directory: Path = None,
+    keep_only_triggers: bool = False,
+    board_ids: list[int] = None,
+    validate: bool = False,
+):
+    """
+    Read several raw data files in parallel with a process pool, the
+    returned list of (dataframe, parsing statistics) tuples is in the same
+    order as `input_files`.
+    """
+    kwargs = {
+        "parser": parser,
+        "backup_directory": backup_directory,
+        "keep_only_triggers": keep_only_triggers,
+        "board_ids": board_ids,
+        "validate": validate,
+    }
+    if len(input_files) == 1:
+        return [read_etroc1_raw_data_with_statistics(input_files[0], columns, script_logger, **kwargs)]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(read_etroc1_raw_data_with_statistics, file, columns, script_logger, **kwargs) for file in input_files]
+        return [future.result() for future in futures]
+
+def match_event_pattern(
+    board_ids: numpy.ndarray,
+    pattern: list[int],
+):
+    """
+    Find where the sequence of board ids in `pattern` occurs in
+    `board_ids`, returning the sorted start positions of the matches.
+    The comparison is done with one vectorized pass over the data for
+    each element of the pattern, so no temporaries larger than the data
+    are created.
+
+    If the pattern can overlap with itself (e.g. [0,1,0]), overlapping
+    matches are resolved deterministically by keeping the leftmost match
+    and dropping any match which starts before the end of a kept match.
+    """
+    N = len(pattern)
+    n_windows = len(board_ids) - N + 1
+    if n_windows <= 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+
+    matched = numpy.ones(n_windows, dtype=bool)
+    for offset in range(N):
+        matched &= (board_ids[offset:offset + n_windows] == pattern[offset])
+    starts = numpy.flatnonzero(matched)
+
+    if len(starts) < 2 or numpy.diff(starts).min() >= N:
+        return starts
+
+    # There are overlapping matches: the matches which do not overlap any other are kept as they
+    # are, then a single greedy pass over the matches of the overlapping groups keeps the leftmost ones.
+    # The groups are separated by at least one pattern length, so they do not affect each other.
+    overlaps_next = numpy.diff(starts) < N
+    in_group = numpy.zeros(len(starts), dtype=bool)
+    in_group[:-1] |= overlaps_next
+    in_group[1:] |= overlaps_next
+    selected = ~in_group
+
+    kept_end = -1
+    for idx, start in zip(numpy.flatnonzero(in_group).tolist(), starts[in_group].tolist()):
+        if start >= kept_end:
+            selected[idx] = True
+            kept_end = start + N
+
+    return starts[selected]
+
+def assign_pattern_events(
+    n_rows: int,
+    starts: numpy.ndarray,
+    pattern_length: int,
+    first_event: int = 0,
+):
+    """
+    Build the event id of each row, given the start positions of the
+    pattern matches. The rows of each match get the same event id,
+    counting up from `first_event`, and rows which are not part of any
+    match get the event id -1.
+    """
+    event_ids = numpy.full(n_rows, -1, dtype=numpy.int64)
+    match_rows = starts[:, numpy.newaxis] + numpy.arange(pattern_length)
+    event_ids[match_rows] = numpy.arange(first_event, first_event + len(starts))[:, numpy.newaxis]
+    return event_ids
+
+def pattern_match_statistics(
+    board_ids: numpy.ndarray,
+    event_ids: numpy.ndarray,
+):
+    """
+    Count, per board, the hits which were matched into an event and the
+    orphaned hits which were not part of any event.
+    """
+    stats_df = pandas.DataFrame({
+        "data_board_id": board_ids,
+        "matched_hits": event_ids >= 0,
+        "orphaned_hits": event_ids < 0,
+    })
+    stats_df = stats_df.groupby("data_board_id").sum()
+    stats_df["hits"] = stats_df["matched_hits"] + stats_df["orphaned_hits"]
+    return stats_df[["hits", "matched_hits", "orphaned_hits"]].astype("int64")
+
+def find_board_sequences(
+    board_ids: numpy.ndarray,
+    timestamps: numpy.ndarray,
+    board_order: list[int],
+    max_time_difference: float = 1,
+):
+    """
+    Split the hits into groups of consecutive rows where the boards follow
+    the readout order in `board_order`, each board at most once but
+    allowing missing boards, and with the timestamps of consecutive hits no
+    more than `max_time_difference` seconds apart (missing timestamps are
+    ignored). A new group starts whenever a board does not come after the
+    previous one in the readout order. Hits from boards which are not in
+    `board_order` are always a group on their own. The whole split is done
+    in a single vectorized pass, returning the start position of each group.
+    """
+    if len(board_ids) == 0:
+        return numpy.zeros(0, dtype=numpy.int64)
+
+    order_position = numpy.full(len(board_ids), len(board_order), dtype=numpy.int64)
+    for position, board in enumerate(board_order):
+        order_position[board_ids == board] = position
+    unknown_board = order_position == len(board_order)
+
+    new_group = numpy.ones(len(board_ids), dtype=bool)
+    new_group[1:] = order_position[1:] <= order_position[:-1]
+    new_group |= unknown_board
+
+    if timestamps is not None:
+        time_difference = numpy.abs(numpy.diff(timestamps.astype("datetime64[ns]")))
+        new_group[1:] |= time_difference > numpy.timedelta64(int(max_time_difference * 1e9), "ns")  # Comparisons with NaT are always False
+
+    return numpy.flatnonzero(new_group)
+
+def assign_sequence_events(
+    board_ids: numpy.ndarray,
+    group_starts: numpy.ndarray,
+    board_order: list[int],
+    min_boards: int = 2,
+    first_event: int = 0,
+):
+    """
+    Build the event id of each row, given the start positions of the
+    groups found by `find_board_sequences`. Groups with at least
+    `min_boards` boards become events, with ids counting up from
+    `first_event`, the rows of the other groups get the event id -1.
+    Also returns, for each row, the boards present in its event as a
+    bitmask of the board ids (0 for the rows not in an event), so all the
+    subsets of boards are built in a single pass and can be selected later.
+    """
+    n_rows = len(board_ids)
+    group_sizes = numpy.diff(numpy.append(group_starts, n_rows))
+
+    board_bits = numpy.left_shift(1, board_ids.astype(numpy.int32))
+    board_bits[~numpy.isin(board_ids, board_order)] = 0
+    group_boards = numpy.bitwise_or.reduceat(board_bits, group_starts) if n_rows > 0 else numpy.zeros(0, dtype=numpy.int32)
+
+    is_event = (group_sizes >= min_boards) & (group_boards != 0)
+    group_event_ids = numpy.full(len(group_starts), -1, dtype=numpy.int64)
+    group_event_ids[is_event] = numpy.arange(first_event, first_event + is_event.sum())
+
+    event_ids = numpy.repeat(group_event_ids, group_sizes)
+    event_boards = numpy.repeat(numpy.where(is_event, group_boards, 0), group_sizes).astype(numpy.int32)
+    return event_ids, event_boards
+
+def event_boards_statistics(event_boards: numpy.ndarray):
+    """
+    Count the events built for each combination of boards, given the
+    boards bitmask of the first row of each event
+    """
+    stats_df = pandas.Series(event_boards).value_counts().sort_index().rename("events").to_frame()
+    stats_df.index.name = "event_boards"
+    stats_df["boards"] = [",".join(str(board) for board in range(int(mask).bit_length()) if (int(mask) >> board) & 1) for mask in stats_df.index]
+    return stats_df[["boards", "events"]]
+
+# The board numbering goes 0 - 1 - 3, but the fields in the file names are sequential
+etroc1_board_ids = [0, 1, 3]
+
+def get_txt_run_board_info(file_name: str):
+    """
+    Parse the metadata of each board from the name of a txt file, e.g.
+    `F5P5_F17P5_B3P5_Beam.txt`, into a table with one row per board
+    """
+    info = file_name.split('_')
+
+    board_info_df = pandas.DataFrame(
+        {"pixel_id": [info[board_idx] for board_idx in range(len(etroc1_board_ids))]},
+        index=pandas.Index(etroc1_board_ids, name="data_board_id"),
+    )
+    board_info_df["pixel_id"] = board_info_df["pixel_id"].astype("category")
+
+    return board_info_df
+
+def get_charge_injection_run_board_info(run_name: str):
+    """
+    Parse the metadata of each board from the name of a charge injection
+    run, e.g. `ETROC1_Run_PhaseAdj12_F5P5_QSel20_DAC535_F17P5_QSel20_DAC720_B3P5_QSel20_DAC720`
+    (optionally followed by the split and extension), into a table with
+    one row per board
+    """
+    info = run_name.split('_')
+
+    rows = []
+    for board_idx in range(len(etroc1_board_ids)):
+        base_info_idx = (board_idx + 1) * 3
+        rows += [{
+            "phase_adjust": info[2][8:],
+            "pixel_id": info[base_info_idx],
+            "board_injected_charge": info[base_info_idx+1][4:],
+            "board_discriminator_threshold": info[base_info_idx+2][3:],
+        }]
+
+    board_info_df = pandas.DataFrame(rows, index=pandas.Index(etroc1_board_ids, name="data_board_id"))
+    board_info_df = board_info_df.astype({
+        "phase_adjust": "int8",
+        "pixel_id": "category",
+        "board_injected_charge": "int16",
+        "board_discriminator_threshold": "int16",
+    })
+
+    return board_info_df
+
+def annotate_board_info(
+    df: pandas.DataFrame,
+    board_info_df: pandas.DataFrame,
+    script_logger: logging.Logger,
+):
+    """
+    Add the columns of `board_info_df` to `df`, matching the rows through
+    the `data_board_id` column. The columns keep the dtypes of the board
+    info table. Rows from boards not in the table get missing values.
+    """
+    unknown_boards = ~df["data_board_id"].isin(board_info_df.index)
+    if unknown_boards.any():
+        script_logger.warning("There is data from board ids without metadata ({}), the metadata of those rows will be left empty".format(sorted(df.loc[unknown_boards, "data_board_id"].unique())))
+
+    for column in board_info_df.columns:
+        df[column] = df["data_board_id"].map(board_info_df[column])
+
+def is_etroc1_txt_line(fields: list[str]):
+    return len(fields) == 7 and all(field.isdigit() for field in fields[:5]) and re.fullmatch(r"\d{4}-\d{2}-\d{2}", fields[5]) is not None
+
+def is_etroc1_dat_line(fields: list[str]):
+    return len(fields) == 5 and all(field.isdigit() for field in fields)
+
+# The raw data formats which can be ingested, each one declares:
+#  - description: a short description of the format
+#  - columns: the columns of the file, with the dtype each column is stored with
+#  - skip_rows: the number of header lines at the start of the file
+#  - parsers: the parser backends which can read the format (the binary files are always read with the binary backend)
+#  - board_info: function returning the metadata of each board, from the name of the file
+#  - event_builders: the methods to build the events from the hits, the first one is the default
+#  - script: the ingest script which processes a run in this format
+#  - detect: function which tells if a line of the file, split into fields, is a line of data of this format
+raw_data_formats = {
+    "txt": {
+        "description": "summary of a beam or cosmic run, from the KC705 board",
+        "columns": etroc1_txt_columns,
+        "skip_rows": 1,
+        "parsers": ["pandas", "pyarrow"],
+        "board_info": get_txt_run_board_info,
+        "event_builders": ["pattern", "sequence"],
+        "script": "process_etroc1_single_run_txt",
+        "detect": is_etroc1_txt_line,
+    },
+    "dat": {
+        "description": "charge injection run, possibly split into several files",
+        "columns": etroc1_dat_columns,
+        "skip_rows": 0,
+        "parsers": ["pandas", "pyarrow"],
+        "board_info": get_charge_injection_run_board_info,
+        "event_builders": ["sequential"],
+        "script": "process_etroc1_single_charge_injection_run",
+        "detect": is_etroc1_dat_line,
+    },
+}
+
+def detect_raw_data_format(
+    input_file: Path,
+    lines_to_check: int = 5,
+):
+    """
+    Find the format of a raw data file from its content, returning the name
+    of the format in `raw_data_formats` or `None` if it is not recognised.
+    For text files (compressed or not) the first lines are checked against
+    each format, the binary files store the layout they were converted
+    from in their header (the older files, without it, are from txt files
+    if they have timestamps).
+    """
+    if is_etroc1_binary_file(input_file):
+        layout = read_etroc1_binary_layout(input_file)
+        if layout in raw_data_formats:
+            return layout
+        records = open_etroc1_binary_file(input_file)
+        if len(records) > 0 and not numpy.isnat(records["timestamp"][0]):
+            return "txt"
+        return "dat"
+
+    with open_raw_data_file(input_file) as file:
+        for _ in range(lines_to_check):
+            line = file.readline()
+            if len(line) == 0:
+                break
+            fields = line.decode(errors="replace").split()
+            for data_format in raw_data_formats:
+                if raw_data_formats[data_format]["detect"](fields):
+                    return data_format
+    return None
+
+def check_raw_data_format(
+    input_file: Path,
+    data_format: str,
+    script_logger: logging.Logger,
+):
+    """
+    Make sure a raw data file is in the format expected by a script
+    """
+    detected_format = detect_raw_data_format(input_file)
+    if detected_format is None:
+        script_logger.warning("Could not detect the format of {}, assuming it is a {} file".format(input_file.name, data_format))
+    elif detected_format != data_format:
+        raise RuntimeError("The file {} is a {} file ({}), not a {} file. Process it with the {}.py script".format(input_file.name, detected_format, raw_data_formats[detected_format]["description"], data_format, raw_data_formats[detected_format]["script"]))
+
+if __name__ == '__main__':
+    print("This is not a standalone script to run, it provides utilities which are run automatically as a part of the other scripts")
@@ -0,0 +1,126 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
+                         #   https://docs.python.org/3/library/pathlib.html
+
+import logging
+
+from storage_utilities import storage_backends
+from storage_utilities import default_storage_backend
+from storage_utilities import migrate_data_directory
+
+def find_data_directories(run_directory: Path):
+    """
+    Find all the directories of a run, including the run directory itself,
+    which hold tables of any backend
+    """
+    data_dirs = []
+    for directory in [run_directory] + sorted(run_directory.rglob("*")):
+        if not directory.is_dir() or directory.suffix in [".arrow", ".parquet"] or any(parent.suffix in [".arrow", ".parquet"] for parent in directory.parents):
+            continue
+        if any(directory.glob("*.sqlite")) or any(path.is_dir() for path in directory.glob("*.parquet")) or any(path.is_dir() for path in directory.glob("*.arrow")):
+            data_dirs += [directory]
+    return data_dirs
+
+def script_main(
+        run_directory:Path,
+        backend:str=default_storage_backend,
+        keep_old_data:bool=False,
+        ):
+
+    script_logger = logging.getLogger('migrate_storage')
+
+    if not run_directory.is_dir():
+        script_logger.info("The run directory should be an existing directory")
+        return
+
+    if backend not in storage_backends:
+        raise RuntimeError("Unknown storage backend: {}".format(backend))
+
+    converted = 0
+    for data_dir in find_data_directories(run_directory.resolve()):
+        converted += migrate_data_directory(data_dir, backend, script_logger, keep_old_data=keep_old_data)
+
+    script_logger.info("Converted {} table(s) into the {} format".format(converted, backend))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Converts the data of existing run directories (or directories with several runs, like the charge injection directories) from one storage format into another')
+    parser.add_argument(
+        '-o',
+        '--out-directory',
+        metavar = 'path',
+        help = 'Path to the output directory of the run(s) to convert. Default: ./out',
+        default = "./out",
+        dest = 'out_directory',
+        type = str,
+    )
+    parser.add_argument(
+        '-l',
+        '--log-level',
+        help = 'Set the logging level. Default: WARNING',
+        choices = ["CRITICAL","ERROR","WARNING","INFO","DEBUG","NOTSET"],
+        default = "WARNING",
+        dest = 'log_level',
+    )
+    parser.add_argument(
+        '--log-file',
+        help = 'If set, the full log will be saved to a file (i.e. the log level is ignored)',
+        action = 'store_true',
+        dest = 'log_file',
+    )
+    parser.add_argument(
+        '--to',
+        help = "The storage format to convert the data into. Default: arrow",
+        choices = storage_backends,
+        default = default_storage_backend,
+        dest = 'backend',
+    )
+    parser.add_argument(
+        '-k',
+        '--keep-old',
+        help = "If set, the data in the old format is kept after it is converted, by default it is removed",
+        action = 'store_true',
+        dest = 'keep_old',
+    )
+
+    args = parser.parse_args()
+
+    if args.log_file:
+        logging.basicConfig(filename='logging.log', filemode='w', encoding='utf-8', level=logging.NOTSET)
+    else:
+        if args.log_level == "CRITICAL":
+            logging.basicConfig(level=50)
+        elif args.log_level == "ERROR":
+            logging.basicConfig(level=40)
+        elif args.log_level == "WARNING":
+            logging.basicConfig(level=30)
+        elif args.log_level == "INFO":
+            logging.basicConfig(level=20)
+        elif args.log_level == "DEBUG":
+            logging.basicConfig(level=10)
+        elif args.log_level == "NOTSET":
+            logging.basicConfig(level=0)
+
+    script_main(Path(args.out_directory), backend=args.backend, keep_old_data=args.keep_old)
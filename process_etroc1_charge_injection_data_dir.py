@@ -29,9 +29,30 @@ import logging
 import shutil
 from datetime import datetime
 import pandas
-import sqlite3
 from process_etroc1_single_charge_injection_run import script_main as process_single_run
 from cut_etroc1_single_run import script_main as cut_single_run
+from ingest_utilities import raw_data_formats
+from ingest_utilities import detect_raw_data_format
+from ingest_utilities import annotate_board_info
+from ingest_utilities import is_first_split_file
+from ingest_utilities import get_split_run_name
+from ingest_utilities import find_run_splits
+from ingest_utilities import read_etroc1_raw_data_files
+from ingest_utilities import write_raw_data_hashes
+from storage_utilities import storage_backends
+from storage_utilities import default_storage_backend
+from storage_utilities import read_table
+from storage_utilities import write_table
+from storage_utilities import open_table_writer
+from storage_utilities import find_table_backend
+from storage_utilities import has_table
+from storage_utilities import TableView
+from storage_utilities import has_filter
+from storage_utilities import read_filter
+from storage_utilities import write_filter
+from utilities import plot_etroc1_task
+from cut_etroc1_single_run import apply_event_cuts
+from cut_etroc1_single_run import event_cuts_columns
 
 import plotly.express as px
 
@@ -45,6 +66,132 @@ def apply_cuts_to_single_runs_subtask(
         # Apply cuts
         cut_single_run(file_directory, drop_old_data=True, make_plots=make_plots)
 
+def write_default_cuts_file(file_path: Path):
+    """
+    Build a basic cuts.csv file, which only removes the hits without a
+    proper calibration code
+    """
+    with file_path.open("w") as cuts_file:
+        cuts_file.write("board_id,variable,cut_type,cut_value,output\n")
+        cuts_file.write("#,calibration_code,<,200")
+
+def ingest_etroc1_runs_into_dataset_subtask(
+    Turing: RM.TaskManager,
+    script_logger: logging.Logger,
+    run_files: list[Path],
+    data_dir: Path,
+    keep_only_triggers: bool,
+    parser:str = "pandas",
+    storage_backend:str = default_storage_backend,
+    validate:bool = True,
+):
+    """
+    Convert all the runs into a single dataset in `data_dir`, where each run
+    is a sub-run saved as its own part of the etroc1_data table, i.e. the
+    table is partitioned by phase, pixel, charge and threshold. The rows get
+    the `sub_run` column and the metadata of their board, the events are
+    numbered sequentially over all the sub-runs and the metadata of the boards
+    of each sub-run is saved in the etroc1_sub_runs table.
+    """
+    dat_format = raw_data_formats["dat"]
+
+    backup_data_dir = Turing.task_path.resolve()/'original_data'
+    backup_data_dir.mkdir()
+
+    sub_run_dfs = []
+    split_info = []
+    quarantine_dfs = []
+    first_event = 0
+    with open_table_writer(data_dir, 'etroc1_data', backend=storage_backend) as writer:
+        for sub_run, file in enumerate(run_files):
+            run_name = get_split_run_name(file)
+            board_info_df = dat_format["board_info"](run_name)
+
+            splits = find_run_splits(file)
+            split_results = read_etroc1_raw_data_files(
+                [split_file for split, split_file in splits],
+                dat_format["columns"],
+                script_logger,
+                parser=parser,
+                backup_directory=backup_data_dir,
+                keep_only_triggers=keep_only_triggers,
+                validate=validate,
+            )
+
+            split_dfs = []
+            for idx in range(len(splits)):
+                split_df, statistics = split_results[idx]
+                split_dfs += [split_df]
+                if statistics["quarantine"] is not None:
+                    quarantine_df = statistics["quarantine"].reset_index(names="row")
+                    quarantine_df.insert(0, "split", splits[idx][0])
+                    quarantine_df.insert(0, "sub_run", sub_run)
+                    quarantine_dfs += [quarantine_df]
+
+                split_info += [{
+                    "sub_run": sub_run,
+                    "split": splits[idx][0],
+                    "file_name": splits[idx][1].name,
+                    "rows": statistics["rows"],
+                    "skipped_rows": statistics["skipped_rows"],
+                    "quarantined_rows": statistics["quarantined_rows"],
+                    "kept_rows": statistics["kept_rows"],
+                }]
+            del split_results
+
+            df = pandas.concat(split_dfs, ignore_index=True)
+            del split_dfs
+
+            df.reset_index(names="event", inplace=True)  # For charge injection, the event number is sequential, here over all the sub-runs
+            df["event"] += first_event
+            df.insert(1, "sub_run", sub_run)
+            df["sub_run"] = df["sub_run"].astype("int16")
+            annotate_board_info(df, board_info_df, script_logger)
+            first_event += len(df)
+
+            if len(df) > 0:
+                script_logger.info('Saving sub-run {} into the dataset...'.format(run_name))
+                writer.write(df)
+                writer.flush()  # Each sub-run goes into its own part of the table
+            del df
+
+            sub_run_df = board_info_df.reset_index()
+            sub_run_df.insert(0, "run_name", run_name)
+            sub_run_df.insert(0, "sub_run", sub_run)
+            sub_run_dfs += [sub_run_df]
+
+    # Record the hash of the original data, so it can be checked if the raw data changed
+    write_raw_data_hashes(backup_data_dir, Turing.path_directory/"raw_data.sha256")
+
+    sub_runs_df = pandas.concat(sub_run_dfs, ignore_index=True)
+    sub_runs_df["sub_run"] = sub_runs_df["sub_run"].astype("int16")
+    write_table(sub_runs_df, data_dir, 'etroc1_sub_runs', backend=storage_backend)
+    write_table(pandas.DataFrame(split_info), data_dir, 'etroc1_splits', backend=storage_backend)
+    if len(quarantine_dfs) > 0:
+        script_logger.info('Saving the rows which failed the validation into the quarantine table...')
+        write_table(pandas.concat(quarantine_dfs), data_dir, 'quarantine', backend=storage_backend)
+
+def apply_cuts_to_dataset_subtask(
+    Turing: RM.TaskManager,
+    script_logger: logging.Logger,
+    data_dir: Path,
+):
+    """
+    Apply the cuts of the cuts.csv file to all the sub-runs of the single
+    dataset at once, the event filter is saved in the run directory
+    """
+    cuts_df = pandas.read_csv(Turing.path_directory/"cuts.csv")
+    cuts_df.to_csv(Turing.task_path/'cuts.backup.csv', index=False)
+
+    input_df = read_table(data_dir, "etroc1_data", columns=event_cuts_columns(cuts_df))
+    event_tensor = TableView(data_dir, "etroc1_data").tensor(list(cuts_df['variable'].unique()))  # Only the variables which are cut on
+
+    event_filter = apply_event_cuts(input_df, event_tensor, cuts_df, script_logger=script_logger, Johnny=Turing)
+
+    script_logger.info('Saving dataset event filter metadata...')
+    write_filter(event_filter, Turing.task_path/'event_filter.npz')
+    write_filter(event_filter, Turing.path_directory/'event_filter.npz')
+
 def process_etroc1_data_directory_task(
     AdaLovelace: RM.RunManager,
     script_logger: logging.Logger,
@@ -52,23 +199,53 @@ def process_etroc1_data_directory_task(
     keep_only_triggers: bool,
     make_plots:bool = False,
     first_time:bool = True,
+    parser:str = "pandas",
+    storage_backend:str = default_storage_backend,
+    single_dataset:bool = False,
+    validate:bool = True,
 ):
+    if single_dataset:
+        # The original data is kept in the task directory, so it is only dropped when the data is converted again
+        with AdaLovelace.handle_task("process_etroc1_data_directory", drop_old_data=first_time) as Turing:
+            data_dir = AdaLovelace.path_directory/"data"
+            if first_time:
+                ingest_etroc1_runs_into_dataset_subtask(
+                    Turing,
+                    script_logger=script_logger,
+                    run_files=[Path(file) for file in run_files],
+                    data_dir=data_dir,
+                    keep_only_triggers=keep_only_triggers,
+                    parser=parser,
+                    storage_backend=storage_backend,
+                    validate=validate,
+                )
+                write_default_cuts_file(AdaLovelace.path_directory/"cuts.csv")
+
+            apply_cuts_to_dataset_subtask(
+                Turing,
+                script_logger=script_logger,
+                data_dir=data_dir,
+            )
+
+        if AdaLovelace.task_completed("process_etroc1_data_directory") and make_plots:
+            plot_etroc1_task(AdaLovelace, "plot_before_cuts", data_dir)
+            plot_etroc1_task(AdaLovelace, "plot_after_cuts", data_dir, filter_files={"event": AdaLovelace.path_directory/"event_filter.npz"})
+        return
+
     with AdaLovelace.handle_task("process_etroc1_data_directory", drop_old_data=True) as Turing:
         run_dirs = []
         for file in run_files:
             path = Path(file)
-            file_base_name = str(path.name)[:-12]
+            file_base_name = get_split_run_name(path)
             file_directory = AdaLovelace.path_directory/"Individual_Runs"/file_base_name
             run_dirs += [file_directory]
 
             if first_time:
                 # Convert from RAW data format to our format
-                process_single_run(path, file_directory, keep_only_triggers, add_extra_data=False, drop_old_data=True, make_plots=make_plots)
+                process_single_run(path, file_directory, keep_only_triggers, add_extra_data=False, drop_old_data=True, make_plots=make_plots, parser=parser, storage_backend=storage_backend, validate=validate)
 
                 # Build a basic cuts.csv file
-                with (file_directory/"cuts.csv").open("w") as cuts_file:
-                    cuts_file.write("board_id,variable,cut_type,cut_value,output\n")
-                    cuts_file.write("#,calibration_code,<,200")
+                write_default_cuts_file(file_directory/"cuts.csv")
 
         apply_cuts_to_single_runs_subtask(
             Turing,
@@ -77,6 +254,142 @@ def process_etroc1_data_directory_task(
             make_plots=make_plots,
         )
 
+def select_run_board_hits(
+    run_df: pandas.DataFrame,
+    board_info_df: pandas.DataFrame,
+    script_logger: logging.Logger,
+    board0_default:int = 535,
+    board1_default:int = 720,
+    board3_default:int = 720,
+    filter_default:bool = True,
+    trigger_board:int = 0,
+):
+    """
+    Given the number of hits of each board in a run, `run_df`, keep only the
+    board being scanned if `filter_default` is set and add the metadata of
+    the boards from `board_info_df`
+    """
+    board0_threshold = board_info_df.at[0, "board_discriminator_threshold"]
+    board1_threshold = board_info_df.at[1, "board_discriminator_threshold"]
+    board3_threshold = board_info_df.at[3, "board_discriminator_threshold"]
+
+    if filter_default:
+        if len(run_df) == 0:  # Figure out which board is different from default and add a 0 hit entry
+            if board0_threshold != board0_default:  # It is board 0
+                run_df.loc[len(run_df.index)] = [0, 0]
+            elif board1_threshold != board1_default:  # It is board 1
+                run_df.loc[len(run_df.index)] = [1, 0]
+            elif board3_threshold != board3_default:  # It is board 3
+                run_df.loc[len(run_df.index)] = [3, 0]
+            else:  # WTF is going on?
+                script_logger.error("Something weird happened, there is an individual run with no threshold different from default and no data. Make sure the data taking parameters made sense. This is only possible if the threshold of the trigger board was set too high.")
+        elif len(run_df) > 1:  # There is data from the board of interest and others (probably trigger board and others with badly set threshold)
+            run_df.drop(run_df.index[run_df['data_board_id'] == trigger_board], inplace=True)
+            run_df.reset_index(drop=True, inplace=True)
+            if len(run_df) > 1:
+                script_logger.error("After removing the extra trigger board, there is still multiple boards in a single run. This is not yet correctly handled. Please consider the data plots with care or fix the code to handle this correctly")
+        else:  # There is data from only 1 board, but this may be from the trigger board and not the board of interest
+            if board0_threshold != board0_default:  # Data should be from board 0
+                if run_df["data_board_id"][0] != 0:  # if not from this board
+                    run_df.drop(run_df.index[run_df['data_board_id'] == trigger_board], inplace=True)
+                    run_df.reset_index(drop=True, inplace=True)
+                    run_df.loc[len(run_df.index)] = [0, 0]
+            elif board1_threshold != board1_default:  # Data should be from board 1
+                if run_df["data_board_id"][0] != 1:  # if not from this board
+                    run_df.drop(run_df.index[run_df['data_board_id'] == trigger_board], inplace=True)
+                    run_df.reset_index(drop=True, inplace=True)
+                    run_df.loc[len(run_df.index)] = [1, 0]
+            elif board3_threshold != board3_default:  # Data should be from board 3
+                if run_df["data_board_id"][0] != 3:  # if not from this board
+                    run_df.drop(run_df.index[run_df['data_board_id'] == trigger_board], inplace=True)
+                    run_df.reset_index(drop=True, inplace=True)
+                    run_df.loc[len(run_df.index)] = [3, 0]
+            else:  # This is the data for the trigger board when it equals the default, keep it
+                if run_df["data_board_id"][0] != trigger_board:
+                    script_logger.error("There is a problem... expecting data from trigger board only, but there was data from another board. Probably the default thresholds are improperly configured")
+
+    run_df["hits"] = run_df["hits"].astype("int64")
+    run_df["data_board_id"] = run_df["data_board_id"].astype("int8")
+
+    annotate_board_info(run_df, board_info_df, script_logger)
+
+    return run_df.dropna()
+
+def merge_etroc1_individual_runs_subtask(
+    Bento: RM.TaskManager,
+    script_logger: logging.Logger,
+    **selection,
+):
+    run_paths = [x for x in (Bento.path_directory/"Individual_Runs").iterdir() if x.is_dir()]
+    combined_writer = None  # The summary of each run is appended to the combined table
+    for run_path in run_paths:
+        with RM.RunManager(run_path) as Goku:
+            if Goku.task_completed("apply_event_cuts"):
+                data_dir = Goku.path_directory/"data"
+                df = read_table(data_dir, "etroc1_data")
+
+                from cut_etroc1_single_run import apply_event_filter
+                event_filter = read_filter(Goku.path_directory/"event_filter.npz")
+
+                df = apply_event_filter(df, event_filter)
+
+                df = df.loc[df['accepted'].to_numpy()]  # Keep the accepted rows
+                df.reset_index(drop=True, inplace=True)
+
+                data_dir = Goku.path_directory/"data-filtered"
+                write_table(df, data_dir, 'etroc1_data', backend=find_table_backend(Goku.path_directory/"data", "etroc1_data"))
+                del df
+                del event_filter
+            elif Goku.task_ran_successfully("proccess_etroc1_data_run"):
+                data_dir = Goku.path_directory/"data"
+            else:
+                data_dir = None
+                script_logger.error("There is no data to process for run {}".format(Goku.run_name))
+
+            if data_dir is not None:
+                board_info_df = raw_data_formats["dat"]["board_info"](str(Goku.path_directory.name))  # For retrieving metadata about the run later
+
+                run_df = read_table(data_dir, "etroc1_data", columns=["data_board_id"]).groupby("data_board_id").size().reset_index(name="hits")
+                run_df = select_run_board_hits(run_df, board_info_df, script_logger, **selection)
+
+                script_logger.info('Saving run {} summary data into database...'.format(Goku.run_name))
+                if combined_writer is None:
+                    combined_writer = open_table_writer(Bento.task_path, 'combined_etroc1_data', backend=find_table_backend(data_dir, "etroc1_data"))
+                combined_writer.write(run_df)
+
+    if combined_writer is not None:
+        combined_writer.close()
+
+def merge_etroc1_dataset_subtask(
+    Bento: RM.TaskManager,
+    script_logger: logging.Logger,
+    data_dir: Path,
+    **selection,
+):
+    """
+    Count the hits of each board in each sub-run of the single dataset with a
+    single grouped aggregation over the accepted rows
+    """
+    df = read_table(data_dir, "etroc1_data", columns=["event", "sub_run", "data_board_id"])
+    if has_filter(Bento.path_directory/"event_filter.npz"):
+        event_filter = read_filter(Bento.path_directory/"event_filter.npz")
+        df = df.loc[event_filter.row_mask(df["event"].to_numpy())]  # Keep the accepted rows
+        del event_filter
+
+    hits_df = df.groupby(["sub_run", "data_board_id"]).size().reset_index(name="hits")
+    del df
+    sub_run_hits = {sub_run: sub_run_df[["data_board_id", "hits"]].reset_index(drop=True) for sub_run, sub_run_df in hits_df.groupby("sub_run")}
+
+    sub_runs_df = read_table(data_dir, "etroc1_sub_runs")
+    run_dfs = []
+    for sub_run, board_info_df in sub_runs_df.groupby("sub_run"):
+        run_df = sub_run_hits.get(sub_run, pandas.DataFrame({"data_board_id": pandas.Series(dtype="int8"), "hits": pandas.Series(dtype="int64")}))
+        board_info_df = board_info_df.drop(columns=["sub_run", "run_name"]).set_index("data_board_id")
+        run_dfs += [select_run_board_hits(run_df, board_info_df, script_logger, **selection)]
+
+    script_logger.info('Saving the summary data of the sub-runs into database...')
+    write_table(pandas.concat(run_dfs, ignore_index=True), Bento.task_path, 'combined_etroc1_data', backend=find_table_backend(data_dir, "etroc1_data"))
+
 def merge_etroc1_runs_task(
     AdaLovelace: RM.RunManager,
     script_logger: logging.Logger,
@@ -88,117 +401,17 @@ def merge_etroc1_runs_task(
 ):
     if AdaLovelace.task_completed("process_etroc1_data_directory"):
         with AdaLovelace.handle_task("merge_etroc1_runs", drop_old_data=True) as Bento:
-            with sqlite3.connect(Bento.task_path/'data.sqlite') as sqlite3_connection:
-                run_paths = [x for x in (AdaLovelace.path_directory/"Individual_Runs").iterdir() if x.is_dir()]
-                for run_path in run_paths:
-                    with RM.RunManager(run_path) as Goku:
-                        if Goku.task_completed("apply_event_cuts"):
-                            sqlite_file = Goku.path_directory/"data"/"data.sqlite"
-                            with sqlite3.connect(sqlite_file) as sqlite3_connection_run:
-                                df = pandas.read_sql('SELECT * FROM etroc1_data', sqlite3_connection_run, index_col=None)
-
-                                from cut_etroc1_single_run import apply_event_filter
-                                filter_df = pandas.read_feather(Goku.path_directory/"event_filter.fd")
-                                filter_df.set_index("event", inplace=True)
-
-                                df = apply_event_filter(df, filter_df)
-
-                                df.drop(df.index[df['accepted'] == False], inplace=True)  # Drop the False, i.e. keep the True
-                                df.reset_index(drop=True, inplace=True)
-
-                                sqlite_file = Goku.path_directory/"data-filtered"/"data.sqlite"
-                                (Goku.path_directory/"data-filtered").mkdir(exist_ok=True)
-                                with sqlite3.connect(sqlite_file) as sqlite3_out_connection:
-                                    df.to_sql('etroc1_data',
-                                            sqlite3_out_connection,
-                                            index=False,
-                                            if_exists='replace')
-                                del df
-                                del filter_df
-                        elif Goku.task_ran_successfully("proccess_etroc1_data_run"):
-                            sqlite_file = Goku.path_directory/"data"/"data.sqlite"
-                        else:
-                            sqlite_file = None
-                            script_logger.error("There is no data to process for run {}".format(Goku.run_name))
-
-                        if sqlite_file is not None:
-                            info = str(Goku.path_directory.name).split('_')  # For retrieving metadata about the run later
-                            board0_threshold = int(info[5][3:])
-                            board1_threshold = int(info[8][3:])
-                            board3_threshold = int(info[11][3:])
-
-                            with sqlite3.connect(sqlite_file) as sqlite3_connection_run:
-                                run_df = pandas.read_sql('SELECT data_board_id, COUNT(*) AS hits FROM etroc1_data GROUP BY data_board_id', sqlite3_connection_run, index_col=None)
-
-                                if filter_default:
-                                    if len(run_df) == 0:  # Figure out which board is different from default and add a 0 hit entry
-                                        if board0_threshold != board0_default:  # It is board 0
-                                            run_df.loc[len(run_df.index)] = [0, 0]
-                                        elif board1_threshold != board1_default:  # It is board 1
-                                            run_df.loc[len(run_df.index)] = [1, 0]
-                                        elif board3_threshold != board3_default:  # It is board 3
-                                            run_df.loc[len(run_df.index)] = [3, 0]
-                                        else:  # WTF is going on?
-                                            script_logger.error("Something weird happened, there is an individual run with no threshold different from default and no data. Make sure the data taking parameters made sense. This is only possible if the threshold of the trigger board was set too high.")
-                                    elif len(run_df) > 1:  # There is data from the board of interest and others (probably trigger board and others with badly set threshold)
-                                        run_df.drop(run_df.index[run_df['data_board_id'] == trigger_board], inplace=True)
-                                        run_df.reset_index(drop=True, inplace=True)
-                                        if len(run_df) > 1:
-                                            script_logger.error("After removing the extra trigger board, there is still multiple boards in a single run. This is not yet correctly handled. Please consider the data plots with care or fix the code to handle this correctly")
-                                    else:  # There is data from only 1 board, but this may be from the trigger board and not the board of interest
-                                        if board0_threshold != board0_default:  # Data should be from board 0
-                                            if run_df["data_board_id"][0] != 0:  # if not from this board
-                                                run_df.drop(run_df.index[run_df['data_board_id'] == trigger_board], inplace=True)
-                                                run_df.reset_index(drop=True, inplace=True)
-                                                run_df.loc[len(run_df.index)] = [0, 0]
-                                        elif board1_threshold != board1_default:  # Data should be from board 1
-                                            if run_df["data_board_id"][0] != 1:  # if not from this board
-                                                run_df.drop(run_df.index[run_df['data_board_id'] == trigger_board], inplace=True)
-                                                run_df.reset_index(drop=True, inplace=True)
-                                                run_df.loc[len(run_df.index)] = [1, 0]
-                                        elif board3_threshold != board3_default:  # Data should be from board 3
-                                            if run_df["data_board_id"][0] != 3:  # if not from this board
-                                                run_df.drop(run_df.index[run_df['data_board_id'] == trigger_board], inplace=True)
-                                                run_df.reset_index(drop=True, inplace=True)
-                                                run_df.loc[len(run_df.index)] = [3, 0]
-                                        else:  # This is the data for the trigger board when it equals the default, keep it
-                                            if run_df["data_board_id"][0] != trigger_board:
-                                                script_logger.error("There is a problem... expecting data from trigger board only, but there was data from another board. Probably the default thresholds are improperly configured")
-
-                                run_df["hits"] = run_df["hits"].astype("int64")
-                                run_df["data_board_id"] = run_df["data_board_id"].astype("int8")
-
-                                run_df["phase_adjust"] = info[2][8:]
-                                run_df["phase_adjust"] = run_df["phase_adjust"].astype("int8")  # TODO: Check if type is ok
-
-                                run_df["pixel_id"] = None
-                                run_df["board_injected_charge"] = None
-                                run_df["board_discriminator_threshold"] = None
-
-                                for idx in range(len(run_df["data_board_id"])):
-                                    board_id = run_df["data_board_id"][idx]
-
-                                    if board_id is None:
-                                        continue
-                                    elif board_id == 3:  # Because the board numbering goes 0 - 1 - 3, but indexes are sequential
-                                        board_idx = 2
-                                    else:
-                                        board_idx = board_id
-
-                                    run_df.at[idx, 'pixel_id'] = info[3 + board_idx*3]
-                                    run_df.at[idx, 'board_injected_charge'] = info[4 + board_idx*3][4:]
-                                    run_df.at[idx, 'board_discriminator_threshold'] = info[5 + board_idx*3][3:]
-
-                                run_df["board_injected_charge"] = run_df["board_injected_charge"].astype("int16")  # TODO: Check if type is ok
-                                run_df["board_discriminator_threshold"] = run_df["board_discriminator_threshold"].astype("int16")  # TODO: Check if type is ok
-
-                                run_df = run_df.dropna()
-
-                                script_logger.info('Saving run {} summary data into database...'.format(Goku.run_name))
-                                run_df.to_sql('combined_etroc1_data',
-                                              sqlite3_connection,
-                                              index=False,
-                                              if_exists='append')
+            selection = {
+                "board0_default": board0_default,
+                "board1_default": board1_default,
+                "board3_default": board3_default,
+                "filter_default": filter_default,
+                "trigger_board": trigger_board,
+            }
+            if has_table(AdaLovelace.path_directory/"data", "etroc1_sub_runs"):  # All the runs were converted into a single dataset
+                merge_etroc1_dataset_subtask(Bento, script_logger, AdaLovelace.path_directory/"data", **selection)
+            else:
+                merge_etroc1_individual_runs_subtask(Bento, script_logger, **selection)
 
 def plot_etroc1_combined_task(
     AdaLovelace: RM.RunManager,
@@ -210,58 +423,56 @@ def plot_etroc1_combined_task(
 
     if AdaLovelace.task_completed("merge_etroc1_runs"):
         with AdaLovelace.handle_task("plot_etroc1_combined", drop_old_data=True) as VanGogh:
-            sqlite_file = VanGogh.get_task_path("merge_etroc1_runs")/'data.sqlite'
-            with sqlite3.connect(sqlite_file) as sqlite3_connection:
-                combined_df = pandas.read_sql('SELECT * FROM combined_etroc1_data', sqlite3_connection, index_col=None)
-                combined_df = combined_df.sort_values(by=['data_board_id', 'board_discriminator_threshold'])
-
-                fig = px.line(
-                    data_frame = combined_df,
-                    x = 'board_discriminator_threshold',
-                    y = 'hits',
-                    labels = {
-                        "board_discriminator_threshold": "Discriminator Threshold [DAC Counts]",
-                        "hits": "Hits",
-                        "data_board_id": "Board ID",
-                        "board_injected_charge": "Injected Charge [fC]"
-                    },
-                    color="data_board_id",
-                    line_dash="board_injected_charge",
-                    #line_group="board_injected_charge",
-                    title = "Discriminator Threshold DAC Scan<br><sup>Run: {}{}</sup>".format(AdaLovelace.run_name, extra_title),
-                    symbol = "board_injected_charge",
-                )
-                fig.write_html(
-                    VanGogh.task_path/"DAC_Scan.html",
-                    full_html = False, # For saving a html containing only a div with the plot
-                    include_plotlyjs='cdn',
-                )
-
-                combined_df["data_board_id_cat"] = combined_df["data_board_id"].astype(str)
-                fig = px.scatter_matrix(
-                    combined_df,
-                    dimensions=["board_discriminator_threshold", "hits", "phase_adjust", "board_injected_charge"],
-                    labels = {
-                        "board_discriminator_threshold": "Discriminator Threshold [DAC Counts]",
-                        "hits": "Hits",
-                        "data_board_id_cat": "Board ID",
-                        "phase_adjust": "Phase Adjust [?]",
-                        "board_injected_charge": "Injected Charge [fC]"
-                    },
-                    title = "Variable Correlations<br><sup>Run: {}{}</sup>".format(AdaLovelace.run_name, extra_title),
-                    color="data_board_id_cat",
-                    symbol = "board_injected_charge",
-                )
-                fig.update_traces(
-                    diagonal_visible=False,
-                    showupperhalf=False
-                )
-
-                fig.write_html(
-                    VanGogh.task_path/'multi_scatter.html',
-                    full_html = False, # For saving a html containing only a div with the plot
-                    include_plotlyjs = 'cdn',
-                )
+            combined_df = read_table(VanGogh.get_task_path("merge_etroc1_runs"), "combined_etroc1_data")
+            combined_df = combined_df.sort_values(by=['data_board_id', 'board_discriminator_threshold'])
+
+            fig = px.line(
+                data_frame = combined_df,
+                x = 'board_discriminator_threshold',
+                y = 'hits',
+                labels = {
+                    "board_discriminator_threshold": "Discriminator Threshold [DAC Counts]",
+                    "hits": "Hits",
+                    "data_board_id": "Board ID",
+                    "board_injected_charge": "Injected Charge [fC]"
+                },
+                color="data_board_id",
+                line_dash="board_injected_charge",
+                #line_group="board_injected_charge",
+                title = "Discriminator Threshold DAC Scan<br><sup>Run: {}{}</sup>".format(AdaLovelace.run_name, extra_title),
+                symbol = "board_injected_charge",
+            )
+            fig.write_html(
+                VanGogh.task_path/"DAC_Scan.html",
+                full_html = False, # For saving a html containing only a div with the plot
+                include_plotlyjs='cdn',
+            )
+
+            combined_df["data_board_id_cat"] = combined_df["data_board_id"].astype(str)
+            fig = px.scatter_matrix(
+                combined_df,
+                dimensions=["board_discriminator_threshold", "hits", "phase_adjust", "board_injected_charge"],
+                labels = {
+                    "board_discriminator_threshold": "Discriminator Threshold [DAC Counts]",
+                    "hits": "Hits",
+                    "data_board_id_cat": "Board ID",
+                    "phase_adjust": "Phase Adjust [?]",
+                    "board_injected_charge": "Injected Charge [fC]"
+                },
+                title = "Variable Correlations<br><sup>Run: {}{}</sup>".format(AdaLovelace.run_name, extra_title),
+                color="data_board_id_cat",
+                symbol = "board_injected_charge",
+            )
+            fig.update_traces(
+                diagonal_visible=False,
+                showupperhalf=False
+            )
+
+            fig.write_html(
+                VanGogh.task_path/'multi_scatter.html',
+                full_html = False, # For saving a html containing only a div with the plot
+                include_plotlyjs = 'cdn',
+            )
 
 def script_main(
         input_directory:Path,
@@ -274,6 +485,10 @@ def script_main(
         board3_default:int = 720,
         filter_default:bool = True,
         trigger_board:int = 0,
+        parser:str = "pandas",
+        storage_backend:str = default_storage_backend,
+        single_dataset:bool = False,
+        validate:bool = True,
         ):
     script_logger = logging.getLogger('process_dir')
 
@@ -292,7 +507,15 @@ def script_main(
     with RM.RunManager(out_dir) as Guilherme:
         Guilherme.create_run(raise_error=True)
 
-        run_files = [x for x in input_directory.iterdir() if x.is_file() and str(x)[-11:-4] == "Split_0"]
+        run_files = []
+        for file in sorted(input_directory.iterdir()):
+            if not file.is_file() or not is_first_split_file(file):
+                continue
+            data_format = detect_raw_data_format(file)
+            if data_format not in [None, "dat"]:  # Only the charge injection runs can be merged
+                script_logger.warning("Skipping {}, it is a {} file and not a charge injection run".format(file.name, data_format))
+                continue
+            run_files += [file]
 
         process_etroc1_data_directory_task(
             Guilherme,
@@ -300,6 +523,10 @@ def script_main(
             run_files=run_files,
             keep_only_triggers=keep_only_triggers,
             make_plots=make_plots,
+            parser=parser,
+            storage_backend=storage_backend,
+            single_dataset=single_dataset,
+            validate=validate,
         )
 
         merge_etroc1_runs_task(
@@ -417,6 +644,32 @@ if __name__ == '__main__':
         dest = 'trigger_board',
         type = int,
     )
+    parser.add_argument(
+        '--parser',
+        help = "The backend used to parse the dat files. The pyarrow backend is multithreaded but requires the columns to be separated by a single space. Default: pandas",
+        choices = raw_data_formats["dat"]["parsers"],
+        default = "pandas",
+        dest = 'parser',
+    )
+    parser.add_argument(
+        '--no-validation',
+        help = "If set, the rows are not validated while parsing. By default, rows with malformed values, unknown board IDs, codes out of their 10 bit range or invalid hit flags are removed and saved in the quarantine table, together with the reason",
+        action = 'store_true',
+        dest = 'no_validation',
+    )
+    parser.add_argument(
+        '--storage',
+        help = "The format used to store the processed data: arrow, which is memory mapped for very fast reading, parquet, a compressed columnar format, or sqlite, the format used by the older runs. Default: arrow",
+        choices = storage_backends,
+        default = default_storage_backend,
+        dest = 'storage',
+    )
+    parser.add_argument(
+        '--single-dataset',
+        help = "If set, all the runs are converted into a single dataset, partitioned by phase, pixel, charge and threshold, instead of a run directory for each one",
+        action = 'store_true',
+        dest = 'single_dataset',
+    )
 
     args = parser.parse_args()
 
@@ -447,4 +700,8 @@ if __name__ == '__main__':
         board3_default = args.board3_default,
         filter_default = args.filter_default,
         trigger_board = args.trigger_board,
+        parser = args.parser,
+        storage_backend = args.storage,
+        single_dataset = args.single_dataset,
+        validate = not args.no_validation,
     )
\ No newline at end of file
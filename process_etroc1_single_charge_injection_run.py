@@ -26,11 +26,18 @@ from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
 import lip_pps_run_manager as RM
 
 import logging
-import shutil
 import pandas
-import sqlite3
 
 from utilities import plot_etroc1_task
+from ingest_utilities import raw_data_formats
+from ingest_utilities import check_raw_data_format
+from storage_utilities import storage_backends
+from storage_utilities import default_storage_backend
+from storage_utilities import write_table
+from ingest_utilities import find_run_splits
+from ingest_utilities import read_etroc1_raw_data_files
+from ingest_utilities import annotate_board_info
+from ingest_utilities import write_raw_data_hashes
 
 def proccess_etroc1_run_task(
     AdaLovelace: RM.RunManager,
@@ -39,84 +46,87 @@ def proccess_etroc1_run_task(
     keep_only_triggers: bool,
     add_extra_data:bool=True,
     drop_old_data:bool=False,
+    parser:str="pandas",
+    max_workers:int=None,
+    board_ids:list[int]=None,
+    validate:bool=True,
+    storage_backend:str=None,
 ):
+    dat_format = raw_data_formats["dat"]
+
     with AdaLovelace.handle_task("proccess_etroc1_data_run", drop_old_data=drop_old_data) as Miso:
         # Copied data location
         backup_data_dir = Miso.task_path.resolve()/'original_data'
         backup_data_dir.mkdir()
 
-        # Copy and save original data
-        script_logger.info("Copying original data to backup location")
-        shutil.copy(input_file, backup_data_dir)
+        # Find all the splits of the run
+        splits = find_run_splits(input_file)
+        script_logger.info("Found {} split(s) for the run".format(len(splits)))
 
         # Create data directory
         data_dir = Miso.path_directory.resolve()/"data"
         data_dir.mkdir()
 
-        info = str(input_file.name).split('_')
-
-        with sqlite3.connect(data_dir/'data.sqlite') as sqlite3_connection:
-            df = pandas.read_csv(
-                input_file,
-                header=None,
-                delim_whitespace=True,
-                names=[
-                    "data_board_id",
-                    "time_of_arrival",
-                    "time_over_threshold",
-                    "calibration_code",
-                    "hit_flag",
-                ]
-            )
-
-            # TODO open other splits of file
-
-            if keep_only_triggers:
-                df = df.loc[df["hit_flag"] == 1]
-                df.reset_index(names="drop_me", inplace=True)
-                df.drop(columns=['drop_me'], inplace=True)
-
-            # Adjust types and sizes
-            df["data_board_id"] = df["data_board_id"].astype("int8")
-            df["time_of_arrival"] = df["time_of_arrival"].astype("int16")
-            df["time_over_threshold"] = df["time_over_threshold"].astype("int16")
-            df["calibration_code"] = df["calibration_code"].astype("int16")
-            df["hit_flag"] = df["hit_flag"].astype("bool")
-
-            df.reset_index(names="event", inplace=True)  # For charge injection, the event number is sequential
-
-            if add_extra_data:
-                df["phase_adjust"] = info[2][8:]
-                df["phase_adjust"] = df["phase_adjust"].astype("int8")  # TODO: Check if type is ok
-
-                df["pixel_id"] = None
-                df["board_injected_charge"] = None
-                df["board_discriminator_threshold"] = None
-
-                for idx in range(len(df["data_board_id"])):
-                    board_id = df["data_board_id"][idx]
-
-                    if board_id is None:
-                        continue
-                    elif board_id == 3:  # Because the board numbering goes 0 - 1 - 3, but indexes are sequential
-                        board_idx = 2
-                    else:
-                        board_idx = board_id
-
-                    base_info_idx = (board_idx + 1) * 3
-                    # df["pixel_id"][idx] = info[base_info_idx]
-                    df.at[idx, 'pixel_id'] = info[base_info_idx]
-                    df.at[idx, 'board_injected_charge'] = info[base_info_idx+1][4:]
-                    df.at[idx, 'board_discriminator_threshold'] = info[base_info_idx+2][3:]
-
-                df["board_injected_charge"] = df["board_injected_charge"].astype("int16")  # TODO: Check if type is ok
-                df["board_discriminator_threshold"] = df["board_discriminator_threshold"].astype("int16")  # TODO: Check if type is ok
-
-            script_logger.info('Saving run metadata into database...')
-            df.to_sql('etroc1_data',
-                      sqlite3_connection,
-                      index=False,
-                      if_exists='replace')
+        board_info_df = None
+        if add_extra_data:
+            board_info_df = dat_format["board_info"](str(input_file.name))
+
+        # The original data is compressed into the backup location while it is parsed, the
+        # rows which are not kept are dropped by the parser and the invalid rows are put into quarantine
+        script_logger.info("Archiving original data to backup location while reading it")
+        split_results = read_etroc1_raw_data_files(
+            [split_file for split, split_file in splits],
+            dat_format["columns"],
+            script_logger,
+            parser=parser,
+            max_workers=max_workers,
+            backup_directory=backup_data_dir,
+            keep_only_triggers=keep_only_triggers,
+            board_ids=board_ids,
+            validate=validate,
+        )
+
+        # Record the hash of the original data, so it can be checked if the raw data changed
+        write_raw_data_hashes(backup_data_dir, Miso.path_directory/"raw_data.sha256")
+
+        split_dfs = []
+        quarantine_dfs = []
+        split_info = []
+        for idx in range(len(splits)):
+            split_df, statistics = split_results[idx]
+            split_dfs += [split_df]
+            if statistics["quarantine"] is not None:
+                quarantine_df = statistics["quarantine"].reset_index(names="row")
+                quarantine_df.insert(0, "split", splits[idx][0])
+                quarantine_dfs += [quarantine_df]
+
+            split_info += [{
+                "split": splits[idx][0],
+                "file_name": splits[idx][1].name,
+                "rows": statistics["rows"],
+                "skipped_rows": statistics["skipped_rows"],
+                "quarantined_rows": statistics["quarantined_rows"],
+                "kept_rows": statistics["kept_rows"],
+            }]
+        del split_results
+        split_info_df = pandas.DataFrame(split_info)
+        script_logger.info("Rows per split:\n{}".format(split_info_df))
+
+        # Concatenate in split order, with a new index so the event number is sequential over all the splits
+        df = pandas.concat(split_dfs, ignore_index=True)
+        del split_dfs
+
+        df.reset_index(names="event", inplace=True)  # For charge injection, the event number is sequential
+
+        if add_extra_data:
+            annotate_board_info(df, board_info_df, script_logger)
+
+        script_logger.info('Saving run metadata into database...')
+        write_table(df, data_dir, 'etroc1_data', backend=storage_backend)
+        write_table(split_info_df, data_dir, 'etroc1_splits', backend=storage_backend)
+        if len(quarantine_dfs) > 0:
+            script_logger.info('Saving the rows which failed the validation into the quarantine table...')
+            write_table(pandas.concat(quarantine_dfs), data_dir, 'quarantine', backend=storage_backend)
 
 def script_main(
         input_file:Path,
@@ -124,7 +134,12 @@ def script_main(
         keep_only_triggers:bool,
         add_extra_data:bool=True,
         drop_old_data:bool=True,
-        make_plots:bool=True
+        make_plots:bool=True,
+        parser:str="pandas",
+        max_workers:int=None,
+        board_ids:list[int]=None,
+        validate:bool=True,
+        storage_backend:str=default_storage_backend,
         ):
 
     script_logger = logging.getLogger('process_run')
@@ -133,6 +148,8 @@ def script_main(
         script_logger.info("The input file should be an existing file")
         return
 
+    check_raw_data_format(input_file, "dat", script_logger)
+
     with RM.RunManager(output_directory.resolve()) as Bob:
         Bob.create_run(raise_error=True)
 
@@ -143,10 +160,15 @@ def script_main(
             keep_only_triggers=keep_only_triggers,
             add_extra_data=add_extra_data,
             drop_old_data=drop_old_data,
+            parser=parser,
+            max_workers=max_workers,
+            board_ids=board_ids,
+            validate=validate,
+            storage_backend=storage_backend,
         )
 
         if Bob.task_completed("proccess_etroc1_data_run") and make_plots:
-            plot_etroc1_task(Bob, "plot_before_cuts", Bob.path_directory/"data"/"data.sqlite")
+            plot_etroc1_task(Bob, "plot_before_cuts", Bob.path_directory/"data")
 
 if __name__ == '__main__':
     import argparse
@@ -190,6 +212,44 @@ if __name__ == '__main__':
         action = 'store_true',
         dest = 'keep_all',
     )
+    parser.add_argument(
+        '--parser',
+        help = "The backend used to parse the dat file. The pyarrow backend is multithreaded but requires the columns to be separated by a single space. Default: pandas",
+        choices = raw_data_formats["dat"]["parsers"],
+        default = "pandas",
+        dest = 'parser',
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        metavar = 'int',
+        help = "Number of processes used to parse the splits of the run in parallel. Default: 0 (the number of processors in the machine)",
+        default = 0,
+        dest = 'jobs',
+        type = int,
+    )
+    parser.add_argument(
+        '-b',
+        '--board-ids',
+        metavar = 'id',
+        help = "If set, only the hits from these boards are kept, the others are dropped while parsing. Default: all boards",
+        nargs = '+',
+        dest = 'board_ids',
+        type = int,
+    )
+    parser.add_argument(
+        '--no-validation',
+        help = "If set, the rows are not validated while parsing. By default, rows with malformed values, unknown board IDs, codes out of their 10 bit range or invalid hit flags are removed and saved in the quarantine table, together with the reason",
+        action = 'store_true',
+        dest = 'no_validation',
+    )
+    parser.add_argument(
+        '--storage',
+        help = "The format used to store the processed data: arrow, which is memory mapped for very fast reading, parquet, a compressed columnar format, or sqlite, the format used by the older runs. Default: arrow",
+        choices = storage_backends,
+        default = default_storage_backend,
+        dest = 'storage',
+    )
 
     args = parser.parse_args()
 
@@ -209,4 +269,8 @@ if __name__ == '__main__':
         elif args.log_level == "NOTSET":
             logging.basicConfig(level=0)
 
-    script_main(Path(args.file), Path(args.out_directory), not args.keep_all)
+    max_workers = None
+    if args.jobs > 0:
+        max_workers = args.jobs
+
+    script_main(Path(args.file), Path(args.out_directory), not args.keep_all, parser=args.parser, max_workers=max_workers, board_ids=args.board_ids, validate=not args.no_validation, storage_backend=args.storage)
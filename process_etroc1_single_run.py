@@ -0,0 +1,177 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
+                         #   https://docs.python.org/3/library/pathlib.html
+
+import logging
+import importlib
+
+from ingest_utilities import raw_data_formats
+from ingest_utilities import detect_raw_data_format
+from storage_utilities import storage_backends
+from storage_utilities import default_storage_backend
+
+def script_main(
+        input_file:Path,
+        output_directory:Path,
+        keep_only_triggers:bool,
+        data_format:str=None,
+        add_extra_data:bool=True,
+        drop_old_data:bool=True,
+        make_plots:bool=True,
+        parser:str="pandas",
+        board_ids:list[int]=None,
+        validate:bool=True,
+        storage_backend:str=default_storage_backend,
+        ):
+
+    script_logger = logging.getLogger('process_run')
+
+    if not input_file.is_file():
+        script_logger.info("The input file should be an existing file")
+        return
+
+    if data_format is None:
+        data_format = detect_raw_data_format(input_file)
+        if data_format is None:
+            raise RuntimeError("Could not detect the format of {}, the known formats are: {}".format(input_file.name, ", ".join(raw_data_formats)))
+        script_logger.info("Detected the {} format ({})".format(data_format, raw_data_formats[data_format]["description"]))
+    elif data_format not in raw_data_formats:
+        raise RuntimeError("Unknown raw data format: {}".format(data_format))
+
+    if parser not in raw_data_formats[data_format]["parsers"]:
+        raise RuntimeError("The {} parser can not read {} files".format(parser, data_format))
+
+    # Each format is processed by its own ingest script, all of them share these options
+    ingest_script = importlib.import_module(raw_data_formats[data_format]["script"])
+    ingest_script.script_main(
+        input_file,
+        output_directory,
+        keep_only_triggers,
+        add_extra_data=add_extra_data,
+        drop_old_data=drop_old_data,
+        make_plots=make_plots,
+        parser=parser,
+        board_ids=board_ids,
+        validate=validate,
+        storage_backend=storage_backend,
+    )
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Converts data taken with the KC 705 FPGA development board connected to an ETROC1 into our data format, detecting the format of the raw data file and processing it with the matching script')
+    parser.add_argument(
+        '--file',
+        metavar = 'path',
+        help = 'Path to the file with the measurements.',
+        required = True,
+        dest = 'file',
+        type = str,
+    )
+    parser.add_argument(
+        '-l',
+        '--log-level',
+        help = 'Set the logging level. Default: WARNING',
+        choices = ["CRITICAL","ERROR","WARNING","INFO","DEBUG","NOTSET"],
+        default = "WARNING",
+        dest = 'log_level',
+    )
+    parser.add_argument(
+        '--log-file',
+        help = 'If set, the full log will be saved to a file (i.e. the log level is ignored)',
+        action = 'store_true',
+        dest = 'log_file',
+    )
+    parser.add_argument(
+        '-o',
+        '--out-directory',
+        metavar = 'path',
+        help = 'Path to the output directory for the run data. Default: ./out',
+        default = "./out",
+        dest = 'out_directory',
+        type = str,
+    )
+    parser.add_argument(
+        '-k',
+        '--keep-all',
+        help = "If set, all lines from the raw data file will be kept in the output, if not, only those corresponding to triggers will be kept",
+        action = 'store_true',
+        dest = 'keep_all',
+    )
+    parser.add_argument(
+        '--format',
+        help = "The format of the raw data file. Default: detected from the file content",
+        choices = list(raw_data_formats),
+        default = None,
+        dest = 'format',
+    )
+    parser.add_argument(
+        '--parser',
+        help = "The backend used to parse the raw data file. The pyarrow backend is multithreaded but requires the columns to be separated by a single space. Default: pandas",
+        choices = ["pandas", "pyarrow"],
+        default = "pandas",
+        dest = 'parser',
+    )
+    parser.add_argument(
+        '-b',
+        '--board-ids',
+        metavar = 'id',
+        help = "If set, only the hits from these boards are kept, the others are dropped while parsing. Default: all boards",
+        nargs = '+',
+        dest = 'board_ids',
+        type = int,
+    )
+    parser.add_argument(
+        '--no-validation',
+        help = "If set, the rows are not validated while parsing. By default, rows with malformed values, unknown board IDs, codes out of their 10 bit range or invalid hit flags are removed and saved in the quarantine table, together with the reason",
+        action = 'store_true',
+        dest = 'no_validation',
+    )
+    parser.add_argument(
+        '--storage',
+        help = "The format used to store the processed data: arrow, which is memory mapped for very fast reading, parquet, a compressed columnar format, or sqlite, the format used by the older runs. Default: arrow",
+        choices = storage_backends,
+        default = default_storage_backend,
+        dest = 'storage',
+    )
+
+    args = parser.parse_args()
+
+    if args.log_file:
+        logging.basicConfig(filename='logging.log', filemode='w', encoding='utf-8', level=logging.NOTSET)
+    else:
+        if args.log_level == "CRITICAL":
+            logging.basicConfig(level=50)
+        elif args.log_level == "ERROR":
+            logging.basicConfig(level=40)
+        elif args.log_level == "WARNING":
+            logging.basicConfig(level=30)
+        elif args.log_level == "INFO":
+            logging.basicConfig(level=20)
+        elif args.log_level == "DEBUG":
+            logging.basicConfig(level=10)
+        elif args.log_level == "NOTSET":
+            logging.basicConfig(level=0)
+
+    script_main(Path(args.file), Path(args.out_directory), not args.keep_all, data_format=args.format, parser=args.parser, board_ids=args.board_ids, validate=not args.no_validation, storage_backend=args.storage)
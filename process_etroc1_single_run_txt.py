@@ -26,20 +26,59 @@ from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
 import lip_pps_run_manager as RM
 
 import logging
-import shutil
+import itertools
 import pandas
 import numpy
-import numpy.typing
-import sqlite3
 
 from utilities import plot_etroc1_task
-
-# Rolling window match taken from: https://stackoverflow.com/a/49005205
-def rolling_window(array: numpy.typing.ArrayLike, window_size: int):
-    shape = array.shape[:-1] + (array.shape[-1] - window_size + 1, window_size)
-    strides = array.strides + (array.strides[-1],)
-    c = numpy.lib.stride_tricks.as_strided(array, shape=shape, strides=strides)
-    return c
+from ingest_utilities import raw_data_formats
+from ingest_utilities import check_raw_data_format
+from ingest_utilities import iterate_etroc1_raw_data
+from ingest_utilities import read_etroc1_raw_data
+from ingest_utilities import read_etroc1_raw_data_parallel
+from ingest_utilities import follow_etroc1_raw_data
+from ingest_utilities import match_event_pattern
+from ingest_utilities import assign_pattern_events
+from ingest_utilities import pattern_match_statistics
+from ingest_utilities import find_board_sequences
+from ingest_utilities import assign_sequence_events
+from ingest_utilities import event_boards_statistics
+from ingest_utilities import annotate_board_info
+from ingest_utilities import decode_timestamps
+from ingest_utilities import write_raw_data_hashes
+from storage_utilities import storage_backends
+from storage_utilities import default_storage_backend
+from storage_utilities import open_table_writer
+from storage_utilities import write_table
+
+def split_sequence_events(
+    df: pandas.DataFrame,
+    board_order: list[int],
+    min_boards: int,
+    max_time_difference: float,
+    first_event: int,
+    last_chunk: bool,
+):
+    """
+    Add the event and event_boards columns to a chunk of hits with the
+    sequence event builder. Unless it is the last chunk, the hits of the
+    last group may continue in the next chunk, so they are returned
+    separately to be prepended to the next chunk.
+    """
+    board_ids = df['data_board_id'].to_numpy()
+    group_starts = find_board_sequences(board_ids, df['datetime'].to_numpy(), board_order, max_time_difference)
+
+    carry_start = len(board_ids)
+    if not last_chunk and len(group_starts) > 0:
+        carry_start = group_starts[-1]
+    leftover_df = df.iloc[carry_start:].copy()
+    df = df.iloc[:carry_start].copy()
+
+    event_ids, event_boards = assign_sequence_events(board_ids[:carry_start], group_starts[group_starts < carry_start], board_order, min_boards=min_boards, first_event=first_event)
+    df.insert(0, "event", event_ids)
+    df["event_boards"] = event_boards
+
+    return df, leftover_df
 
 def proccess_etroc1_txt_run_task(
     AdaLovelace: RM.RunManager,
@@ -50,103 +89,162 @@ def proccess_etroc1_txt_run_task(
     add_extra_data:bool=True,
     drop_old_data:bool=False,
     pattern:list[int]=[0,1,3],
+    chunk_size:int=None,
+    parser:str="pandas",
+    follow:bool=False,
+    follow_interval:float=10,
+    follow_timeout:float=300,
+    board_ids:list[int]=None,
+    max_workers:int=1,
+    event_builder:str="pattern",
+    min_boards:int=2,
+    max_time_difference:float=1,
+    validate:bool=True,
+    storage_backend:str=None,
 ):
+    txt_format = raw_data_formats["txt"]
+    columns = txt_format["columns"]
+
     with AdaLovelace.handle_task("proccess_etroc1_data_run_txt", drop_old_data=drop_old_data) as Miso:
         # Copied data location
         backup_data_dir = Miso.task_path.resolve()/'original_data'
         backup_data_dir.mkdir()
 
-        # Copy and save original data
-        script_logger.info("Copying original data to backup location")
-        shutil.copy(input_file, backup_data_dir)
-
         # Create data directory
         data_dir = Miso.path_directory/"data"
         data_dir.mkdir()
 
-        info = str(input_file.name).split('_')
-
-        with sqlite3.connect(data_dir/'data.sqlite') as sqlite3_connection:
-            df = pandas.read_csv(
-                input_file,
-                header=None,
-                delim_whitespace=True,
-                skiprows=ignore_rows,
-                names=[
-                    "data_board_id",
-                    "time_of_arrival",
-                    "time_over_threshold",
-                    "calibration_code",
-                    "hit_flag",
-                    "day",
-                    "time",
-                ]
-            )
-
-            if keep_only_triggers:
-                df = df.loc[df["hit_flag"] == 1]
-
-            # Adjust types and sizes
-            df["data_board_id"] = df["data_board_id"].astype("int8")
-            df["time_of_arrival"] = df["time_of_arrival"].astype("int16")
-            df["time_over_threshold"] = df["time_over_threshold"].astype("int16")
-            df["calibration_code"] = df["calibration_code"].astype("int16")
-            df["hit_flag"] = df["hit_flag"].astype("bool")
-
-            # Combine day and time into datetime
-            df["datetime"] = pandas.to_datetime(
-                df['day'].astype(str) + " " + df["time"],
-                format='%Y-%m-%d %H:%M:%S',
-            )
-            df.drop('day', axis=1, inplace=True)
-            df.drop('time', axis=1, inplace=True)
-
-            # print(df)
-            # print(df.dtypes)
-
-            if pattern is not None and len(pattern) > 0:
-                arr = df['data_board_id'].values
-                N = len(pattern)
-                b = numpy.all(rolling_window(arr, N) == pattern, axis=1)
-                c = numpy.mgrid[0:len(b)][b]
-                d = [i  for x in c for i in range(x, x+N)]
-                df['pattern_match'] = numpy.in1d(numpy.arange(len(arr)), d)
-                del arr
-                del N
-                del b
-                del c
-                del d
-
-                df.drop(df.index[df['pattern_match'] == False], inplace=True)
-                df.reset_index(drop=True, inplace=True)
-
-                df.reset_index(names="event", inplace=True)
-                df["event"] = (df["event"]/len(pattern)).apply(numpy.floor).astype("int")
-
-                df.drop('pattern_match', axis=1, inplace=True)
+        board_info_df = None
+        if add_extra_data:
+            board_info_df = txt_format["board_info"](str(input_file.name))
+
+        with open_table_writer(data_dir, 'etroc1_data', backend=storage_backend) as data_writer:
+            # The original data is compressed into the backup location while it is parsed, the
+            # rows which are not kept are dropped by the parser and the invalid rows are put into quarantine
+            script_logger.info("Archiving original data to backup location while reading it")
+            read_statistics = {}
+            read_options = {
+                "parser": parser,
+                "skip_rows": ignore_rows,
+                "backup_directory": backup_data_dir,
+                "keep_only_triggers": keep_only_triggers,
+                "board_ids": board_ids,
+                "validate": validate,
+                "statistics": read_statistics,
+            }
+            if follow:  # The file is still being written, process the new lines as they are appended
+                script_logger.info("Following the input file, processing new lines every {} seconds".format(follow_interval))
+                reader = follow_etroc1_raw_data(input_file, columns, script_logger, poll_interval=follow_interval, idle_timeout=follow_timeout, **read_options)
+            elif chunk_size is None and max_workers != 1:  # The file is split into byte ranges parsed in parallel and merged, so events are built on the full file as usual
+                reader = [read_etroc1_raw_data_parallel(input_file, columns, script_logger, max_workers=max_workers, **read_options)]
+            elif chunk_size is None:  # Without a chunk size the whole file is read at once, so treat it as a single chunk
+                reader = [read_etroc1_raw_data(input_file, columns, script_logger, **read_options)]
             else:
-                df.reset_index(names="event", inplace=True)
-
-            if add_extra_data:  # For now only add pixel names
-                df["pixel_id"] = None
-                for idx in range(len(df["data_board_id"])):
-                    board_id = df["data_board_id"][idx]
-
-                    if board_id is None:
+                script_logger.info("Reading the input file in chunks of {} lines".format(chunk_size))
+                reader = iterate_etroc1_raw_data(input_file, columns, script_logger, chunk_size=chunk_size, **read_options)
+
+            # State carried across chunk boundaries
+            leftover_df = None  # Trailing rows of the previous chunk which may still be the start of a pattern match or sequence
+            next_event = 0
+            match_stats_df = pandas.DataFrame(columns=["hits", "matched_hits", "orphaned_hits"])
+            event_boards_stats = []
+
+            for df in itertools.chain(reader, [None]):
+                last_chunk = df is None
+                if last_chunk:  # Once all the data is read, the hits carried over by the sequence event builder are the last group
+                    if event_builder != "sequence" or leftover_df is None or len(leftover_df) == 0:
+                        break
+                    df = leftover_df.iloc[0:0]
+
+                # Combine day and time into datetime (the binary files already have the datetime)
+                if "datetime" not in df:
+                    df["datetime"] = decode_timestamps(df["day"], df["time"])
+                    df.drop('day', axis=1, inplace=True)
+                    df.drop('time', axis=1, inplace=True)
+
+                # print(df)
+                # print(df.dtypes)
+
+                if event_builder == "sequence":
+                    if leftover_df is not None:
+                        df = pandas.concat([leftover_df, df])
+
+                    df, leftover_df = split_sequence_events(df, pattern, min_boards, max_time_difference, next_event, last_chunk)
+
+                    event_ids = df['event'].to_numpy()
+                    match_stats_df = match_stats_df.add(pattern_match_statistics(df['data_board_id'].to_numpy(), event_ids), fill_value=0)
+                    event_ids, first_rows = numpy.unique(event_ids, return_index=True)
+                    event_boards_stats += [df['event_boards'].to_numpy()[first_rows[event_ids >= 0]]]
+                    next_event += int((event_ids >= 0).sum())
+                    del event_ids
+                    del first_rows
+
+                    df = df.loc[df["event"] >= 0]
+                    df.reset_index(drop=True, inplace=True)
+                elif pattern is not None and len(pattern) > 0:
+                    if leftover_df is not None:
+                        df = pandas.concat([leftover_df, df])
+
+                    arr = df['data_board_id'].to_numpy()
+                    N = len(pattern)
+                    if len(arr) < N:  # Not enough rows for a full pattern, keep all of them for the next chunk
+                        leftover_df = df
                         continue
-                    elif board_id == 3:  # Because the board numbering goes 0 - 1 - 3, but indexes are sequential
-                        board_idx = 2
-                    else:
-                        board_idx = board_id
-
-                    # df["pixel_id"][idx] = info[board_idx]
-                    df.at[idx, 'pixel_id'] = info[board_idx]
-
-            script_logger.info('Saving run metadata into database...')
-            df.to_sql('etroc1_data',
-                      sqlite3_connection,
-                      index=False,
-                      if_exists='replace')
+                    starts = match_event_pattern(arr, pattern)
+
+                    # Rows after the last match could be the start of a match which continues in the next chunk
+                    carry_start = len(arr) - N + 1
+                    if len(starts) > 0:
+                        carry_start = max(carry_start, starts[-1] + N)
+                    leftover_df = df.iloc[carry_start:].copy()
+                    df = df.iloc[:carry_start]
+
+                    event_ids = assign_pattern_events(carry_start, starts, N, first_event=next_event)
+                    match_stats_df = match_stats_df.add(pattern_match_statistics(arr[:carry_start], event_ids), fill_value=0)
+                    next_event += len(starts)
+                    del arr
+                    del starts
+
+                    df.insert(0, "event", event_ids)
+                    del event_ids
+                    df = df.loc[df["event"] >= 0]
+                    df.reset_index(drop=True, inplace=True)
+                else:
+                    df.reset_index(names="event", inplace=True)
+
+                if add_extra_data:  # For now only add pixel names
+                    annotate_board_info(df, board_info_df, script_logger)
+
+                script_logger.info('Saving run metadata into database...')
+                data_writer.write(df)
+                if follow:  # Make the events processed so far readable while the run is ongoing
+                    data_writer.flush()
+
+            # Record the hash of the original data, so it can be checked if the raw data changed
+            write_raw_data_hashes(backup_data_dir, Miso.path_directory/"raw_data.sha256")
+
+            if read_statistics.get("quarantine") is not None:
+                script_logger.info('Saving the rows which failed the validation into the quarantine table...')
+                write_table(read_statistics["quarantine"].reset_index(names="row"), data_dir, 'quarantine', backend=storage_backend)
+
+            if event_builder == "sequence":
+                match_stats_df = match_stats_df.astype("int64")
+                match_stats_df.index.name = "data_board_id"
+                event_boards_df = event_boards_statistics(numpy.concatenate(event_boards_stats) if len(event_boards_stats) > 0 else numpy.zeros(0, dtype=numpy.int32))
+
+                script_logger.info("Built {} events with at least {} of the boards {}, event building statistics per board:\n{}".format(next_event, min_boards, pattern, match_stats_df))
+                script_logger.info("Events per combination of boards:\n{}".format(event_boards_df))
+                write_table(match_stats_df, data_dir, 'event_building_info', backend=storage_backend, index=True)
+                write_table(event_boards_df, data_dir, 'event_boards_info', backend=storage_backend, index=True)
+            elif pattern is not None and len(pattern) > 0:
+                if leftover_df is not None:  # The rows left at the end of the file can not be matched anymore
+                    leftover_board_ids = leftover_df['data_board_id'].to_numpy()
+                    match_stats_df = match_stats_df.add(pattern_match_statistics(leftover_board_ids, numpy.full(len(leftover_board_ids), -1)), fill_value=0)
+                match_stats_df = match_stats_df.astype("int64")
+                match_stats_df.index.name = "data_board_id"
+
+                script_logger.info("Built {} events with the pattern {}, event building statistics per board:\n{}".format(next_event, pattern, match_stats_df))
+                write_table(match_stats_df, data_dir, 'event_building_info', backend=storage_backend, index=True)
 
 def script_main(
         input_file:Path,
@@ -157,6 +255,18 @@ def script_main(
         drop_old_data:bool=True,
         make_plots:bool=True,
         pattern:list[int]=[0,1,3],
+        chunk_size:int=None,
+        parser:str="pandas",
+        follow:bool=False,
+        follow_interval:float=10,
+        follow_timeout:float=300,
+        board_ids:list[int]=None,
+        max_workers:int=1,
+        event_builder:str="pattern",
+        min_boards:int=2,
+        max_time_difference:float=1,
+        validate:bool=True,
+        storage_backend:str=default_storage_backend,
         ):
 
     script_logger = logging.getLogger('process_run')
@@ -171,6 +281,28 @@ def script_main(
     if ignore_rows < 0:
         raise RuntimeError("The number of rows to ignore should be greater or equal to 0")
 
+    if chunk_size is not None and chunk_size <= 0:
+        raise RuntimeError("The chunk size should be greater than 0")
+
+    if follow and (follow_interval <= 0 or follow_timeout <= 0):
+        raise RuntimeError("The follow interval and timeout should be greater than 0")
+
+    if event_builder not in raw_data_formats["txt"]["event_builders"]:
+        raise RuntimeError("Unknown event builder: {}".format(event_builder))
+
+    if event_builder == "sequence":
+        if pattern is None or len(pattern) == 0:
+            raise RuntimeError("The sequence event builder needs the readout order of the boards, given by the event pattern")
+        if min_boards < 1 or min_boards > len(pattern):
+            raise RuntimeError("The minimum number of boards in an event should be between 1 and the number of boards in the event pattern")
+        if max_time_difference < 0:
+            raise RuntimeError("The maximum time difference between hits of the same event can not be negative")
+
+    if max_workers != 1 and (follow or chunk_size is not None):
+        raise RuntimeError("The txt file can only be parsed with several processes when it is read at once (no chunk size and not following it)")
+
+    check_raw_data_format(input_file, "txt", script_logger)
+
     with RM.RunManager(output_directory.resolve()) as Bob:
         Bob.create_run(raise_error=True)
 
@@ -183,10 +315,22 @@ def script_main(
             add_extra_data=add_extra_data,
             drop_old_data=drop_old_data,
             pattern=pattern,
+            chunk_size=chunk_size,
+            parser=parser,
+            follow=follow,
+            follow_interval=follow_interval,
+            follow_timeout=follow_timeout,
+            board_ids=board_ids,
+            max_workers=max_workers,
+            event_builder=event_builder,
+            min_boards=min_boards,
+            max_time_difference=max_time_difference,
+            validate=validate,
+            storage_backend=storage_backend,
         )
 
         if Bob.task_completed("proccess_etroc1_data_run_txt") and make_plots:
-            plot_etroc1_task(Bob, "plot_before_cuts", Bob.path_directory/"data"/"data.sqlite")
+            plot_etroc1_task(Bob, "plot_before_cuts", Bob.path_directory/"data")
 
 if __name__ == '__main__':
     import argparse
@@ -239,6 +383,99 @@ if __name__ == '__main__':
         dest = 'event_pattern',
         type = int,
     )
+    parser.add_argument(
+        '-c',
+        '--chunk-size',
+        metavar = 'int',
+        help = "If set, the txt file is read and processed in chunks with this number of lines, keeping the memory usage bounded for very large files. Default: 0 (the whole file is read at once)",
+        default = 0,
+        dest = 'chunk_size',
+        type = int,
+    )
+    parser.add_argument(
+        '--parser',
+        help = "The backend used to parse the txt file. The pyarrow backend is multithreaded but requires the columns to be separated by a single space. Default: pandas",
+        choices = raw_data_formats["txt"]["parsers"],
+        default = "pandas",
+        dest = 'parser',
+    )
+    parser.add_argument(
+        '-f',
+        '--follow',
+        help = "If set, the txt file is followed while it is still being written, the new lines are processed and appended to the output every few seconds (see --follow-interval). It stops once the file stops growing (see --follow-timeout) or is rotated",
+        action = 'store_true',
+        dest = 'follow',
+    )
+    parser.add_argument(
+        '--follow-interval',
+        metavar = 'seconds',
+        help = "When following the txt file, how often to process the new lines. Default: 10",
+        default = 10,
+        dest = 'follow_interval',
+        type = float,
+    )
+    parser.add_argument(
+        '--follow-timeout',
+        metavar = 'seconds',
+        help = "When following the txt file, stop once the file did not grow for this long. Default: 300",
+        default = 300,
+        dest = 'follow_timeout',
+        type = float,
+    )
+    parser.add_argument(
+        '-b',
+        '--board-ids',
+        metavar = 'id',
+        help = "If set, only the hits from these boards are kept, the others are dropped while parsing. Default: all boards",
+        nargs = '+',
+        dest = 'board_ids',
+        type = int,
+    )
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        metavar = 'int',
+        help = "Number of processes used to parse the txt file in parallel, each one parsing a part of the file. Can not be used with --chunk-size or --follow. Default: 1 (0 for the number of processors in the machine)",
+        default = 1,
+        dest = 'jobs',
+        type = int,
+    )
+    parser.add_argument(
+        '--event-builder',
+        help = "The method used to build events from the board hits: pattern (default) only keeps the hits which exactly follow the event pattern; sequence groups consecutive hits which follow the order of the boards in the event pattern and are close in time, allowing events with missing boards (see --min-boards). With the sequence builder, the boards present in each event are saved in the event_boards column (as a bitmask of the board ids)",
+        choices = raw_data_formats["txt"]["event_builders"],
+        default = raw_data_formats["txt"]["event_builders"][0],
+        dest = 'event_builder',
+    )
+    parser.add_argument(
+        '--min-boards',
+        metavar = 'int',
+        help = "With the sequence event builder, the minimum number of boards with a hit for a group of hits to be an event. Default: 2",
+        default = 2,
+        dest = 'min_boards',
+        type = int,
+    )
+    parser.add_argument(
+        '--max-time-difference',
+        metavar = 'seconds',
+        help = "With the sequence event builder, the maximum difference between the timestamps of consecutive hits of the same event. Default: 1",
+        default = 1,
+        dest = 'max_time_difference',
+        type = float,
+    )
+    parser.add_argument(
+        '--no-validation',
+        help = "If set, the rows are not validated while parsing. By default, rows with malformed values, unknown board IDs, codes out of their 10 bit range or invalid hit flags are removed and saved in the quarantine table, together with the reason",
+        action = 'store_true',
+        dest = 'no_validation',
+    )
+    parser.add_argument(
+        '--storage',
+        help = "The format used to store the processed data: arrow, which is memory mapped for very fast reading, parquet, a compressed columnar format, or sqlite, the format used by the older runs. Default: arrow",
+        choices = storage_backends,
+        default = default_storage_backend,
+        dest = 'storage',
+    )
 
     args = parser.parse_args()
 
@@ -270,4 +507,12 @@ if __name__ == '__main__':
         elif args.log_level == "NOTSET":
             logging.basicConfig(level=0)
 
-    script_main(Path(args.file), Path(args.out_directory), not args.keep_all, pattern=pattern)
+    chunk_size = None
+    if args.chunk_size > 0:
+        chunk_size = args.chunk_size
+
+    max_workers = None
+    if args.jobs > 0:
+        max_workers = args.jobs
+
+    script_main(Path(args.file), Path(args.out_directory), not args.keep_all, pattern=pattern, chunk_size=chunk_size, parser=args.parser, follow=args.follow, follow_interval=args.follow_interval, follow_timeout=args.follow_timeout, board_ids=args.board_ids, max_workers=max_workers, event_builder=args.event_builder, min_boards=args.min_boards, max_time_difference=args.max_time_difference, validate=not args.no_validation, storage_backend=args.storage)
@@ -28,9 +28,9 @@ import lip_pps_run_manager as RM
 import logging
 import shutil
 import pandas
-import sqlite3
 
 from utilities import plot_etroc1_task
+from utilities import etroc1_data_view
 from process_etroc1_charge_injection_data_dir import plot_etroc1_combined_task
 from analyse_dac_vs_charge import plot_dac_vs_charge_task
 from calculate_times_in_ns import plot_times_in_ns_task
@@ -56,9 +56,9 @@ def script_main(
             plot_etroc1_combined_task(Geralt, script_logger=script_logger, extra_title=extra_title)
 
         if Geralt.task_completed("proccess_etroc1_data_run") or Geralt.task_completed("proccess_etroc1_data_run_txt"):
-            plot_etroc1_task(Geralt, "plot_before_cuts", Geralt.path_directory/"data"/"data.sqlite", extra_title=extra_title)
+            plot_etroc1_task(Geralt, "plot_before_cuts", Geralt.path_directory/"data", extra_title=extra_title)
             if Geralt.task_completed("apply_event_cuts"):
-                plot_etroc1_task(Geralt, "plot_after_cuts", Geralt.path_directory/"data"/"data.sqlite", extra_title=extra_title, filter_files={"event": Geralt.path_directory/"event_filter.fd"})
+                plot_etroc1_task(Geralt, "plot_after_cuts", Geralt.path_directory/"data", extra_title=extra_title, filter_files={"event": Geralt.path_directory/"event_filter.npz"})
 
         if Geralt.task_completed("calculate_dac_points"):
             plot_dac_vs_charge_task(Geralt, script_logger=script_logger, extra_title=extra_title)
@@ -68,7 +68,7 @@ def script_main(
                 Geralt,
                 script_logger=script_logger,
                 task_name="plot_times_in_ns_before_cuts",
-                data_file=Geralt.get_task_path("calculate_times_in_ns")/'data.sqlite',
+                data_view=etroc1_data_view(Geralt, ["calculate_times_in_ns"]),
                 filter_files={},
                 max_toa=max_toa,
                 max_tot=max_tot,
@@ -80,8 +80,8 @@ def script_main(
                 Geralt,
                 script_logger=script_logger,
                 task_name="plot_times_in_ns_after_cuts",
-                data_file=Geralt.get_task_path("calculate_times_in_ns")/'data.sqlite',
-                filter_files={"event": Geralt.path_directory/"event_filter.fd"},
+                data_view=etroc1_data_view(Geralt, ["calculate_times_in_ns"]),
+                filter_files={"event": Geralt.path_directory/"event_filter.npz"},
                 max_toa=max_toa,
                 max_tot=max_tot,
                 min_toa=0,
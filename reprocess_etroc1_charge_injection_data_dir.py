@@ -28,8 +28,10 @@ import lip_pps_run_manager as RM
 import logging
 from datetime import datetime
 from process_etroc1_charge_injection_data_dir import apply_cuts_to_single_runs_subtask
+from process_etroc1_charge_injection_data_dir import apply_cuts_to_dataset_subtask
 from process_etroc1_charge_injection_data_dir import merge_etroc1_runs_task
 from process_etroc1_charge_injection_data_dir import plot_etroc1_combined_task
+from storage_utilities import has_table
 
 def reprocess_etroc1_data_directory_task(
     AdaLovelace: RM.RunManager,
@@ -41,12 +43,19 @@ def reprocess_etroc1_data_directory_task(
         with AdaLovelace.handle_task("reprocess_etroc1_data_directory", drop_old_data=True) as Turing:
             run_dirs = []
 
-            apply_cuts_to_single_runs_subtask(
-                Turing,
-                script_logger=script_logger,
-                run_dirs=run_dirs,
-                make_plots=make_plots,
-            )
+            if has_table(AdaLovelace.path_directory/"data", "etroc1_sub_runs"):  # All the runs were converted into a single dataset
+                apply_cuts_to_dataset_subtask(
+                    Turing,
+                    script_logger=script_logger,
+                    data_dir=AdaLovelace.path_directory/"data",
+                )
+            else:
+                apply_cuts_to_single_runs_subtask(
+                    Turing,
+                    script_logger=script_logger,
+                    run_dirs=run_dirs,
+                    make_plots=make_plots,
+                )
 
 def script_main(
         output_directory:Path,
@@ -69,7 +78,9 @@ def script_main(
         Guilherme.create_run(raise_error=False)
 
         #run_files = [x for x in input_directory.iterdir() if x.is_file() and str(x)[-11:-4] == "Split_0"]
-        run_dirs = [x for x in (out_dir/"Individual_Runs").iterdir() if x.is_dir()]
+        run_dirs = []
+        if (out_dir/"Individual_Runs").is_dir():
+            run_dirs = [x for x in (out_dir/"Individual_Runs").iterdir() if x.is_dir()]
 
         reprocess_etroc1_data_directory_task(
             Guilherme,
@@ -0,0 +1,984 @@
+#############################################################################
+# zlib License
+#
+# (C) 2023 Cristóvão Beirão da Cruz e Silva <cbeiraod@cern.ch>
+#
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the authors be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#############################################################################
+
+from pathlib import Path # Pathlib documentation, very useful if unfamiliar:
+                         #   https://docs.python.org/3/library/pathlib.html
+
+import logging
+import shutil
+import sqlite3
+import json
+import pandas
+import numpy
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+
+# The data of each stage is saved in a data directory (e.g. the "data" directory of a run or the
+# directory of a task), which holds one or more tables. The tables can be stored with one of the backends:
+#  - arrow: each table is a directory "<table>.arrow" with one or more Arrow IPC (Feather v2) files, which
+#           are memory mapped when read, so the columns are used directly from the files without copying
+#           them (unless `arrow_compression` is set, then the data is decompressed into memory)
+#  - parquet: each table is a directory "<table>.parquet" with one or more parquet files, the rows of
+#             each file are split into row groups of `parquet_row_group_events` events and the column
+#             statistics are saved, so the files are compact and can be filtered efficiently
+#  - sqlite: all the tables are in a single "data.sqlite" file, the format used by the older runs
+# When a table is found with more than one backend, the first one in `storage_backends` is used.
+# The stages which need the hits of each event side by side use the event tensor of a table (see `EventTensor`),
+# which is built from the table the first time it is needed, saved next to it as "<table>.tensor" and
+# removed by the table writers whenever the table is written.
+# The arrow and parquet files keep the dtype of each column, but sqlite only has a few storage types, so the
+# logical dtype of each column of the tables stored with the sqlite backend (e.g. int8, bool, category or
+# float32) is saved in the `sqlite_schema_table` table of the data.sqlite file and restored when read.
+# The memory footprint of each table read and written is logged with the "storage" logger.
+storage_backends = ["arrow", "parquet", "sqlite"]
+default_storage_backend = "arrow"
+sqlite_file_name = "data.sqlite"
+arrow_compression = None  # Set to "lz4" to compress the arrow files
+parquet_row_group_events = 100000
+parquet_row_group_rows = 1000000  # For tables without an event column or with the events out of order
+sqlite_batch_rows = 200000
+sqlite_schema_table = "_logical_schema"
+storage_logger = logging.getLogger('storage')
+
+def arrow_table_path(data_dir: Path, table: str):
+    return data_dir/"{}.arrow".format(table)
+
+def parquet_table_path(data_dir: Path, table: str):
+    return data_dir/"{}.parquet".format(table)
+
+def sqlite_has_table(sqlite_file: Path, table: str):
+    if not sqlite_file.is_file():
+        return False
+    with sqlite3.connect(sqlite_file) as sqlite3_connection:
+        return sqlite3_connection.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone() is not None
+
+def find_table_backend(data_dir: Path, table: str):
+    """
+    Find the backend a table is stored with in a data directory, or `None`
+    if the table does not exist
+    """
+    if arrow_table_path(data_dir, table).is_dir():
+        return "arrow"
+    if parquet_table_path(data_dir, table).is_dir():
+        return "parquet"
+    if sqlite_has_table(data_dir/sqlite_file_name, table):
+        return "sqlite"
+    return None
+
+def has_table(data_dir: Path, table: str):
+    return find_table_backend(data_dir, table) is not None
+
+def table_files(data_dir: Path, table: str):
+    """
+    Returns the part files of a table stored with the arrow or parquet
+    backends, the tables stored with the sqlite backend share the data.sqlite
+    file and do not have files of their own
+    """
+    backend = find_table_backend(data_dir, table)
+    if backend == "arrow":
+        return sorted(arrow_table_path(data_dir, table).glob("part-*.arrow"))
+    elif backend == "parquet":
+        return sorted(parquet_table_path(data_dir, table).glob("part-*.parquet"))
+    elif backend == "sqlite":
+        raise RuntimeError("The table {} in {} is stored in the {} file".format(table, data_dir, sqlite_file_name))
+    raise RuntimeError("The table {} does not exist in {}".format(table, data_dir))
+
+def list_sqlite_tables(sqlite_file: Path):
+    if not sqlite_file.is_file():
+        return []
+    with sqlite3.connect(sqlite_file) as sqlite3_connection:
+        return [name for (name,) in sqlite3_connection.execute("SELECT name FROM sqlite_master WHERE type='table' AND name<>? ORDER BY name", (sqlite_schema_table,))]
+
+def list_tables(data_dir: Path):
+    """
+    Returns a dictionary with the tables in a data directory and the backend
+    each one is stored with
+    """
+    tables = {}
+    for table in list_sqlite_tables(data_dir/sqlite_file_name):
+        tables[table] = "sqlite"
+    if data_dir.is_dir():
+        for extension, backend in [(".parquet", "parquet"), (".arrow", "arrow")]:
+            for table_path in sorted(data_dir.glob("*" + extension)):
+                if table_path.is_dir():
+                    tables[table_path.name[:-len(extension)]] = backend
+    return tables
+
+def open_arrow_table(
+    data_dir: Path,
+    table: str,
+    columns: list[str] = None,
+):
+    """
+    Open the files of a table stored with the arrow backend with memory
+    mapping, the returned arrow table refers to the data in the files
+    """
+    tables = []
+    for part_file in sorted(arrow_table_path(data_dir, table).glob("part-*.arrow")):
+        arrow_table = pyarrow.ipc.open_file(pyarrow.memory_map(str(part_file))).read_all()
+        if columns is not None:
+            arrow_table = arrow_table.select(columns)
+        tables += [arrow_table]
+    if len(tables) == 0:
+        raise RuntimeError("The table {} in {} does not have any data yet".format(table, data_dir))
+    return pyarrow.concat_tables(tables)
+
+def table_columns(
+    data_dir: Path,
+    table: str,
+):
+    """
+    Returns the names of the columns of a table in a data directory, without
+    reading its data
+    """
+    backend = find_table_backend(data_dir, table)
+    if backend == "arrow":
+        return open_arrow_table(data_dir, table).schema.names
+    elif backend == "parquet":
+        return pyarrow.parquet.ParquetDataset(parquet_table_path(data_dir, table)).schema.names
+    elif backend == "sqlite":
+        with sqlite3.connect(data_dir/sqlite_file_name) as sqlite3_connection:
+            return [row[1] for row in sqlite3_connection.execute('PRAGMA table_info("{}")'.format(table))]
+    raise RuntimeError("The table {} does not exist in {}".format(table, data_dir))
+
+def memory_footprint(df: pandas.DataFrame):
+    """
+    Returns the memory used by a dataframe in bytes, including the python
+    objects of the object columns
+    """
+    return int(df.memory_usage(index=False, deep=True).sum())
+
+def log_memory_footprint(action: str, table: str, data_dir: Path, rows: int, footprint: int):
+    storage_logger.info("{} the table {} of {}: {} rows, {:.1f} MB in memory ({:.1f} bytes per row)".format(action, table, data_dir, rows, footprint/1024**2, footprint/max(rows, 1)))
+
+def logical_schema(df: pandas.DataFrame):
+    """
+    Returns the logical dtype of each column of a dataframe as a list of
+    (column, position, dtype, categories) tuples, where the categories of the
+    categorical columns are saved as a json list
+    """
+    schema = []
+    for position, column in enumerate(df.columns):
+        dtype = df[column].dtype
+        categories = None
+        if isinstance(dtype, pandas.CategoricalDtype):
+            categories = json.dumps({"categories": dtype.categories.tolist(), "ordered": bool(dtype.ordered)})
+            dtype = "category"
+        schema += [(column, position, str(dtype), categories)]
+    return schema
+
+def restore_logical_dtypes(df: pandas.DataFrame, schema: list[tuple]):
+    """
+    Convert the columns of a dataframe read from sqlite back into the logical
+    dtypes of `schema`. The integer and boolean columns with missing values,
+    which the original columns could not have had, are left as they are.
+    """
+    for column, position, dtype, categories in schema:
+        if column not in df:
+            continue
+        if dtype == "category":
+            categories = json.loads(categories)
+            df[column] = df[column].astype(pandas.CategoricalDtype(categories["categories"], ordered=categories["ordered"]))
+        elif dtype.startswith("datetime64"):
+            df[column] = pandas.to_datetime(df[column])
+        elif dtype != "object" and dtype != str(df[column].dtype):
+            logical_dtype = pandas.api.types.pandas_dtype(dtype)
+            if isinstance(logical_dtype, numpy.dtype) and logical_dtype.kind in "iub" and df[column].hasnans:
+                continue
+            df[column] = df[column].astype(logical_dtype)
+    return df
+
+def read_sqlite_schema(sqlite3_connection: sqlite3.Connection, table: str):
+    """
+    Returns the logical schema of a table saved in the data.sqlite file, or an
+    empty list for the tables saved by the older versions of the scripts
+    """
+    if sqlite3_connection.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (sqlite_schema_table,)).fetchone() is None:
+        return []
+    return sqlite3_connection.execute('SELECT "column", "position", "dtype", "categories" FROM "{}" WHERE "table"=? ORDER BY "position"'.format(sqlite_schema_table), (table,)).fetchall()
+
+def read_table(
+    data_dir: Path,
+    table: str,
+    columns: list[str] = None,
+):
+    """
+    Read a table from a data directory into a dataframe, whatever the backend
+    it was stored with. If `columns` is set, only those columns are read, in
+    the given order (repeated columns are read once).
+
+    The tables stored with the arrow backend are memory mapped and, for the
+    columns without missing values in a single file, the dataframe holds
+    read-only views of the data in the files instead of copies. The columns
+    of the tables stored with the sqlite backend get back the dtypes they
+    were written with.
+    """
+    backend = find_table_backend(data_dir, table)
+    if backend is None:
+        raise RuntimeError("The table {} does not exist in {}".format(table, data_dir))
+
+    if columns is not None:
+        columns = list(dict.fromkeys(columns))
+        available_columns = table_columns(data_dir, table)
+        missing_columns = [column for column in columns if column not in available_columns]
+        if len(missing_columns) > 0:
+            raise RuntimeError("The table {} in {} does not have the columns: {}".format(table, data_dir, ", ".join(missing_columns)))
+
+    if backend == "arrow":
+        df = open_arrow_table(data_dir, table, columns=columns).to_pandas(split_blocks=True)  # One block per column, so the columns are not copied into a single array
+    elif backend == "parquet":
+        df = pyarrow.parquet.read_table(parquet_table_path(data_dir, table), columns=columns).to_pandas()
+    else:
+        if columns is None:
+            query = 'SELECT * FROM "{}"'.format(table)
+        else:
+            query = 'SELECT {} FROM "{}"'.format(", ".join('"{}"'.format(column) for column in columns), table)
+        with sqlite3.connect(data_dir/sqlite_file_name) as sqlite3_connection:
+            df = pandas.read_sql(query, sqlite3_connection, index_col=None)
+            df = restore_logical_dtypes(df, read_sqlite_schema(sqlite3_connection, table))
+
+    if storage_logger.isEnabledFor(logging.INFO):
+        log_memory_footprint("Read", table, data_dir, len(df), memory_footprint(df))
+    return df
+
+class TableView:
+    """
+    A table made of the columns of a base table joined with the columns of
+    sidecar tables, which hold the columns derived from the base table by
+    the later stages with the same key columns. Nothing is read until `read`
+    is called and then only the tables with the requested columns are read.
+    When a column is in more than one table, the last table added is used.
+    """
+    def __init__(self, data_dir: Path, table: str, keys: list[str] = ["event", "data_board_id"]):
+        self._tables = [(data_dir, table)]
+        self._keys = keys
+
+    def add_sidecar(self, data_dir: Path, table: str):
+        self._tables += [(data_dir, table)]
+
+    def tables(self):
+        """
+        Returns the (data directory, table) tuples of the base table and of
+        the sidecar tables
+        """
+        return list(self._tables)
+
+    def columns(self):
+        columns = []
+        for data_dir, table in self._tables:
+            columns += table_columns(data_dir, table)
+        return list(dict.fromkeys(columns))
+
+    def _find_column_tables(self, columns: list[str]):
+        """
+        Returns, for each table of the view, the list of the given columns
+        which are read from it
+        """
+        table_read_columns = [[] for _ in self._tables]
+        missing_columns = []
+        all_table_columns = [table_columns(data_dir, table) for data_dir, table in self._tables]
+        for column in columns:
+            if column in self._keys:
+                continue
+            for idx in reversed(range(len(self._tables))):
+                if column in all_table_columns[idx]:
+                    table_read_columns[idx] += [column]
+                    break
+            else:
+                missing_columns += [column]
+        if len(missing_columns) > 0:
+            raise RuntimeError("The columns {} can not be found in the tables {}".format(", ".join(missing_columns), ", ".join(str(data_dir/table) for data_dir, table in self._tables)))
+        return table_read_columns
+
+    def read(self, columns: list[str] = None):
+        if columns is None:
+            columns = self.columns()
+        columns = list(dict.fromkeys(columns))
+        table_read_columns = self._find_column_tables(columns)
+
+        data_dir, table = self._tables[0]
+        df = read_table(data_dir, table, columns=self._keys + table_read_columns[0])
+        for (data_dir, table), read_columns in zip(self._tables[1:], table_read_columns[1:]):
+            if len(read_columns) == 0:
+                continue
+            sidecar_df = read_table(data_dir, table, columns=self._keys + read_columns)
+            if len(sidecar_df) == len(df) and all(numpy.array_equal(sidecar_df[key].to_numpy(), df[key].to_numpy()) for key in self._keys):
+                # The sidecar has the same rows in the same order as the base table, so there is no need to join on the keys
+                for column in read_columns:
+                    df[column] = sidecar_df[column].to_numpy()
+            else:
+                df = df.merge(sidecar_df, how="left", on=self._keys)
+
+        if list(df.columns) != columns:
+            df = df[columns]
+        return df
+
+    def tensor(self, variables: list[str]):
+        """
+        Returns the given columns as an `EventTensor` with the events and
+        boards of the base table, the tensor of each table is built the
+        first time it is used and memory mapped afterwards
+        """
+        variables = list(dict.fromkeys(variables))
+        table_read_columns = self._find_column_tables(variables)
+
+        base_tensor = read_event_tensor(*self._tables[0], keys=self._keys)
+        layers = {}
+        for (data_dir, table), read_columns in zip(self._tables, table_read_columns):
+            if len(read_columns) == 0:
+                continue
+            tensor = read_event_tensor(data_dir, table, keys=self._keys)
+            for column in read_columns:
+                layers[column] = tensor.aligned_layer(column, base_tensor.events, base_tensor.boards)
+
+        return EventTensor(base_tensor.events, base_tensor.boards, base_tensor.hits, {variable: layers[variable] for variable in variables})
+
+class EventTensor:
+    """
+    The hits of a table laid out as a dense tensor, with one row per event,
+    one column per board and one layer per variable, where the missing hits
+    are NaN (`hits` flags the event and board pairs with data). Selecting a
+    `(variable, board_id)` pair returns a series indexed by event, like
+    selecting a column of the table pivoted with the boards as columns, and
+    selecting a variable returns its layer as an array.
+    """
+    def __init__(self, events: numpy.ndarray, boards: numpy.ndarray, hits: numpy.ndarray, layers: dict[str, numpy.ndarray]):
+        self.events = events
+        self.boards = boards
+        self.hits = hits
+        self.layers = layers
+        self.event_index = pandas.Index(events, name="event")
+
+    def variables(self):
+        return list(self.layers)
+
+    def board_index(self, board_id: int):
+        idx = numpy.searchsorted(self.boards, board_id)
+        if idx == len(self.boards) or self.boards[idx] != board_id:
+            raise RuntimeError("The board {} does not have any data, the boards with data are: {}".format(board_id, list(self.boards)))
+        return idx
+
+    def locate(self, events: numpy.ndarray, boards: numpy.ndarray):
+        """
+        Returns the row and column of the tensor for each pair of event and
+        board, which must have a hit
+        """
+        return numpy.searchsorted(self.events, events), numpy.searchsorted(self.boards, boards)
+
+    def aligned_layer(self, variable: str, events: numpy.ndarray, boards: numpy.ndarray):
+        """
+        Returns the layer of a variable with the rows and columns of the given
+        events and boards, the ones not in this tensor are NaN
+        """
+        layer = self.layers[variable]
+        if numpy.array_equal(events, self.events) and numpy.array_equal(boards, self.boards):
+            return layer
+
+        aligned_layer = numpy.full((len(events), len(boards)), numpy.nan)
+        event_idx = numpy.searchsorted(events, self.events)
+        board_idx = numpy.searchsorted(boards, self.boards)
+        event_found = event_idx < len(events)
+        event_found[event_found] = events[event_idx[event_found]] == self.events[event_found]
+        board_found = board_idx < len(boards)
+        board_found[board_found] = boards[board_idx[board_found]] == self.boards[board_found]
+        aligned_layer[numpy.ix_(event_idx[event_found], board_idx[board_found])] = layer[numpy.ix_(event_found, board_found)]
+        return aligned_layer
+
+    def boards_with_hits(self):
+        return self.boards[self.hits.any(axis=0)]
+
+    def to_frame(self, variables: list[str] = None, events: numpy.ndarray = None):
+        """
+        Returns the layers of the given variables as a dataframe indexed by
+        event with a column "<variable>_<board_id>" for each variable and
+        board. If `events` is set, only those events are kept.
+        """
+        if variables is None:
+            variables = self.variables()
+
+        event_index = self.event_index
+        rows = slice(None)
+        if events is not None:
+            rows = numpy.searchsorted(self.events, events)
+            event_index = self.event_index[rows]
+
+        columns = {}
+        for variable in variables:
+            for board_idx, board_id in enumerate(self.boards):
+                columns["{}_{}".format(variable, board_id)] = self.layers[variable][rows, board_idx]
+        return pandas.DataFrame(columns, index=event_index)
+
+    def __contains__(self, variable: str):
+        return variable in self.layers
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            variable, board_id = key
+            return pandas.Series(self.layers[variable][:, self.board_index(board_id)], index=self.event_index, name=key)
+        return self.layers[key]
+
+    def __setitem__(self, variable: str, layer: numpy.ndarray):
+        self.layers[variable] = layer
+
+def event_tensor_path(data_dir: Path, table: str):
+    return data_dir/"{}.tensor".format(table)
+
+def remove_event_tensor(data_dir: Path, table: str):
+    if event_tensor_path(data_dir, table).is_dir():
+        shutil.rmtree(event_tensor_path(data_dir, table))
+
+def build_event_tensor(data_dir: Path, table: str, keys: list[str] = ["event", "data_board_id"]):
+    """
+    Build the event tensor of a table and save it next to the table, in the
+    directory "<table>.tensor" with the arrays as numpy files:
+     - events.npy and boards.npy: the sorted events and boards of the table
+     - hits.npy: n_events x n_boards, true where the table has a row
+     - values.npy: n_events x n_boards x n_variables, every numeric column
+                   of the table as float, NaN where there is no row
+     - variables.npy: the name of the variable of each layer of values.npy
+    The columns which can not be converted into numbers are left out.
+    """
+    event_column, board_column = keys
+    df = read_table(data_dir, table)
+
+    events, event_idx = numpy.unique(df[event_column].to_numpy(), return_inverse=True)
+    boards, board_idx = numpy.unique(df[board_column].to_numpy(), return_inverse=True)
+    if len(df) > 0 and numpy.bincount(event_idx*len(boards) + board_idx).max() > 1:
+        raise RuntimeError("The table {} in {} has more than one row for the same {} and {}, it can not be laid out as an event tensor".format(table, data_dir, event_column, board_column))
+
+    columns = {}
+    for column in df.columns:
+        if column in keys or pandas.api.types.is_datetime64_any_dtype(df[column]):
+            continue
+        try:
+            columns[column] = df[column].to_numpy(dtype=numpy.float64, na_value=numpy.nan)
+        except (TypeError, ValueError):
+            continue
+
+    # Written with a hidden name and renamed once complete, like the part files of the tables
+    tensor_path = event_tensor_path(data_dir, table)
+    tmp_path = data_dir/("." + tensor_path.name)
+    if tmp_path.is_dir():
+        shutil.rmtree(tmp_path)
+    tmp_path.mkdir()
+
+    numpy.save(tmp_path/"events.npy", events)
+    numpy.save(tmp_path/"boards.npy", boards)
+    numpy.save(tmp_path/"variables.npy", numpy.array(list(columns), dtype=str))
+
+    hits = numpy.lib.format.open_memmap(tmp_path/"hits.npy", mode="w+", dtype=bool, shape=(len(events), len(boards)))
+    hits[event_idx, board_idx] = True
+    hits.flush()
+    del hits
+
+    values = numpy.lib.format.open_memmap(tmp_path/"values.npy", mode="w+", dtype=numpy.float64, shape=(len(events), len(boards), len(columns)))
+    values[:] = numpy.nan
+    for idx, column in enumerate(columns):
+        values[event_idx, board_idx, idx] = columns[column]
+    values.flush()
+    del values
+
+    if tensor_path.is_dir():
+        shutil.rmtree(tensor_path)
+    tmp_path.rename(tensor_path)
+
+def read_event_tensor(data_dir: Path, table: str, keys: list[str] = ["event", "data_board_id"]):
+    """
+    Returns the event tensor of a table, with a layer for every numeric
+    column. The tensor is built when it does not exist, otherwise the saved
+    arrays are memory mapped (the table writers remove the tensor of a table
+    whenever they write to it, so it is never out of date).
+    """
+    tensor_path = event_tensor_path(data_dir, table)
+    if not tensor_path.is_dir():
+        build_event_tensor(data_dir, table, keys=keys)
+
+    values = numpy.load(tensor_path/"values.npy", mmap_mode="r")
+    variables = numpy.load(tensor_path/"variables.npy")
+    return EventTensor(
+        events=numpy.load(tensor_path/"events.npy"),
+        boards=numpy.load(tensor_path/"boards.npy"),
+        hits=numpy.load(tensor_path/"hits.npy", mmap_mode="r"),
+        layers={str(variable): values[:, :, idx] for idx, variable in enumerate(variables)},
+    )
+
+class CutflowFilter:
+    """
+    The result of each cut of a cutflow for each event, packed as one bit per
+    event and cut: bit `i % 8` of byte `i // 8` of the row of an event is set
+    when the event passes cut `i`. The events accepted after any number of
+    cuts are found by AND-ing the bits of those cuts. The events must be
+    sorted.
+    """
+    def __init__(self, events: numpy.ndarray, bits: numpy.ndarray, cuts: list[str], outputs: list[str]):
+        self.events = events
+        self.bits = bits
+        self.cuts = list(cuts)
+        self.outputs = list(outputs)  # The output name of each cut, empty for the cuts without partial cut plots
+
+    @classmethod
+    def from_masks(cls, events: numpy.ndarray, masks: list[numpy.ndarray], cuts: list[str] = None, outputs: list[str] = None):
+        """
+        Build the filter from the boolean mask of each cut over the events
+        """
+        if cuts is None:
+            cuts = [str(idx) for idx in range(len(masks))]
+        if outputs is None:
+            outputs = [""] * len(masks)
+        if len(masks) == 0:
+            bits = numpy.zeros((len(events), 0), dtype=numpy.uint8)
+        else:
+            bits = numpy.packbits(numpy.stack(masks, axis=1), axis=1, bitorder="little")
+        return cls(events, bits, cuts, outputs)
+
+    def accepted(self, n_cuts: int = None):
+        """
+        Returns the mask of the events which pass the first `n_cuts` cuts, or
+        all of them if not set
+        """
+        if n_cuts is None:
+            n_cuts = len(self.cuts)
+        accepted = numpy.ones(len(self.events), dtype=bool)
+        full_bytes, extra_bits = divmod(n_cuts, 8)
+        for byte in range(full_bytes):
+            accepted &= self.bits[:, byte] == 0xFF
+        if extra_bits > 0:
+            byte_mask = (1 << extra_bits) - 1
+            accepted &= (self.bits[:, full_bytes] & byte_mask) == byte_mask
+        return accepted
+
+    def prefix(self, n_cuts: int):
+        """
+        Returns the filter with only the first `n_cuts` cuts
+        """
+        full_bytes, extra_bits = divmod(n_cuts, 8)
+        bits = self.bits[:, :full_bytes + (1 if extra_bits > 0 else 0)].copy()
+        if extra_bits > 0:
+            bits[:, full_bytes] &= (1 << extra_bits) - 1
+        return CutflowFilter(self.events, bits, self.cuts[:n_cuts], self.outputs[:n_cuts])
+
+    def steps(self):
+        """
+        Returns the steps of the cutflow with partial cut plots, i.e. the cuts
+        with an output, named "<cut>-<output>", and the number of cuts up to
+        and including each one
+        """
+        return {"{}-{}".format(cut, output): idx + 1 for idx, (cut, output) in enumerate(zip(self.cuts, self.outputs)) if output != ""}
+
+    def row_mask(self, events: numpy.ndarray, n_cuts: int = None):
+        """
+        Returns the mask of the rows of a table, given the event of each row,
+        whose event passes the first `n_cuts` cuts (all if not set), the
+        events not in the filter are not accepted
+        """
+        if len(self.events) == 0:
+            return numpy.zeros(len(events), dtype=bool)
+        if self.events[-1] - self.events[0] + 1 == len(self.events):  # Consecutive events, the position of each one is known
+            event_idx = events - self.events[0]
+            found = (event_idx >= 0) & (event_idx < len(self.events))
+            event_idx[~found] = 0
+        else:
+            event_idx = numpy.searchsorted(self.events, events)
+            found = event_idx < len(self.events)
+            found[found] = self.events[event_idx[found]] == events[found]
+        return found & self.accepted(n_cuts)[numpy.minimum(event_idx, len(self.events) - 1)]
+
+def has_filter(file_path: Path):
+    return file_path.is_file() or file_path.with_suffix(".fd").is_file()
+
+def read_filter(file_path: Path):
+    """
+    Read a filter saved by `write_filter`. The older runs have the filters
+    saved as feather files, with the accepted flag of each event, which are
+    read as a filter with a single cut.
+    """
+    if not file_path.is_file() and file_path.with_suffix(".fd").is_file():
+        file_path = file_path.with_suffix(".fd")
+
+    if file_path.suffix == ".fd":
+        filter_df = pandas.read_feather(file_path).sort_values("event")
+        return CutflowFilter.from_masks(filter_df["event"].to_numpy(), [filter_df["accepted"].to_numpy(dtype=bool)])
+
+    with numpy.load(file_path) as filter_file:
+        return CutflowFilter(
+            events=filter_file["events"],
+            bits=filter_file["bits"],
+            cuts=[str(cut) for cut in filter_file["cuts"]],
+            outputs=[str(output) for output in filter_file["outputs"]],
+        )
+
+def write_filter(cutflow_filter: CutflowFilter, file_path: Path):
+    """
+    Save a filter as a compressed numpy .npz file, replacing the feather file of the
+    older runs if there is one
+    """
+    tmp_path = file_path.with_name("." + file_path.name)
+    with open(tmp_path, "wb") as tmp_file:
+        numpy.savez_compressed(
+            tmp_file,
+            events=cutflow_filter.events,
+            bits=cutflow_filter.bits,
+            cuts=numpy.array(cutflow_filter.cuts, dtype=str),
+            outputs=numpy.array(cutflow_filter.outputs, dtype=str),
+        )
+    tmp_path.rename(file_path)
+
+    if file_path.with_suffix(".fd").is_file():
+        file_path.with_suffix(".fd").unlink()
+
+def remove_table(data_dir: Path, table: str, backend: str = None):
+    """
+    Remove a table from a data directory, from all the backends unless the
+    backend is set
+    """
+    if backend in [None, "arrow"] and arrow_table_path(data_dir, table).is_dir():
+        shutil.rmtree(arrow_table_path(data_dir, table))
+    if backend in [None, "parquet"] and parquet_table_path(data_dir, table).is_dir():
+        shutil.rmtree(parquet_table_path(data_dir, table))
+    if backend in [None, "sqlite"] and sqlite_has_table(data_dir/sqlite_file_name, table):
+        with sqlite3.connect(data_dir/sqlite_file_name) as sqlite3_connection:
+            sqlite3_connection.execute('DROP TABLE "{}"'.format(table))
+            if read_sqlite_schema(sqlite3_connection, table) != []:
+                sqlite3_connection.execute('DELETE FROM "{}" WHERE "table"=?'.format(sqlite_schema_table), (table,))
+    remove_event_tensor(data_dir, table)
+
+def event_row_groups(df: pandas.DataFrame, row_group_events: int):
+    """
+    Returns the row where each row group starts, so that each row group holds
+    the rows of `row_group_events` consecutive events
+    """
+    if "event" not in df or len(df) == 0:
+        return numpy.arange(0, len(df), parquet_row_group_rows)
+    events = df["event"].to_numpy()
+    if numpy.any(events[1:] < events[:-1]):  # The events are out of order, fall back to a fixed number of rows
+        return numpy.arange(0, len(df), parquet_row_group_rows)
+    groups = events//row_group_events
+    return numpy.concatenate([[0], numpy.flatnonzero(groups[1:] != groups[:-1]) + 1])
+
+class PartFileTableWriter:
+    """
+    Base class of the writers which save a table as a directory of files,
+    the file being written has a hidden name and is renamed once it is
+    complete so the table can always be read. Calling `flush` completes the
+    current file, making the data written so far readable, and the next
+    dataframes go into a new file of the same table. The event tensor at
+    `tensor_path`, if any, is removed whenever a file is completed.
+    """
+    extension = None
+
+    def __init__(self, table_path: Path, tensor_path: Path = None):
+        self._path = table_path
+        self._tensor_path = tensor_path
+        self._schema = None
+        self._writer = None
+        self._part = 0
+        self._rows = 0
+        self._footprint = 0
+
+        if self._path.is_dir():
+            shutil.rmtree(self._path)
+
+    def _part_name(self):
+        return "part-{:05d}{}".format(self._part, self.extension)
+
+    def _open_file(self, file_path: Path):
+        raise NotImplementedError
+
+    def _write_table(self, table: pyarrow.Table, df: pandas.DataFrame):
+        raise NotImplementedError
+
+    def write(self, df: pandas.DataFrame):
+        if self._schema is None:
+            table = pyarrow.Table.from_pandas(df, preserve_index=False)
+            self._schema = table.schema
+        else:
+            table = pyarrow.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+
+        if self._writer is None:
+            self._path.mkdir(parents=True, exist_ok=True)
+            self._writer = self._open_file(self._path/("." + self._part_name()))
+
+        self._write_table(table, df)
+        self._rows += len(df)
+        if storage_logger.isEnabledFor(logging.INFO):
+            self._footprint += memory_footprint(df)
+
+    def flush(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            (self._path/("." + self._part_name())).rename(self._path/self._part_name())
+            self._part += 1
+            if self._tensor_path is not None and self._tensor_path.is_dir():
+                shutil.rmtree(self._tensor_path)
+
+    def close(self):
+        self.flush()
+        if self._schema is not None and storage_logger.isEnabledFor(logging.INFO):
+            log_memory_footprint("Wrote", self._path.stem, self._path.parent, self._rows, self._footprint)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class ArrowTableWriter(PartFileTableWriter):
+    """
+    Writes the dataframes given to `write` into a table in the Arrow IPC
+    format, each dataframe is saved as a single record batch so its columns
+    can be memory mapped as contiguous arrays
+    """
+    extension = ".arrow"
+
+    def __init__(self, data_dir: Path, table: str):
+        super().__init__(arrow_table_path(data_dir, table), event_tensor_path(data_dir, table))
+        self._options = pyarrow.ipc.IpcWriteOptions(compression=arrow_compression)
+
+    def _open_file(self, file_path: Path):
+        return pyarrow.ipc.new_file(str(file_path), self._schema, options=self._options)
+
+    def _write_table(self, table: pyarrow.Table, df: pandas.DataFrame):
+        self._writer.write_table(table.combine_chunks(), max_chunksize=None)
+
+class ParquetTableWriter(PartFileTableWriter):
+    """
+    Writes the dataframes given to `write` into a table in the parquet format,
+    with row groups of `row_group_events` events
+    """
+    extension = ".parquet"
+
+    def __init__(self, data_dir: Path, table: str, row_group_events: int = parquet_row_group_events):
+        super().__init__(parquet_table_path(data_dir, table), event_tensor_path(data_dir, table))
+        self._row_group_events = row_group_events
+
+    def _open_file(self, file_path: Path):
+        return pyarrow.parquet.ParquetWriter(file_path, self._schema, write_statistics=True)
+
+    def _write_table(self, table: pyarrow.Table, df: pandas.DataFrame):
+        starts = event_row_groups(df, self._row_group_events)
+        ends = numpy.append(starts[1:], len(df))
+        for start, end in zip(starts, ends):
+            self._writer.write_table(table.slice(start, end - start), row_group_size=end - start)
+
+# The sqlite type used to store each type of column, the same types used by pandas
+sqlite_column_types = {
+    "integer": "INTEGER",
+    "boolean": "INTEGER",
+    "floating": "REAL",
+    "mixed-integer-float": "REAL",
+    "decimal": "REAL",
+    "datetime64": "TIMESTAMP",
+    "datetime": "TIMESTAMP",
+    "date": "DATE",
+}
+
+def sqlite_column_type(series: pandas.Series):
+    """
+    Returns the sqlite type used to store a column, the type of the columns
+    of python objects is found from their values
+    """
+    return sqlite_column_types.get(pandas.api.types.infer_dtype(series, skipna=True), "TEXT")
+
+def sqlite_column_values(series: pandas.Series):
+    """
+    Returns the values of a column as a list of python objects which can be
+    stored by sqlite, the missing values are replaced by `None`
+    """
+    if series.dtype.kind == "M":
+        # The timestamps are converted into the text format used by pandas, each distinct timestamp only once
+        codes, timestamps = pandas.factorize(series)
+        text = numpy.array(timestamps.astype(str).tolist() + [None], dtype=object)  # The missing timestamps have the code -1
+        return text[codes].tolist()
+    elif isinstance(series.dtype, pandas.CategoricalDtype):
+        values = series.astype(object).tolist()
+    elif series.dtype == object and sqlite_column_type(series) in ["INTEGER", "REAL"]:
+        values = pandas.to_numeric(series).tolist()  # The numbers may be numpy types, which sqlite can not store
+    else:
+        values = series.tolist()
+    if series.hasnans:
+        is_missing = series.isna().to_numpy()
+        values = [None if missing else value for value, missing in zip(values, is_missing)]
+    return values
+
+class SQLiteTableWriter:
+    """
+    Writes the dataframes given to `write` into a table of the data.sqlite file,
+    replacing the table at the first write and appending afterwards. The
+    table is created with explicit column types and the rows are inserted in
+    batches of `sqlite_batch_rows` rows, with the journal in WAL mode and
+    without waiting for the data to reach the disk at each commit. Once all
+    the data is written, an index on the event and board is created.
+    """
+    def __init__(self, data_dir: Path, table: str):
+        self._data_dir = data_dir
+        self._table = table
+        self._columns = None
+        self._rows = 0
+        self._footprint = 0
+        self._connection = sqlite3.connect(data_dir/sqlite_file_name)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=OFF")  # Only for this connection, i.e. while writing
+
+    def _create_table(self, df: pandas.DataFrame):
+        self._columns = list(df.columns)
+        column_definitions = ", ".join('"{}" {}'.format(column, sqlite_column_type(df[column])) for column in self._columns)
+        self._connection.execute('DROP TABLE IF EXISTS "{}"'.format(self._table))
+        self._connection.execute('CREATE TABLE "{}" ({})'.format(self._table, column_definitions))
+
+        # Save the dtypes of the columns, so they can be restored when the table is read
+        self._connection.execute('CREATE TABLE IF NOT EXISTS "{}" ("table" TEXT, "column" TEXT, "position" INTEGER, "dtype" TEXT, "categories" TEXT)'.format(sqlite_schema_table))
+        self._connection.execute('DELETE FROM "{}" WHERE "table"=?'.format(sqlite_schema_table), (self._table,))
+        self._connection.executemany(
+            'INSERT INTO "{}" ("table", "column", "position", "dtype", "categories") VALUES (?, ?, ?, ?, ?)'.format(sqlite_schema_table),
+            [(self._table,) + column_schema for column_schema in logical_schema(df)],
+        )
+
+    def write(self, df: pandas.DataFrame):
+        if self._columns is None:
+            self._create_table(df)
+
+        query = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+            self._table,
+            ", ".join('"{}"'.format(column) for column in self._columns),
+            ", ".join("?" for _ in self._columns),
+        )
+        for start in range(0, len(df), sqlite_batch_rows):
+            batch_df = df.iloc[start:start + sqlite_batch_rows]
+            rows = zip(*[sqlite_column_values(batch_df[column]) for column in self._columns])
+            self._connection.executemany(query, rows)
+        self._connection.commit()  # So the table can be written by other connections in the meantime
+        remove_event_tensor(self._data_dir, self._table)
+        self._rows += len(df)
+        if storage_logger.isEnabledFor(logging.INFO):
+            self._footprint += memory_footprint(df)
+
+    def flush(self):
+        self._connection.commit()
+
+    def close(self):
+        if self._connection is not None:
+            if self._columns is not None and "event" in self._columns and "data_board_id" in self._columns:
+                self._connection.execute('CREATE INDEX IF NOT EXISTS "{0}_event_board" ON "{0}" ("event", "data_board_id")'.format(self._table))
+            self._connection.commit()
+            self._connection.close()
+            self._connection = None
+            if self._columns is not None and storage_logger.isEnabledFor(logging.INFO):
+                log_memory_footprint("Wrote", self._table, self._data_dir, self._rows, self._footprint)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# The writer class of each backend
+table_writers = {
+    "arrow": ArrowTableWriter,
+    "parquet": ParquetTableWriter,
+    "sqlite": SQLiteTableWriter,
+}
+
+def open_table_writer(
+    data_dir: Path,
+    table: str,
+    backend: str = None,
+):
+    """
+    Open a writer to save a table piece by piece into a data directory, the
+    existing table with the same name is replaced. If the backend is not
+    set, the default backend is used.
+    """
+    if backend is None:
+        backend = default_storage_backend
+
+    if backend not in storage_backends:
+        raise RuntimeError("Unknown storage backend: {}".format(backend))
+
+    data_dir.mkdir(parents=True, exist_ok=True)
+    remove_table(data_dir, table)
+
+    return table_writers[backend](data_dir, table)
+
+def write_table(
+    df: pandas.DataFrame,
+    data_dir: Path,
+    table: str,
+    backend: str = None,
+    index: bool = False,
+):
+    """
+    Save a dataframe as a table of a data directory, replacing the table if it
+    already exists. The index is saved as columns if `index` is set.
+    """
+    if index:
+        df = df.reset_index()
+    with open_table_writer(data_dir, table, backend=backend) as writer:
+        writer.write(df)
+
+def migrate_data_directory(
+    data_dir: Path,
+    backend: str,
+    script_logger: logging.Logger,
+    keep_old_data: bool = False,
+):
+    """
+    Convert all the tables of a data directory which are not stored with the
+    given backend, the tables in other sqlite files of the directory (used by
+    the older versions of the scripts) are also converted
+    """
+    if backend not in storage_backends:
+        raise RuntimeError("Unknown storage backend: {}".format(backend))
+
+    converted = 0
+    for table, table_backend in list_tables(data_dir).items():
+        if table_backend == backend:
+            continue
+        df = read_table(data_dir, table)
+        script_logger.info("Converting the table {} of {} from {} into {}".format(table, data_dir, table_backend, backend))
+        with table_writers[backend](data_dir, table) as writer:
+            writer.write(df)
+        if not keep_old_data:
+            remove_table(data_dir, table, backend=table_backend)
+        converted += 1
+
+    for sqlite_file in sorted(data_dir.glob("*.sqlite")):
+        if sqlite_file.name == sqlite_file_name:
+            continue
+        for table in list_sqlite_tables(sqlite_file):
+            with sqlite3.connect(sqlite_file) as sqlite3_connection:
+                df = pandas.read_sql('SELECT * FROM "{}"'.format(table), sqlite3_connection, index_col=None)
+            script_logger.info("Converting the table {} of {} into {}".format(table, sqlite_file, backend))
+            with table_writers[backend](data_dir, table) as writer:
+                writer.write(df)
+            converted += 1
+        if not keep_old_data:
+            sqlite_file.unlink()
+
+    sqlite_file = data_dir/sqlite_file_name
+    if backend != "sqlite" and not keep_old_data and sqlite_file.is_file() and len(list_sqlite_tables(sqlite_file)) == 0:
+        sqlite_file.unlink()
+    return converted
+
+if __name__ == '__main__':
+    print("This is not a standalone script to run, it provides utilities which are run automatically as a part of the other scripts")
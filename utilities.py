@@ -29,7 +29,6 @@ import logging
 import pandas
 import numpy
 import sympy
-import sqlite3
 
 import plotly.express as px
 import plotly.graph_objects as go
@@ -37,6 +36,21 @@ import plotly.graph_objects as go
 from math import ceil
 from math import floor
 
+from storage_utilities import has_table
+from storage_utilities import read_table
+from storage_utilities import TableView
+from storage_utilities import EventTensor
+from storage_utilities import CutflowFilter
+from storage_utilities import has_filter
+from storage_utilities import read_filter
+
+# The columns of the etroc1_data table used by the plots, so that only these are read from the data
+etroc1_plot_columns = ["event", "data_board_id", "calibration_code", "time_of_arrival", "time_over_threshold"]
+time_plot_columns = etroc1_plot_columns + ["time_of_arrival_ns", "time_over_threshold_ns"]
+
+# The table where each stage saves the columns it derives from the etroc1_data table
+etroc1_derived_table = "etroc1_derived_data"
+
 def make_2d_line_plot(
     data_df: pandas.DataFrame,
     run_name: str,
@@ -751,7 +765,7 @@ def make_time_correlation_plot(
     )
 
 def make_board_scatter_with_fit_plot(
-    data_df: pandas.DataFrame,
+    event_tensor: EventTensor,
     base_path: Path,
     run_name: str,
     board_id: int,
@@ -768,9 +782,9 @@ def make_board_scatter_with_fit_plot(
     rounding_digits: int = 3,
     annotation_distance: float = 10,
     ):
-    accepted = data_df[("accepted", board_id)]
-    x_column = data_df.loc[accepted][(x_axis_col, board_id)].astype(float)
-    y_column = data_df.loc[accepted][(y_axis_col, board_id)].astype(float)
+    accepted = event_tensor[("accepted", board_id)]
+    x_column = event_tensor[(x_axis_col, board_id)].loc[accepted].astype(float)
+    y_column = event_tensor[(y_axis_col, board_id)].loc[accepted].astype(float)
     min_x = x_column.min()
     max_x = x_column.max()
 
@@ -1066,6 +1080,7 @@ def build_plots(
 
 def build_time_plots(
     original_df: pandas.DataFrame,
+    event_tensor: EventTensor,
     base_path: Path,
     run_name: str,
     task_name: str,
@@ -1093,14 +1108,11 @@ def build_time_plots(
     # Get list of all board ids
     board_ids = sorted(df["data_board_id"].unique())
 
-    # Create the pivot table with a column for each board
-    pivot_df = df.pivot(
-        index = 'event',
-        columns = 'data_board_id',
-        values = list(set(df.columns) - {'data_board_id', 'event'}),
+    # Take the events being plotted from the event tensor, with a column for each board, only for the variables used in the correlation plots
+    pivot_df = event_tensor.to_frame(
+        variables = ["time_of_arrival_ns", "time_over_threshold_ns"],
+        events = df["event"].unique(),
     )
-    # Rename columns so they are no longer hierarchical
-    pivot_df.columns = ["{}_{}".format(x, y) for x, y in pivot_df.columns]
 
     # Calculate plot ranges
     #   TOA
@@ -1204,38 +1216,70 @@ def build_time_plots(
         extra_title=extra_title,
     )
 
-def apply_event_filter(data_df: pandas.DataFrame, filter_df: pandas.DataFrame, filter_name: str = "event_filter"):
-    reindexed_data_df = data_df.set_index('event')
-    reindexed_data_df[filter_name] = filter_df
-    if "accepted" not in reindexed_data_df:
-        reindexed_data_df["accepted"] = reindexed_data_df[filter_name]
+def apply_event_filter(data_df: pandas.DataFrame, event_filter: CutflowFilter, filter_name: str = "event_filter"):
+    """
+    Returns the data with a `filter_name` column, flagging the rows of the
+    events which pass all the cuts of `event_filter`, and the `accepted`
+    column, flagging the rows which pass all the filters applied so far.
+    The flags are looked up with the event of each row, the data is not
+    reindexed.
+    """
+    accepted = event_filter.row_mask(data_df["event"].to_numpy())
+    data_df = data_df.copy(deep=False)  # Only new columns are set, so the data itself is not copied
+    data_df[filter_name] = accepted
+    if "accepted" not in data_df:
+        data_df["accepted"] = accepted
     else:
-        reindexed_data_df["accepted"] &= reindexed_data_df[filter_name]
-    return reindexed_data_df.reset_index()
+        data_df["accepted"] = data_df["accepted"].to_numpy() & accepted
+    return data_df
 
 def filter_dataframe(
     df:pandas.DataFrame,
-    filter_files:dict[Path],
+    filter_files:dict[str, Path | CutflowFilter],
     script_logger:logging.Logger,
     ):
+    """
+    Apply the "event" and "time" filters to the data, each given either as
+    the path of the filter file or as an already read filter
+    """
     for filter in filter_files:
-        if filter_files[filter].is_file():
-            filter_df = pandas.read_feather(filter_files[filter])
-            filter_df.set_index("event", inplace=True)
-
-            if filter == "event":
-                df = apply_event_filter(df, filter_df)
-            elif filter == "time":
-                df = apply_event_filter(df, filter_df, filter_name="time_filter")
-        else:
-            script_logger.error("The filter file {} does not exist".format(filter_files[filter]))
+        event_filter = filter_files[filter]
+        if isinstance(event_filter, Path):
+            if not has_filter(event_filter):
+                script_logger.error("The filter file {} does not exist".format(event_filter))
+                continue
+            event_filter = read_filter(event_filter)
+
+        if filter == "event":
+            df = apply_event_filter(df, event_filter)
+        elif filter == "time":
+            df = apply_event_filter(df, event_filter, filter_name="time_filter")
 
     return df
 
+def etroc1_data_view(
+    Manager: RM.RunManager,
+    derived_tasks: list[str],
+    ):
+    """
+    Returns a view of the etroc1_data table of a run joined with the columns
+    derived from it by the given tasks (in the order they were run)
+    """
+    data_view = TableView(Manager.path_directory/"data", "etroc1_data")
+    for task in derived_tasks:
+        task_path = Manager.get_task_path(task)
+        if has_table(task_path, etroc1_derived_table):
+            data_view.add_sidecar(task_path, etroc1_derived_table)
+        elif has_table(task_path, "etroc1_data"):  # Older runs, where each task saved a full copy of the data
+            data_view = TableView(task_path, "etroc1_data")
+        else:
+            raise RuntimeError("The task {} does not have any data for run {}".format(task, Manager.run_name))
+    return data_view
+
 def plot_etroc1_task(
         Bob_Manager:RM.RunManager,
         task_name:str,
-        data_file:Path,
+        data_dir:Path,
         filter_files:dict[str,Path] = {},
         drop_old_data:bool = True,
         extra_title: str = "",
@@ -1243,27 +1287,26 @@ def plot_etroc1_task(
 
     script_logger = logging.getLogger('run_plotter')
 
-    if not data_file.is_file():
-        script_logger.info("The data file should be an existing file")
+    if not has_table(data_dir, "etroc1_data"):
+        script_logger.info("The data directory should have the etroc1_data table")
         return
 
     with Bob_Manager.handle_task(task_name, drop_old_data=drop_old_data) as Picasso:
-        with sqlite3.connect(data_file) as sqlite3_connection:
-            df = pandas.read_sql('SELECT * FROM etroc1_data', sqlite3_connection, index_col=None)
+        df = read_table(data_dir, "etroc1_data", columns=etroc1_plot_columns)
 
-            df = filter_dataframe(
-                df=df,
-                filter_files=filter_files,
-                script_logger=script_logger,
-            )
+        df = filter_dataframe(
+            df=df,
+            filter_files=filter_files,
+            script_logger=script_logger,
+        )
 
-            build_plots(df, Picasso.run_name, task_name, Picasso.task_path, extra_title=extra_title)
+        build_plots(df, Picasso.run_name, task_name, Picasso.task_path, extra_title=extra_title)
 
 def plot_times_in_ns_task(
     Fermat: RM.RunManager,
     script_logger: logging.Logger,
     task_name:str,
-    data_file:Path,
+    data_view:TableView,
     filter_files:dict[str,Path] = {},
     drop_old_data:bool=True,
     extra_title: str = "",
@@ -1274,27 +1317,28 @@ def plot_times_in_ns_task(
     min_tot:float=-20,
     ):
     with Fermat.handle_task(task_name, drop_old_data=drop_old_data) as Monet:
-        with sqlite3.connect(data_file) as input_sqlite3_connection:
-            data_df = pandas.read_sql('SELECT * FROM etroc1_data', input_sqlite3_connection, index_col=None)
+        data_df = data_view.read(columns=time_plot_columns)
+        event_tensor = data_view.tensor(["time_of_arrival_ns", "time_over_threshold_ns"])
 
-            data_df = filter_dataframe(
-                df=data_df,
-                filter_files=filter_files,
-                script_logger=script_logger,
-            )
+        data_df = filter_dataframe(
+            df=data_df,
+            filter_files=filter_files,
+            script_logger=script_logger,
+        )
 
-            build_time_plots(
-                data_df,
-                base_path=Monet.task_path,
-                run_name=Monet.run_name,
-                task_name=Monet.task_name,
-                full_html=full_html,
-                max_toa=max_toa,
-                max_tot=max_tot,
-                min_toa=min_toa,
-                min_tot=min_tot,
-                extra_title=extra_title,
-            )
+        build_time_plots(
+            data_df,
+            event_tensor,
+            base_path=Monet.task_path,
+            run_name=Monet.run_name,
+            task_name=Monet.task_name,
+            full_html=full_html,
+            max_toa=max_toa,
+            max_tot=max_tot,
+            min_toa=min_toa,
+            min_tot=min_tot,
+            extra_title=extra_title,
+        )
 
 if __name__ == '__main__':
     print("This is not a standalone script to run, it provides utilities which are run automatically as a part of the other scripts")